@@ -0,0 +1,161 @@
+"""Benchmark the compiler on a corpus of PL/M kernels.
+
+   python benchmarks/bench.py [--update] [--target z80] [kernel ...]
+
+Each kernel in this directory is compiled with -s MAIN -o -t hlt and run in
+the 8080 simulator, or the Z80 simulator for --target z80.  A kernel
+states its expected results in comments:
+
+   /* EXPECT RESULT = 204 */
+
+The simulator starts at MAIN unless the kernel names another label:
+
+   /* ENTRY = TOP */
+
+The emitted bytes, simulated T-states and compile wall time of each
+kernel are compared with baseline.json (baseline_z80.json for the Z80).  Any wrong result, any growth in
+size or cycles, or a compile time more than --time-tolerance times the
+baseline is reported as a failure.  --update records new baselines."""
+
+import json
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from time import perf_counter
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+import pyplm
+from compiler import CompileError
+from sim8080 import Simulator, AsmError, SimError
+
+BASELINES = {"8080" : os.path.join(BENCHDIR, "baseline.json"),
+             "z80" : os.path.join(BENCHDIR, "baseline_z80.json")}
+MAX_CYCLES = 50000000
+
+EXPECT_RE = re.compile(r'EXPECT\s+([A-Z_][A-Z0-9_]*)\s*=\s*(\d+)')
+ENTRY_RE = re.compile(r'ENTRY\s*=\s*([A-Z_][A-Z0-9_]*)')
+
+
+def find_kernels(names):
+    """Get the kernel source files to run, all of them by default"""
+    if len(names) == 0:
+        names = sorted(n[:-4] for n in os.listdir(BENCHDIR) if n.endswith(".plm"))
+    return [(n, os.path.join(BENCHDIR, n + ".plm")) for n in names]
+
+
+def run_kernel(fileName, repeat, target):
+    """Compile and simulate one kernel.  Returns a dict of the measurements
+       and a list of errors."""
+    srcFile = open(fileName, "rt")
+    text = srcFile.read()
+    srcFile.close()
+    compiler = pyplm.Compiler(start = "MAIN", optimize = True, trailer = "hlt",
+                              target = target)
+    best = None
+    for n in range(repeat):
+        t = perf_counter()
+        with redirect_stdout(StringIO()):
+            result = compiler.compile(text)
+        t = perf_counter() - t
+        if (best is None) or (t < best):
+            best = t
+    entry = ENTRY_RE.search(text)
+    sim = Simulator(result.asm, z80 = (target == "z80"))
+    sim.run("MAIN" if entry is None else entry.group(1), MAX_CYCLES)
+    errors = []
+    if sim.exit != "hlt":
+        errors.append("exit by %s" % sim.exit)
+    for (name, value) in EXPECT_RE.findall(text):
+        actual = sim.read_word(name)
+        if actual != int(value):
+            errors.append("%s = %d, expected %s" % (name, actual, value))
+    stats = {"bytes" : result.size,
+             "cycles" : sim.cycles,
+             "compile_ms" : round(best * 1000.0, 2)}
+    return (stats, errors)
+
+
+def compare(stats, base, timeTolerance):
+    """Compare a kernel's measurements with its baseline, returns a list
+       of regressions"""
+    errors = []
+    if base is None:
+        return ["no baseline"]
+    for key in ("bytes", "cycles"):
+        if stats[key] > base[key]:
+            errors.append("%s %d > %d" % (key, stats[key], base[key]))
+    if (timeTolerance > 0) and (stats["compile_ms"] > base["compile_ms"] * timeTolerance):
+        errors.append("compile %.2fms > %.1f x %.2fms" %
+                      (stats["compile_ms"], timeTolerance, base["compile_ms"]))
+    return errors
+
+
+def main(argv):
+    """Benchmark entry point, returns the process exit status"""
+    argparser = ArgumentParser(prog = "bench")
+    argparser.add_argument("kernels", type=str, nargs="*",
+                           help="kernel names (default all)")
+    argparser.add_argument("-u", "--update", action="store_true",
+                           help="record the results as the new baseline")
+    argparser.add_argument("-r", "--repeat", action="store", type=int, default=3,
+                           help="compiles per kernel, the fastest is kept")
+    argparser.add_argument("-t", "--time-tolerance", action="store", type=float,
+                           default=3.0,
+                           help="allowed compile time factor over baseline, 0 to ignore")
+    argparser.add_argument("-z", "--target", action="store", type=str,
+                           choices = ("8080", "z80"), default="8080",
+                           help="processor to compile and simulate for")
+    args = argparser.parse_args(argv)
+
+    baseName = BASELINES[args.target]
+    baseline = {}
+    if os.path.exists(baseName):
+        baseFile = open(baseName, "rt")
+        baseline = json.load(baseFile)
+        baseFile.close()
+
+    failed = 0
+    print("%-12s %8s %10s %12s  %s" % ("kernel", "bytes", "cycles", "compile ms", "status"))
+    for (name, fileName) in find_kernels(args.kernels):
+        try:
+            (stats, errors) = run_kernel(fileName, args.repeat, args.target)
+        except (CompileError, AsmError, SimError, IOError) as e:
+            failed += 1
+            print("%-12s %8s %10s %12s  FAILED %s" % (name, "-", "-", "-", e))
+            continue
+        if (len(errors) == 0) and not args.update:
+            errors = compare(stats, baseline.get(name), args.time_tolerance)
+        status = "ok"
+        if len(errors) > 0:
+            failed += 1
+            status = "FAILED " + ", ".join(errors)
+        elif args.update:
+            baseline[name] = stats
+            status = "updated"
+        else:
+            base = baseline[name]
+            if (stats["bytes"] < base["bytes"]) or (stats["cycles"] < base["cycles"]):
+                status = "improved (%+d bytes, %+d cycles)" % \
+                         (stats["bytes"] - base["bytes"], stats["cycles"] - base["cycles"])
+        print("%-12s %8d %10d %12.2f  %s" %
+              (name, stats["bytes"], stats["cycles"], stats["compile_ms"], status))
+
+    if args.update and (failed == 0):
+        baseFile = open(baseName, "wt")
+        json.dump(baseline, baseFile, indent = 2, sort_keys = True)
+        baseFile.write("\n")
+        baseFile.close()
+    if failed > 0:
+        print("%d kernel(s) FAILED" % failed)
+        return -1
+    return 0
+
+
+if __name__ == '__main__':
+
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,84 @@
+"""Measure lexer throughput on comment heavy PL/M source.
+
+   python benchmarks/lexbench.py [--repeat n] [--comments n] [kernel ...]
+
+The kernels in this directory are joined into one source, with a block
+of --comments comment lines (in the style of a vendor header) before
+every declaration and procedure.  The source is lexed --repeat times
+and the best run is reported as tokens and characters per second."""
+
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHDIR))
+
+from lexer import plmlexer
+from bench import find_kernels
+
+HEADER_LINE = " *  %-6s %s  ; register usage, entry and exit conditions, see manual\n"
+
+STATEMENT_RE = re.compile(r'^(DECLARE|\w+:\s*PROCEDURE)', re.MULTILINE)
+
+
+def comment_block(name, lines):
+    """Get a multi-line comment describing name"""
+    text = "/*" + "*" * 60 + "\n"
+    for n in range(lines):
+        text += HEADER_LINE % (name, "-" * (n % 17))
+    return text + " " + "*" * 60 + "*/\n"
+
+
+def make_source(names, lines):
+    """Join the kernel sources, commenting every declaration and procedure"""
+    text = ""
+    for (name, fileName) in find_kernels(names):
+        srcFile = open(fileName, "rt")
+        src = srcFile.read()
+        srcFile.close()
+        text += STATEMENT_RE.sub(lambda m: comment_block(name, lines) + m.group(0), src)
+    return text
+
+
+def lex_source(text):
+    """Lex the whole source, returns the number of tokens"""
+    plmlexer.begin('INITIAL')
+    plmlexer.lineno = 1
+    plmlexer.input(text)
+    count = 0
+    for tok in iter(plmlexer.token, None):
+        count += 1
+    return count
+
+
+def main(argv):
+    """Lexer benchmark entry point, returns the process exit status"""
+    argparser = ArgumentParser(prog = "lexbench")
+    argparser.add_argument("kernels", type=str, nargs="*",
+                           help="kernel names (default all)")
+    argparser.add_argument("-r", "--repeat", action="store", type=int, default=20,
+                           help="lexer runs, the fastest is kept")
+    argparser.add_argument("-c", "--comments", action="store", type=int, default=12,
+                           help="comment lines before each declaration")
+    args = argparser.parse_args(argv)
+
+    text = make_source(args.kernels, args.comments)
+    best = None
+    for n in range(args.repeat):
+        t = perf_counter()
+        count = lex_source(text)
+        t = perf_counter() - t
+        if (best is None) or (t < best):
+            best = t
+    print("%d chars, %d lines, %d tokens" % (len(text), plmlexer.lineno, count))
+    print("%.2f ms, %.0f tokens/s, %.0f chars/s" %
+          (best * 1000.0, count / best, len(text) / best))
+    return 0
+
+
+if __name__ == '__main__':
+
+    exit(main(sys.argv[1:]))
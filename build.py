@@ -0,0 +1,228 @@
+"""Parallel build driver for compiling many PL/M modules.
+
+   python pyplm.py build [options] source ...
+   python pyplm.py build -m manifest
+
+Sources may be file names or glob patterns, each one is compiled to a
+.ASM file of the same name (in --outdir if given) using the shared
+compile options.  A manifest lists one module per line using the same
+arguments as a single file compile:
+
+   infile outfile [-e external] [-s start] [-o] [-i] [-t trailer] [-c]
+                   [-z target]
+
+Paths in a manifest are relative to the manifest file.  Blank lines and
+lines starting with # are ignored."""
+
+import json
+import os
+import shlex
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from glob import glob
+from io import StringIO
+
+import pyplm
+from cache import add_cache_options, cache_from_args
+from compiler import CompileError, RuleStats
+
+
+class BuildJob(object):
+    """A single module to compile, cache is a CompileCache or None and
+       log the Log for its diagnostics.  If stats is set the compile
+       statistics are collected."""
+
+    def __init__(self, inName, outName, options, cache = None, log = None,
+                 stats = False):
+        self.in_name = inName
+        self.out_name = outName
+        self.options = options
+        self.cache = cache
+        self.log = log
+        self.stats = stats
+
+    def __repr__(self):
+        return "BuildJob(%s,%s)" % (self.in_name, self.out_name)
+
+
+class BuildResult(object):
+    """Outcome of a BuildJob.  error is None on success and log holds
+       the compiler output for the module.  stats is the CompileStats
+       if they were collected."""
+
+    def __init__(self, job, error, log, size, stats = None):
+        self.job = job
+        self.error = error
+        self.log = log
+        self.size = size
+        self.stats = stats
+
+    def __repr__(self):
+        return "BuildResult(%s,%s,%s)" % (self.job.in_name, self.error, self.size)
+
+    def warnings(self):
+        """Get the warning lines from the compiler output"""
+        return [l for l in self.log.splitlines() if l.startswith("WARNING:")]
+
+
+def compile_job(job):
+    """Compile one module, runs in a worker process.  Any exception is
+       the failure of this module only, an unexpected one is reported
+       with its traceback."""
+    log = StringIO()
+    try:
+        with redirect_stdout(log):
+            inFile = open(job.in_name, "rt")
+            text = inFile.read()
+            inFile.close()
+            compiler = pyplm.Compiler(cache = job.cache, log = job.log,
+                                      stats = job.stats, **job.options)
+            result = compiler.compile(text)
+        outFile = open(job.out_name, "wt")
+        outFile.write(result.asm)
+        outFile.close()
+    except (CompileError, IOError) as e:
+        return BuildResult(job, str(e), log.getvalue(), None)
+    except Exception:
+        return BuildResult(job, "internal error\n" + traceback.format_exc().rstrip(),
+                           log.getvalue(), None)
+    return BuildResult(job, None, log.getvalue(), result.size, result.stats)
+
+
+def output_name(inName, outDir):
+    """Get the .ASM file name for a source file"""
+    base = os.path.splitext(inName)[0] + ".asm"
+    if outDir is not None:
+        base = os.path.join(outDir, os.path.basename(base))
+    return base
+
+
+def read_manifest(manName, cache, log, stats):
+    """Create the build jobs listed in a manifest file"""
+    baseDir = os.path.dirname(os.path.abspath(manName))
+    argparser = ArgumentParser(prog = manName)
+    argparser.add_argument("infile", type=str)
+    argparser.add_argument("outfile", type=str)
+    pyplm.add_options(argparser)
+    jobs = []
+    manFile = open(manName, "rt")
+    for line in manFile:
+        line = line.strip()
+        if (len(line) == 0) or line.startswith("#"):
+            continue
+        args = argparser.parse_args(shlex.split(line))
+        if args.external is not None:
+            args.external = os.path.join(baseDir, args.external)
+        jobs.append(BuildJob(os.path.join(baseDir, args.infile),
+                             os.path.join(baseDir, args.outfile),
+                             pyplm.compiler_options(args), cache, log, stats))
+    manFile.close()
+    return jobs
+
+
+def find_sources(patterns):
+    """Expand source names and glob patterns, keeping the given order"""
+    names = []
+    for pattern in patterns:
+        matches = sorted(glob(pattern))
+        if len(matches) == 0:
+            matches = [pattern]
+        for name in matches:
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def report_stats(results, asJson):
+    """Print the compile time and optimizer rule hits of each module and
+       the rule hits summed over all modules"""
+    rules = RuleStats()
+    modules = {}
+    lines = ["%-24s %10s %10s %10s" % ("module", "ms", "peak KB", "bytes")]
+    for result in results:
+        if result.stats is None:
+            continue
+        name = result.job.in_name
+        (calls, elapsed, peak) = result.stats.phases["total"]
+        lines.append("%-24s %10.3f %10.1f %10d" %
+                     (name, elapsed * 1000.0, peak / 1024.0, result.size))
+        rules.merge(result.stats.rules, name)
+        modules[name] = result.stats.as_dict()
+    if asJson:
+        print(json.dumps({"modules" : modules, "optimizer" : rules.as_dict()}))
+    else:
+        print("\n".join(lines) + "\n")
+        print(rules.table("module"), end="")
+        
+        
+def run_jobs(jobs, numWorkers):
+    """Compile all jobs, in parallel if more than one worker.
+       Results are returned in job order."""
+    if (numWorkers <= 1) or (len(jobs) <= 1):
+        return [compile_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers = numWorkers) as pool:
+        return list(pool.map(compile_job, jobs))
+
+
+def main(argv):
+    """Build driver entry point, returns the process exit status"""
+    argparser = ArgumentParser(prog = "pyplm build")
+    argparser.add_argument("sources", type=str, nargs="*",
+                           help="PL/M source files or glob patterns")
+    argparser.add_argument("-m", "--manifest", action="store", type=str,
+                           help="manifest file listing modules to build")
+    argparser.add_argument("-d", "--outdir", action="store", type=str,
+                           help="directory for output ASM files")
+    argparser.add_argument("-j", "--jobs", action="store", type=int,
+                           default=os.cpu_count(),
+                           help="number of worker processes")
+    pyplm.add_options(argparser)
+    pyplm.add_log_options(argparser)
+    add_cache_options(argparser)
+    argparser.add_argument("--stats", action="store_true",
+                           help="show compile time and optimizer rule hits of the modules, "
+                                "as JSON with --log-json")
+    args = argparser.parse_args(argv)
+
+    cache = cache_from_args(args)
+    log = pyplm.log_from_args(args)
+    jobs = []
+    if args.manifest is not None:
+        jobs.extend(read_manifest(args.manifest, cache, log, args.stats))
+    options = pyplm.compiler_options(args)
+    for name in find_sources(args.sources):
+        jobs.append(BuildJob(name, output_name(name, args.outdir), options, cache,
+                             log, args.stats))
+    if len(jobs) == 0:
+        argparser.error("no sources to build")
+    if args.outdir is not None:
+        os.makedirs(args.outdir, exist_ok = True)
+
+    failed = 0
+    results = run_jobs(jobs, args.jobs)
+    for result in results:
+        job = result.job
+        if (args.verbose > 0) or args.log_json:
+            print(result.log, end="")
+        else:
+            for line in result.warnings():
+                print("%s: %s" % (job.in_name, line))
+        if result.error is None:
+            print("OK      %s -> %s (%d bytes)" % (job.in_name, job.out_name, result.size))
+        else:
+            failed += 1
+            print("FAILED  %s: %s" % (job.in_name, result.error))
+    print("%d built, %d failed" % (len(jobs) - failed, failed))
+    if args.stats:
+        report_stats(results, args.log_json)
+    if failed > 0:
+        return -1
+    return 0
+
+
+if __name__ == '__main__':
+
+    import sys
+    exit(main(sys.argv[1:]))
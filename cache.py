@@ -0,0 +1,126 @@
+"""Content addressed cache of compiled modules.
+
+Each entry is keyed by a hash of the source text, the compile options,
+the contents of the EXTERNAL assembly file and the compiler version (a
+hash of the compiler sources).  A hit returns the stored assembly without
+lexing or parsing.  The cache directory is bounded in size, the least
+recently used entries are removed first.  The warnings of the compile
+are stored with the assembly and shown again on a hit."""
+
+import json
+import os
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+
+from compiler import CompileResult
+
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pyplm")
+DEFAULT_SIZE = 64
+
+g_version = None
+
+
+def compiler_version():
+    """Hash of the compiler sources, so any change to the compiler
+       invalidates the cache"""
+    global g_version
+    if g_version is None:
+        h = sha256()
+        for name in ("pyplm.py", "compiler.py", "lexer.py"):
+            srcFile = open(os.path.join(SRCDIR, name), "rb")
+            h.update(srcFile.read())
+            srcFile.close()
+        g_version = h.hexdigest()
+    return g_version
+    
+    
+class CompileCache(object):
+    """Size bounded LRU cache of compile results stored in a directory"""
+
+    def __init__(self, dirName = None, maxSize = DEFAULT_SIZE):
+        if dirName is None:
+            dirName = os.environ.get("PYPLM_CACHE", DEFAULT_DIR)
+        self.dir_name = dirName
+        self.max_size = maxSize * 1024 * 1024
+        
+    def __repr__(self):
+        return "CompileCache(%s,%d)" % (self.dir_name, self.max_size)
+        
+    def key(self, text, options):
+        """Get the cache key for a source text and compile options"""
+        h = sha256()
+        h.update(compiler_version().encode())
+        h.update(repr(sorted(options.items())).encode())
+        external = options.get("external")
+        if external is not None:
+            extFile = open(external, "rb")
+            h.update(extFile.read())
+            extFile.close()
+        h.update(text.encode())
+        return h.hexdigest()
+        
+    def get(self, key):
+        """Lookup a compile result.  Returns None if not cached."""
+        path = os.path.join(self.dir_name, key + ".json")
+        try:
+            entryFile = open(path, "rt")
+            entry = json.load(entryFile)
+            entryFile.close()
+            os.utime(path)
+        except (IOError, ValueError):
+            return None
+        return CompileResult(entry["asm"], entry["end_addr"],
+                             warnings = entry["warnings"])
+        
+    def put(self, key, result):
+        """Store a compile result and evict old entries if the cache is
+           over size.  Failures to write are ignored."""
+        try:
+            os.makedirs(self.dir_name, exist_ok = True)
+            entryFile = NamedTemporaryFile("wt", dir = self.dir_name,
+                                           suffix = ".tmp", delete = False)
+            json.dump({"asm" : result.asm, "end_addr" : result.end_addr,
+                       "warnings" : result.warnings}, entryFile)
+            entryFile.close()
+            os.replace(entryFile.name, os.path.join(self.dir_name, key + ".json"))
+            self.evict()
+        except IOError:
+            pass
+            
+    def evict(self):
+        """Remove least recently used entries until the cache fits"""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.dir_name):
+            if entry.name.endswith(".json"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except IOError:
+                pass
+            total -= size
+            
+            
+def add_cache_options(argparser):
+    """Add the compile cache options to an ArgumentParser"""
+    argparser.add_argument("--cache-dir", action="store", type=str,
+                           help="compile cache directory (default $PYPLM_CACHE or %s)" % DEFAULT_DIR)
+    argparser.add_argument("--cache-size", action="store", type=int,
+                           default=DEFAULT_SIZE,
+                           help="maximum compile cache size in MB")
+    argparser.add_argument("--no-cache", action="store_true",
+                           help="do not use the compile cache")
+                           
+                           
+def cache_from_args(args):
+    """Create the CompileCache selected by parsed options, or None"""
+    if args.no_cache:
+        return None
+    return CompileCache(args.cache_dir, args.cache_size)
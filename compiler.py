@@ -1,3 +1,6 @@
+import json
+import tracemalloc
+from time import perf_counter
 
 
 class Symbol(object):
@@ -72,10 +75,15 @@ class Label(Symbol):
         return "Label(%s,0x%04x)" % (self.name, self.addr)
         
 class CodeBlock(Symbol):
+    """Compiled code of the procedure proc.  hits lists the optimizer
+       rules which rewrote it as (rule, bytes, cycles) when statistics
+       are collected."""
 
-    def __init__(self, addr, size, cdata):
+    def __init__(self, addr, size, cdata, proc = None):
         Symbol.__init__(self, '', addr, size)
         self.cdata = cdata
+        self.proc = proc
+        self.hits = None
         
     def __repr__(self):
         return "CodeBlock(0x%04x,%s,%s)" % (self.addr, self.size, self.cdata) 
@@ -104,6 +112,177 @@ class UserProcedure(Procedure):
         
 class ExternalProcedure(UserProcedure): pass
 
+# 8080 instruction sizes in bytes
+OPCODE_SIZES = {}
+for op in ('MOV', 'ADD', 'ADC', 'SUB', 'SBB', 'ANA', 'XRA', 'ORA', 'CMP',
+           'INR', 'DCR', 'INX', 'DCX', 'DAD', 'LDAX', 'STAX', 'PUSH', 'POP',
+           'XCHG', 'XTHL', 'SPHL', 'PCHL', 'RLC', 'RRC', 'RAL', 'RAR',
+           'CMA', 'CMC', 'STC', 'DAA', 'RET', 'RNZ', 'RZ', 'RNC', 'RC',
+           'RPO', 'RPE', 'RP', 'RM', 'RST', 'EI', 'DI', 'NOP', 'HLT'):
+    OPCODE_SIZES[op] = 1
+for op in ('MVI', 'ADI', 'ACI', 'SUI', 'SBI', 'ANI', 'XRI', 'ORI', 'CPI',
+           'IN', 'OUT'):
+    OPCODE_SIZES[op] = 2
+for op in ('LXI', 'LDA', 'STA', 'LHLD', 'SHLD', 'JMP', 'JNZ', 'JZ', 'JNC',
+           'JC', 'JPO', 'JPE', 'JP', 'JM', 'CALL', 'CNZ', 'CZ', 'CNC', 'CC',
+           'CPO', 'CPE', 'CP', 'CM'):
+    OPCODE_SIZES[op] = 3
+
+# Z80 only instruction sizes in bytes, using the Intel style mnemonics
+# of the Z80.LIB macro library: JR, JRZ, JRNZ, JRC, JRNC, DJNZ, LDIR,
+# DSBC (SBC HL,rp), LIXD/LIYD (LD IX/IY,(addr)) and LDX/LDY (LD r,(IX/IY+d))
+Z80_OPCODE_SIZES = {}
+for op in ('JR', 'JRZ', 'JRNZ', 'JRC', 'JRNC', 'DJNZ', 'LDIR', 'DSBC'):
+    Z80_OPCODE_SIZES[op] = 2
+for op in ('LDX', 'LDY'):
+    Z80_OPCODE_SIZES[op] = 3
+for op in ('LIXD', 'LIYD'):
+    Z80_OPCODE_SIZES[op] = 4
+
+INSTR_SIZES = dict(OPCODE_SIZES)
+INSTR_SIZES.update(Z80_OPCODE_SIZES)
+
+# estimated T-states of each instruction, used to report the savings of
+# the optimizer.  8080 timings with conditional jumps, calls and returns
+# counted as taken, Z80 timings for the Z80 only instructions and LDIR
+# for one byte.  M_CYCLES are the timings with an M operand.
+INSTR_CYCLES = {}
+for op in ('ADD', 'ADC', 'SUB', 'SBB', 'ANA', 'XRA', 'ORA', 'CMP', 'XCHG',
+           'RLC', 'RRC', 'RAL', 'RAR', 'CMA', 'CMC', 'STC', 'DAA', 'EI',
+           'DI', 'NOP'):
+    INSTR_CYCLES[op] = 4
+for op in ('MOV', 'INR', 'DCR', 'INX', 'DCX', 'PCHL', 'SPHL'):
+    INSTR_CYCLES[op] = 5
+for op in ('MVI', 'LDAX', 'STAX', 'ADI', 'ACI', 'SUI', 'SBI', 'ANI', 'XRI',
+           'ORI', 'CPI', 'HLT'):
+    INSTR_CYCLES[op] = 7
+for op in ('LXI', 'DAD', 'JMP', 'JNZ', 'JZ', 'JNC', 'JC', 'JPO', 'JPE', 'JP',
+           'JM', 'RET', 'POP', 'IN', 'OUT'):
+    INSTR_CYCLES[op] = 10
+for op in ('RNZ', 'RZ', 'RNC', 'RC', 'RPO', 'RPE', 'RP', 'RM', 'RST', 'PUSH'):
+    INSTR_CYCLES[op] = 11
+for op in ('CALL', 'CNZ', 'CZ', 'CNC', 'CC', 'CPO', 'CPE', 'CP', 'CM'):
+    INSTR_CYCLES[op] = 17
+INSTR_CYCLES.update({'LDA' : 13, 'STA' : 13, 'LHLD' : 16, 'SHLD' : 16,
+                     'XTHL' : 18, 'JR' : 12, 'JRZ' : 12, 'JRNZ' : 12,
+                     'JRC' : 12, 'JRNC' : 12, 'DJNZ' : 13, 'LDIR' : 21,
+                     'DSBC' : 15, 'LDX' : 19, 'LDY' : 19, 'LIXD' : 20,
+                     'LIYD' : 20})
+M_CYCLES = {'MOV' : 7, 'INR' : 10, 'DCR' : 10, 'MVI' : 10}
+for op in ('ADD', 'ADC', 'SUB', 'SBB', 'ANA', 'XRA', 'ORA', 'CMP'):
+    M_CYCLES[op] = 7
+
+class Instr(object):
+    """A single 8080 instruction with up to two operands.  Z80 only
+       instructions use the Intel style mnemonics of Z80_OPCODE_SIZES."""
+    __slots__ = ('op', 'arg1', 'arg2', 'size', 'comment')
+
+    def __init__(self, op, arg1 = None, arg2 = None, comment = None):
+        self.op = op
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.size = INSTR_SIZES[op]
+        self.comment = comment
+        
+    def __repr__(self):
+        return "Instr(%s,%s,%s,%d)" % (self.op, self.arg1, self.arg2, self.size)
+        
+    def __str__(self):
+        s = self.op
+        if self.arg1 is not None:
+            s += " " + self.arg1
+            if self.arg2 is not None:
+                s += "," + self.arg2
+        if self.comment is not None:
+            s += "  ; " + self.comment
+        return s
+        
+def instr_cycles(instr):
+    """Get the estimated T-states of an instruction"""
+    if (instr.op in M_CYCLES) and ((instr.arg1 == 'M') or (instr.arg2 == 'M')):
+        return M_CYCLES[instr.op]
+    return INSTR_CYCLES[instr.op]
+        
+# Zilog mnemonics of the 8080 and Z80 instructions
+ZILOG_REGS = {'M' : '(HL)'}
+ZILOG_PAIRS = {'B' : 'BC', 'D' : 'DE', 'H' : 'HL', 'SP' : 'SP', 'PSW' : 'AF'}
+ZILOG_IMPLIED = {'XCHG' : 'EX DE,HL', 'XTHL' : 'EX (SP),HL', 'SPHL' : 'LD SP,HL',
+                 'PCHL' : 'JP (HL)', 'RLC' : 'RLCA', 'RRC' : 'RRCA', 'RAL' : 'RLA',
+                 'RAR' : 'RRA', 'CMA' : 'CPL', 'CMC' : 'CCF', 'STC' : 'SCF',
+                 'DAA' : 'DAA', 'RET' : 'RET', 'EI' : 'EI', 'DI' : 'DI',
+                 'NOP' : 'NOP', 'HLT' : 'HALT', 'LDIR' : 'LDIR'}
+ZILOG_ALU = {'ADD' : 'ADD A,', 'ADC' : 'ADC A,', 'SUB' : 'SUB ', 'SBB' : 'SBC A,',
+             'ANA' : 'AND ', 'XRA' : 'XOR ', 'ORA' : 'OR ', 'CMP' : 'CP ',
+             'ADI' : 'ADD A,', 'ACI' : 'ADC A,', 'SUI' : 'SUB ', 'SBI' : 'SBC A,',
+             'ANI' : 'AND ', 'XRI' : 'XOR ', 'ORI' : 'OR ', 'CPI' : 'CP '}
+ZILOG_CONDS = ('NZ', 'Z', 'NC', 'C', 'PO', 'PE', 'P', 'M')
+
+def zilog_text(instr):
+    """Get the Zilog assembly text of an instruction, with its comment"""
+    op = instr.op
+    a1 = instr.arg1
+    a2 = instr.arg2
+    if op == 'MOV':
+        s = "LD %s,%s" % (ZILOG_REGS.get(a1, a1), ZILOG_REGS.get(a2, a2))
+    elif op == 'MVI':
+        s = "LD %s,%s" % (ZILOG_REGS.get(a1, a1), a2)
+    elif op == 'LXI':
+        s = "LD %s,%s" % (ZILOG_PAIRS[a1], a2)
+    elif op == 'LDA':
+        s = "LD A,(%s)" % a1
+    elif op == 'STA':
+        s = "LD (%s),A" % a1
+    elif op == 'LHLD':
+        s = "LD HL,(%s)" % a1
+    elif op == 'SHLD':
+        s = "LD (%s),HL" % a1
+    elif op == 'LDAX':
+        s = "LD A,(%s)" % ZILOG_PAIRS[a1]
+    elif op == 'STAX':
+        s = "LD (%s),A" % ZILOG_PAIRS[a1]
+    elif op in ZILOG_ALU:
+        s = ZILOG_ALU[op] + ZILOG_REGS.get(a1, a1)
+    elif op in ('INR', 'DCR'):
+        s = "%s %s" % ("INC" if op == 'INR' else "DEC", ZILOG_REGS.get(a1, a1))
+    elif op in ('INX', 'DCX'):
+        s = "%s %s" % ("INC" if op == 'INX' else "DEC", ZILOG_PAIRS[a1])
+    elif op == 'DAD':
+        s = "ADD HL,%s" % ZILOG_PAIRS[a1]
+    elif op == 'DSBC':
+        s = "SBC HL,%s" % ZILOG_PAIRS[a1]
+    elif op in ('PUSH', 'POP'):
+        s = "%s %s" % (op, ZILOG_PAIRS[a1])
+    elif op in ZILOG_IMPLIED:
+        s = ZILOG_IMPLIED[op]
+    elif op == 'JMP':
+        s = "JP %s" % a1
+    elif op == 'CALL':
+        s = "CALL %s" % a1
+    elif op in ('JR', 'DJNZ'):
+        s = "%s %s" % (op, a1)
+    elif op.startswith('JR'):
+        s = "JR %s,%s" % (op[2:], a1)
+    elif (op[0] in 'JCR') and (op[1:] in ZILOG_CONDS):
+        s = {'J' : "JP ", 'C' : "CALL ", 'R' : "RET "}[op[0]] + op[1:]
+        if a1 is not None:
+            s += "," + a1
+    elif op == 'RST':
+        n = int(a1[:-1], 16) if a1.endswith('H') else int(a1)
+        s = "RST %03XH" % (n * 8)
+    elif op == 'IN':
+        s = "IN A,(%s)" % a1
+    elif op == 'OUT':
+        s = "OUT (%s),A" % a1
+    elif op in ('LIXD', 'LIYD'):
+        s = "LD I%s,(%s)" % (op[2], a1)
+    elif op in ('LDX', 'LDY'):
+        s = "LD %s,(I%s+%s)" % (a1, op[2], a2)
+    else:
+        raise ValueError("no Zilog form for %s" % op)
+    if instr.comment is not None:
+        s += "  ; " + instr.comment
+    return s
+        
 def strip_comment(line):
     """Remove any comment from a line of code."""
     p = line.find(';')
@@ -148,12 +327,334 @@ def get_instr(line):
     """Get just the instruction from a line of code"""
     sl = line.split()
     return sl[0].strip()
+
+def parse_instr(line):
+    """Split a line of code into an (instruction, arg1, arg2) tuple.
+       Missing arguments are None."""
+    return (get_instr(line), get_arg1(line), get_arg2(line))
         
+class CompileError(Exception):
+    """Error which stops the compilation"""
+    
 def fatal(msg):
-    """Print error message and exit with failure code"""
-    print("ERROR:", msg)
-    exit(-1)
+    """Stop the compilation with an error message"""
+    raise CompileError(msg)
+
+# diagnostic levels, a message is shown if its level is at or below
+# the Log level.  -v shows INFO and -vv DEBUG.
+ERROR = 0
+WARNING = 1
+INFO = 2
+DEBUG = 3
+LEVEL_NAMES = ("error", "warning", "info", "debug")
+
+class Log(object):
+    """Destination of the compiler diagnostics.  Messages above level are
+       dropped before they are formatted.  The rest are printed as text,
+       or as one JSON object per line if json is set."""
+
+    def __init__(self, level = WARNING, json = False):
+        self.level = level
+        self.json = json
+        
+    def __repr__(self):
+        return "Log(%s,%s)" % (LEVEL_NAMES[self.level], self.json)
+        
+    def write(self, level, kind, msg):
+        """Print a formatted message"""
+        if self.json:
+            print(json.dumps({"level" : LEVEL_NAMES[level], "kind" : kind,
+                              "msg" : msg}))
+        elif level <= WARNING:
+            print("%s: %s" % (LEVEL_NAMES[level].upper(), msg))
+        else:
+            print(msg)
+            
+g_log = Log()
+g_warnings = []
+
+def set_log(newLog):
+    """Send diagnostics to newLog and start a new list of warnings"""
+    global g_log
+    g_log = newLog
+    del g_warnings[:]
+    
+def log_state():
+    """Get the log and the warnings so far, for restore_log"""
+    return (g_log, list(g_warnings))
+    
+def restore_log(state):
+    """Go back to a log and warnings from log_state"""
+    global g_log
+    (g_log, warnings) = state
+    g_warnings[:] = warnings
+    
+def log(level, kind, msg, *args):
+    """Record a diagnostic of the given kind.  msg is a format string
+       which is only applied to args if the level is enabled."""
+    if level <= g_log.level:
+        if len(args) > 0:
+            msg = msg % args
+        g_log.write(level, kind, msg)
 
 def warning(msg):
-    """Print warning message"""
-    print("WARNING:", msg)
\ No newline at end of file
+    """Record a warning message, which is also kept in g_warnings"""
+    g_warnings.append(msg)
+    log(WARNING, "warning", msg)
+    
+    
+class PeepholeRule(object):
+    """A peephole rewrite rule.  The pattern is a sequence of instruction
+       templates such as "MVI E,*" where * matches any argument.  The
+       handler is given the matched instructions and returns the
+       replacement instructions, or None to reject the match."""
+
+    def __init__(self, name, pattern, handler, removeSize):
+        self.name = name
+        self.pattern = tuple(parse_instr(p) for p in pattern)
+        self.handler = handler
+        self.remove_size = removeSize
+        
+    def __repr__(self):
+        return "PeepholeRule(%s,%d)" % (self.name, self.remove_size)
+        
+    def match(self, code, idx):
+        """Check the instructions starting at idx against the pattern"""
+        if idx + len(self.pattern) > len(code):
+            return False
+        for n in range(len(self.pattern)):
+            (op, arg1, arg2) = self.pattern[n]
+            instr = code[idx + n]
+            if op != instr.op:
+                return False
+            if (arg1 != '*') and (arg1 != instr.arg1):
+                return False
+            if (arg2 != '*') and (arg2 != instr.arg2):
+                return False
+        return True
+    
+    
+class CompileResult(object):
+    """Output of a successful compilation, warnings is the list of
+       warning messages and stats is a CompileStats if they were
+       collected"""
+
+    def __init__(self, asm, endAddr, stats = None, warnings = ()):
+        self.asm = asm
+        self.end_addr = endAddr
+        self.size = endAddr - 0x0100
+        self.stats = stats
+        self.warnings = list(warnings)
+        
+    def __repr__(self):
+        return "CompileResult(0x%04x,%d)" % (self.end_addr, self.size)
+        
+        
+class RuleStats(object):
+    """Hits of the optimizer rules.  For each procedure and rule the
+       number of hits, the code bytes and the estimated T-states saved
+       are kept.  Rules listed in names are reported even if they never
+       fire."""
+    
+    def __init__(self, names = ()):
+        self.names = list(names)
+        self.hits = {}
+        
+    def __repr__(self):
+        return "RuleStats(%d rules,%d hits)" % (len(self.names), len(self.hits))
+        
+    def add(self, rule, proc, size, cycles, count = 1):
+        """Record count hits of a rule in a procedure"""
+        if rule not in self.names:
+            self.names.append(rule)
+        hit = self.hits.setdefault((proc, rule), [0, 0, 0])
+        hit[0] += count
+        hit[1] += size
+        hit[2] += cycles
+        
+    def merge(self, other, proc = None):
+        """Add the hits of another RuleStats, all of them to proc if given"""
+        for name in other.names:
+            if name not in self.names:
+                self.names.append(name)
+        for ((otherProc, rule), (count, size, cycles)) in other.hits.items():
+            self.add(rule, otherProc if proc is None else proc, size, cycles, count)
+            
+    def totals(self, index):
+        """Sum the hits by rule (index 1) or by procedure (index 0)"""
+        sums = {}
+        if index == 1:
+            for name in self.names:
+                sums[name] = [0, 0, 0]
+        for (key, hit) in sorted(self.hits.items()):
+            total = sums.setdefault(key[index], [0, 0, 0])
+            for n in range(3):
+                total[n] += hit[n]
+        return sums
+        
+    def as_dict(self):
+        """Get the hits as plain data for JSON output"""
+        procs = {}
+        for ((proc, rule), (count, size, cycles)) in sorted(self.hits.items()):
+            procs.setdefault(proc, {})[rule] = {"hits" : count, "bytes" : size,
+                                                "cycles" : cycles}
+        rules = {}
+        for (rule, (count, size, cycles)) in self.totals(1).items():
+            rules[rule] = {"hits" : count, "bytes" : size, "cycles" : cycles}
+        return {"rules" : rules, "procedures" : procs}
+        
+    def table(self, procTitle = "procedure"):
+        """Get the totals by rule and by procedure as a text table"""
+        lines = []
+        for (title, index) in (("rule", 1), (procTitle, 0)):
+            lines.append("%-24s %6s %10s %10s" % (title, "hits", "bytes", "cycles"))
+            total = [0, 0, 0]
+            for (name, hit) in self.totals(index).items():
+                lines.append("%-24s %6d %10d %10d" % (name, hit[0], hit[1], hit[2]))
+                for n in range(3):
+                    total[n] += hit[n]
+            lines.append("%-24s %6d %10d %10d" % ("total", total[0], total[1], total[2]))
+            lines.append("")
+        return "\n".join(lines)
+        
+        
+class CompileStats(object):
+    """Measurements of one compilation.  Each phase records its number of
+       runs, total wall time and the peak traced memory while it ran.  A
+       phase run inside another is named parent/child.  counts holds the
+       sizes of the compiled program and rules the optimizer rule hits."""
+
+    def __init__(self, ruleNames = ()):
+        self.phases = {}
+        self.counts = {}
+        self.rules = RuleStats(ruleNames)
+        self.stack = []
+        self.started = False
+        
+    def __repr__(self):
+        return "CompileStats(%d phases)" % len(self.phases)
+        
+    def start(self):
+        """Start tracing memory allocations"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+            
+    def stop(self):
+        """Stop tracing memory allocations if start began it"""
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+            
+    def peak(self):
+        """Get the traced memory peak since the last reset"""
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[1]
+        return 0
+            
+    def measure(self, name, func, *args):
+        """Run func(*args) as a phase and return its result"""
+        if len(self.stack) > 0:
+            outer = self.stack[-1]
+            outer[1] = max(outer[1], self.peak())
+            name = outer[0] + "/" + name
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        phase = self.phases.setdefault(name, [0, 0.0, 0])
+        entry = [name, 0]
+        self.stack.append(entry)
+        start = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = perf_counter() - start
+            self.stack.pop()
+            peak = max(entry[1], self.peak())
+            if len(self.stack) > 0:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            phase[0] += 1
+            phase[1] += elapsed
+            phase[2] = max(phase[2], peak)
+            
+    def record(self, name, elapsed, peak = 0):
+        """Add a phase measured elsewhere"""
+        self.phases[name] = [1, elapsed, peak]
+            
+    def as_dict(self):
+        """Get the measurements as plain data for JSON output"""
+        phases = []
+        for (name, (calls, elapsed, peak)) in self.phases.items():
+            phases.append({"phase" : name, "calls" : calls,
+                           "ms" : round(elapsed * 1000.0, 3),
+                           "peak_kb" : round(peak / 1024.0, 1)})
+        return {"phases" : phases, "counts" : dict(self.counts),
+                "optimizer" : self.rules.as_dict()}
+        
+    def table(self):
+        """Get the measurements as a text table"""
+        lines = ["%-24s %6s %10s %10s" % ("phase", "calls", "ms", "peak KB")]
+        for (name, (calls, elapsed, peak)) in self.phases.items():
+            if peak > 0:
+                peak = "%10.1f" % (peak / 1024.0)
+            else:
+                peak = "%10s" % "-"
+            lines.append("%-24s %6d %10.3f %s" %
+                         (name, calls, elapsed * 1000.0, peak))
+        lines.append("")
+        for (name, value) in self.counts.items():
+            lines.append("%-24s %6d" % (name, value))
+        lines.append("")
+        return "\n".join(lines) + "\n" + self.rules.table()
+        
+        
+class SymbolTable(object):
+    """Hash indexed symbol table.  Data symbols are keyed by their
+       mangled name (_PROC_NAME for procedure locals) so a lookup costs
+       one dict probe per enclosing procedure instead of a list scan.
+       The ordered output stream (code blocks, labels and allocated data)
+       is kept separately by the compiler."""
+
+    def __init__(self):
+        self.alloc = {}
+        self.uninit = {}
+        self.procs = {}
+        self.anon = {}
+
+    def add_alloc(self, sym):
+        """Add a data symbol which is allocated in the output stream"""
+        self.alloc.setdefault(sym.name, sym)
+
+    def add_uninit(self, sym):
+        """Add an uninitialized data symbol"""
+        self.uninit.setdefault(sym.name, sym)
+
+    def add_proc(self, sym):
+        """Add a procedure, later declarations take precedence"""
+        self.procs[sym.name] = sym
+
+    def add_anon(self, sym):
+        """Add an anonymous data symbol"""
+        self.anon.setdefault(sym.name, sym)
+
+    def lookup_data(self, name):
+        """Lookup a data symbol by mangled name.
+           Returns None if not found."""
+        sym = self.alloc.get(name)
+        if sym is None:
+            sym = self.uninit.get(name)
+        return sym
+
+    def lookup(self, name, procStack):
+        """Lookup symbol by name, with scope and precedence: locals of the
+           enclosing procedures (innermost first), globals, procedures
+           and anonymous data.  Returns None if not found."""
+        for proc in reversed(procStack):
+            sym = self.lookup_data("_%s_%s" % (proc, name))
+            if sym is not None:
+                return sym
+        sym = self.lookup_data(name)
+        if sym is None:
+            sym = self.procs.get(name)
+            if sym is None:
+                sym = self.anon.get(name)
+        return sym
@@ -1,10 +1,17 @@
 
-from copy import copy
+import os
+import sys
+from hashlib import md5
+from importlib import util
+from time import perf_counter
 
 import ply.lex as lex
 
-states = (('comment', 'exclusive'),
-          ('literal', 'exclusive'))
+# cached lexer and parser tables live next to the compiler modules
+TABDIR = os.path.dirname(os.path.abspath(__file__))
+LEXTAB = 'plmlextab'
+
+states = ()
 
 tokens = ['LCOMMENT',
           'ASTERIX',
@@ -89,30 +96,14 @@ keywords = set(  ('DECLARE',
     
 
 def t_LCOMMENT(t):
-    r'\/\*'
-    t.lexer.begin('comment')
-    
-def t_comment_RCOMMENT(t):
-    r'\*\/'
-    t.lexer.begin('INITIAL')
-    
-def t_comment_asterisk(t):
-    r'\*+[^\/]'
-    
-def t_comment_slash(t):
-    r'[^*]+\/'
-    
-def t_comment_string(t):
-    r'[^\*\/]'
-    
-def t_comment_error(t):
-    pass
-    
-def t_comment_newline(t):
-    r'\n+'
-    t.lexer.lineno += len(t.value)
-    
-t_comment_ignore = ''
+    r'\/\*[^*]*\*+(?:[^*\/][^*]*\*+)*\/'
+    # the whole comment is one match, only its newlines need counting
+    t.lexer.lineno += t.value.count('\n')
+    
+def t_UNTERMINATED(t):
+    r'\/\*[\s\S]*'
+    # comment runs to the end of the input
+    t.lexer.lineno += t.value.count('\n')
 
 def t_ASTERIX(t):
     r'\*'
@@ -134,33 +125,24 @@ def t_SEMICOLON(t):
     r';'
     return t
     
-def t_SQUOTE(t):
-    r'\''
-    t.lexer.begin('literal')
-    t.lexer.sbuf = ""
-    return None
-    
-def t_literal_SQUOTE(t):
-    r'\''
-    if len(t.lexer.sbuf) == 1:
+def t_STRING(t):
+    r"'[^']*(?:''[^']*)*'"
+    # a doubled quote stands for one quote in the string
+    t.value = t.value[1:-1]
+    if "''" in t.value:
+        t.value = t.value.replace("''", "'")
+    if len(t.value) == 1:
         t.type = 'DECNUMBER'
-        t.value = ord(t.lexer.sbuf[0])
+        t.value = ord(t.value)
     else:
-        t.type = 'STRING'
-        t.value = copy(t.lexer.sbuf)
-    t.lexer.begin('INITIAL')
+        t.lexer.lineno += t.value.count('\n')
     return t
     
-def t_literal_STRING(t):
-    r'[^\']+'
-    t.lexer.sbuf += t.value
-    return None
-    
-def t_literal_error(t):
-    pass
+def t_SQUOTE(t):
+    r"'[\s\S]*"
+    # string runs to the end of the input
+    t.lexer.lineno += t.value.count('\n')
     
-t_literal_ignore = ''
-
 def t_AT(t):
     r'AT'
     return t
@@ -251,7 +233,62 @@ t_ignore = ' \t\r'
 def t_error(t):
     print("ERROR: ", t.value)
 
-plmlexer = lex.lex()
+def load_table(name, dirname):
+    """Import a cached table module from dirname, bypassing sys.path so a
+       stale copy in the working directory is never used.
+       Returns None if the table does not exist."""
+    path = os.path.join(dirname, name + '.py')
+    if not os.path.exists(path):
+        return None
+    spec = util.spec_from_file_location(name, path)
+    module = util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+    
+    
+def lexer_signature():
+    """Hash of the token rules, used to validate the cached lexer table.
+       Only the rule names and regexes are used, so moving code around
+       does not invalidate the table.  Function rules keep the order in
+       which they are defined, which is their matching priority."""
+    funcs = []
+    strs = []
+    for name, value in globals().items():
+        if not name.startswith('t_'):
+            continue
+        if callable(value):
+            funcs.append("%s %s" % (name, value.__doc__))
+        else:
+            strs.append("%s %r" % (name, value))
+    strs.sort()
+    sig = md5()
+    sig.update(repr((tokens, states)).encode())
+    sig.update("\n".join(funcs + strs).encode())
+    return sig.hexdigest()
+    
+    
+def build_lexer():
+    """Create the lexer from the cached table if its signature matches
+       the token rules, otherwise build it and refresh the cache."""
+    sig = lexer_signature()
+    tab = load_table(LEXTAB, TABDIR)
+    if getattr(tab, '_lexsignature', None) == sig:
+        return lex.lex(optimize=1, lextab=tab)
+    lexer = lex.lex()
+    try:
+        lexer.writetab(LEXTAB, TABDIR)
+        with open(os.path.join(TABDIR, LEXTAB + '.py'), 'a') as tabFile:
+            tabFile.write("_lexsignature = %r\n" % sig)
+    except IOError:
+        pass
+    return lexer
+    
+
+# time to load or build the lexer, reported by --stats
+load_start = perf_counter()
+plmlexer = build_lexer()
+LOAD_TIME = perf_counter() - load_start
 
 
 if __name__ == '__main__':
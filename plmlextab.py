@@ -0,0 +1,11 @@
+# plmlextab.py. This file automatically created by PLY (version 3.11). Don't edit!
+_tabversion   = '3.10'
+_lextokens    = set(('ADDRESS', 'AND', 'ASSIGN', 'ASTERIX', 'AT', 'BASED', 'BINNUMBER', 'BY', 'BYTE', 'CALL', 'CASE', 'COLON', 'COMMA', 'DATA', 'DECLARE', 'DECNUMBER', 'DIV', 'DO', 'ELSE', 'END', 'EQUAL', 'EXTERNAL', 'GO', 'GREATERTHAN', 'GREATERTHANEQUAL', 'HEXNUMBER', 'IDENT', 'IF', 'LCOMMENT', 'LESSTHAN', 'LESSTHANEQUAL', 'LITERALLY', 'LPARENS', 'MINUS', 'MOD', 'NOT', 'NOTEQUAL', 'OR', 'PERIOD', 'PLUS', 'PROCEDURE', 'RETURN', 'RPARENS', 'SEMICOLON', 'SQUOTE', 'STRING', 'STRUCTURE', 'THEN', 'TO', 'WHILE'))
+_lexreflags   = 64
+_lexliterals  = ''
+_lexstateinfo = {'INITIAL': 'inclusive'}
+_lexstatere   = {'INITIAL': [("(?P<t_LCOMMENT>\\/\\*[^*]*\\*+(?:[^*\\/][^*]*\\*+)*\\/)|(?P<t_UNTERMINATED>\\/\\*[\\s\\S]*)|(?P<t_ASTERIX>\\*)|(?P<t_COMMA>,)|(?P<t_LPARENS>\\()|(?P<t_RPARENS>\\))|(?P<t_SEMICOLON>;)|(?P<t_STRING>'[^']*(?:''[^']*)*')|(?P<t_SQUOTE>'[\\s\\S]*)|(?P<t_AT>AT)|(?P<t_DATA>DATA)|(?P<t_ASSIGN>:=)|(?P<t_COLON>:)|(?P<t_NOTEQUAL><>)|(?P<t_LESSTHANEQUAL><=)|(?P<t_GREATERTHANEQUAL>>=)|(?P<t_EQUAL>=)|(?P<t_LESSTHAN><)|(?P<t_GREATERTHAN>>)|(?P<t_PLUS>\\+)|(?P<t_MINUS>\\-)|(?P<t_DIV>\\/)|(?P<t_PERIOD>\\.)|(?P<t_IDENT>[A-Za-z_][A-Za-z$\\d]*)|(?P<t_HEXNUMBER>[\\dA-Fa-f$]+[H|h])|(?P<t_BINNUMBER>[01$]+[B|b])|(?P<t_DECNUMBER>[\\d$]+)|(?P<t_newline>\\n+)", [None, ('t_LCOMMENT', 'LCOMMENT'), ('t_UNTERMINATED', 'UNTERMINATED'), ('t_ASTERIX', 'ASTERIX'), ('t_COMMA', 'COMMA'), ('t_LPARENS', 'LPARENS'), ('t_RPARENS', 'RPARENS'), ('t_SEMICOLON', 'SEMICOLON'), ('t_STRING', 'STRING'), ('t_SQUOTE', 'SQUOTE'), ('t_AT', 'AT'), ('t_DATA', 'DATA'), ('t_ASSIGN', 'ASSIGN'), ('t_COLON', 'COLON'), ('t_NOTEQUAL', 'NOTEQUAL'), ('t_LESSTHANEQUAL', 'LESSTHANEQUAL'), ('t_GREATERTHANEQUAL', 'GREATERTHANEQUAL'), ('t_EQUAL', 'EQUAL'), ('t_LESSTHAN', 'LESSTHAN'), ('t_GREATERTHAN', 'GREATERTHAN'), ('t_PLUS', 'PLUS'), ('t_MINUS', 'MINUS'), ('t_DIV', 'DIV'), ('t_PERIOD', 'PERIOD'), ('t_IDENT', 'IDENT'), ('t_HEXNUMBER', 'HEXNUMBER'), ('t_BINNUMBER', 'BINNUMBER'), ('t_DECNUMBER', 'DECNUMBER'), ('t_newline', 'newline')])]}
+_lexstateignore = {'INITIAL': ' \t\r'}
+_lexstateerrorf = {'INITIAL': 't_error'}
+_lexstateeoff = {}
+_lexsignature = '3a92de25e17a9ca3aa3848466eff7356'
@@ -1,8 +1,11 @@
 
+import re
 from copy import copy
+from io import StringIO
+from threading import RLock
 
-from ply import yacc
-from lexer import tokens, plmlexer
+from ply import lex, yacc
+from lexer import tokens, plmlexer, load_table, TABDIR, LOAD_TIME as LEXER_LOAD_TIME
 from compiler import *
 
 # globals
@@ -15,10 +18,11 @@ g_exec_state = False
 g_state_count = 0
 g_do_stack = []
 g_first_do = True
-g_case_flag = False
 g_case_list = []
 g_opt = False
 g_data_init = False
+g_case_check = False
+g_target = "8080"
 g_sym_list = []
 g_uni_list = []
 g_anon_list = []
@@ -27,59 +31,142 @@ g_proc_list = []
 g_proc_stack = []
 g_ret = False
 g_entry = None
+g_top_start = None
 g_flag_names = set(("ZERO", "CARRY", "SIGN", "PARITY"))
+g_symtab = SymbolTable()
+g_runtime = set()
+g_loop_ptrs = {}
+g_stats = None
+g_block_hits = []
+
+# longest DAD chain used for a multiply by a constant
+MUL_CHAIN_MAX = 8
+
+
+def init_state(opt, dataInit, entry, caseCheck = False, target = "8080"):
+    """Reset the compiler state for a new compilation"""
+    global g_pc, g_pc_save, g_code, g_fout, g_label_n, g_exec_state
+    global g_state_count, g_do_stack, g_first_do, g_case_list, g_target
+    global g_opt, g_data_init, g_case_check, g_sym_list, g_uni_list, g_anon_list
+    global g_pseudo_count, g_proc_list, g_proc_stack, g_ret, g_entry, g_symtab
+    global g_top_start, g_runtime, g_loop_ptrs, g_block_hits
+    g_pc = 0x0100
+    g_pc_save = g_pc
+    g_code = []
+    g_fout = None
+    g_label_n = 0
+    g_exec_state = False
+    g_state_count = 0
+    g_do_stack = []
+    g_first_do = True
+    g_case_list = []
+    g_opt = opt
+    g_data_init = dataInit
+    g_case_check = caseCheck
+    g_target = target
+    g_sym_list = []
+    g_uni_list = []
+    g_anon_list = []
+    g_pseudo_count = 0
+    g_proc_list = []
+    g_proc_stack = []
+    g_ret = False
+    g_entry = entry
+    g_top_start = None
+    g_symtab = SymbolTable()
+    g_runtime = set()
+    g_loop_ptrs = {}
+    g_block_hits = []
+    
+
+# the globals which hold the state of one compilation
+g_state_names = ("g_pc", "g_pc_save", "g_code", "g_fout", "g_label_n", "g_exec_state",
+                 "g_state_count", "g_do_stack", "g_first_do", "g_case_list", "g_target",
+                 "g_opt", "g_data_init", "g_case_check", "g_sym_list", "g_uni_list",
+                 "g_anon_list", "g_pseudo_count", "g_proc_list", "g_proc_stack", "g_ret",
+                 "g_entry", "g_top_start", "g_symtab", "g_runtime", "g_loop_ptrs",
+                 "g_block_hits", "g_stats")
+
+
+def save_state():
+    """Get the compiler state, including the log"""
+    g = globals()
+    state = dict((name, g[name]) for name in g_state_names)
+    state["log"] = log_state()
+    return state
+    
+    
+def load_state(state):
+    """Make a state from save_state the current compiler state"""
+    state = dict(state)
+    restore_log(state.pop("log"))
+    globals().update(state)
+    
 
 def lookup_sym(name):
     """Lookup symbol by name, with scope and precedence.
        Returns None if not found."""
-    global g_sym_list, g_proc_list, g_proc_stack, g_anon_list, g_uni_list
-        
-    # search for variable as local
-    # add current procedure name to enforce scope
-    for proc in reversed(g_proc_stack):
-        locname = "_%s_%s" % (proc, name)
-        for sym in g_sym_list:
-            if (locname == sym.name) and (not isinstance(sym, Label)):
-                return sym
-        for sym in g_uni_list:
-            if locname == sym.name:
-                return sym
-    
-    # search for variable as global
-    for sym in g_sym_list:
-        if (name == sym.name) and (not isinstance(sym, Label)):
-            return sym
-    for sym in g_uni_list:
-        if name == sym.name:
-            return sym
-            
-    # search procedure list
-    for sym in reversed(g_proc_list):
-        if name == sym.name:
-            return sym
-            
-    # seach the anonymous variables
-    for sym in g_anon_list:
-        if name == sym.name:
-            return sym
-            
-    # not found
-    return None
+    global g_symtab, g_proc_stack
+    return g_symtab.lookup(name, g_proc_stack)
+    
+    
+def add_sym(sym):
+    """Add an allocated data symbol to the output stream and symbol table"""
+    global g_sym_list, g_symtab
+    g_sym_list.append(sym)
+    g_symtab.add_alloc(sym)
+    
+    
+def add_uni(sym):
+    """Add an uninitialized data symbol to the symbol table"""
+    global g_uni_list, g_symtab
+    g_uni_list.append(sym)
+    g_symtab.add_uninit(sym)
+    
+    
+def add_proc(sym):
+    """Add a procedure to the symbol table"""
+    global g_proc_list, g_symtab
+    g_proc_list.append(sym)
+    g_symtab.add_proc(sym)
+    
+    
+def current_proc():
+    """Get the name of the procedure code is generated for"""
+    if len(g_proc_stack) > 0:
+        return g_proc_stack[-1]
+    return "(module)"
     
     
 def emit_code():
     """Commit the current block of compiled code to the symbol table.
        Each line is counted for tracking commited statements."""
-    global g_pc, g_pc_save, g_code, g_sym_list, g_state_count
+    global g_pc, g_pc_save, g_code, g_sym_list, g_state_count, g_block_hits
     if len(g_code) > 0:
-        optimize()
-        cdata = copy(g_code)
-        g_sym_list.append(CodeBlock(g_pc_save, g_pc - g_pc_save, cdata))
+        block = CodeBlock(g_pc_save, 0, None, current_proc())
+        if g_stats is None:
+            optimize()
+        else:
+            g_stats.measure("peephole", optimize)
+            block.hits = g_block_hits
+            g_block_hits = []
+        block.cdata = copy(g_code)
+        block.size = g_pc - g_pc_save
+        g_sym_list.append(block)
         g_code.clear()
         g_state_count += 1
     g_pc_save = g_pc
     
     
+def emit_instr(op, arg1 = None, arg2 = None, comment = None):
+    """Add an instruction to the current block of compiled code.
+       The current address is advanced by the instruction size."""
+    global g_pc, g_code
+    instr = Instr(op, arg1, arg2, comment)
+    g_code.append(instr)
+    g_pc += instr.size
+    
+    
 def emit_label(name):
     """Add a new label to the symbol table at the current address"""
     global g_pc, g_sym_list, g_state_count
@@ -125,8 +212,8 @@ def mark_statement():
 def emit_proc():
     """Output the current procedure code start label and the code necessary
        to save the input procedure args to variables."""
-    global g_pc, g_code, g_proc_stack, g_sym_list, g_state_count
-    global g_proc_list, g_entry
+    global g_pc, g_proc_stack, g_sym_list, g_state_count
+    global g_proc_list, g_entry, g_symtab
     
     # the first statement of the procedure has just been emmitted
     # rewind so that the procedure label and args code can be inserted
@@ -135,15 +222,12 @@ def emit_proc():
     #print("PROC:", procName, len(g_proc_stack))
     emit_label(procName)
     oldpc = g_pc
-    for proc in g_proc_list:
-        if proc.name == procName:
-            break
+    proc = g_symtab.procs[procName]
         
     # optional entry handling
     if proc.name == g_entry:
-        g_code.append("LXI H,__ENDCOM  ; exit address")
-        g_code.append("PUSH H")
-        g_pc += 4
+        emit_instr("LXI", "H", "__ENDCOM", comment="exit address")
+        emit_instr("PUSH", "H")
         
     if proc.num_args > 0:
     
@@ -152,13 +236,11 @@ def emit_proc():
         if arg is None:
             fatal("cannot find argument %s for procedure %s" % (argName, procName))
         if arg.size == 1:
-            g_code.append("LXI H,%s  ; store proc arg 1" % arg.name)
-            g_code.append("MOV M,E")
-            g_pc += 4
+            emit_instr("LXI", "H", arg.name, comment="store proc arg 1")
+            emit_instr("MOV", "M", "E")
         else:
-            g_code.append("XCHG")
-            g_code.append("SHLD %s  ; store proc arg 1" % arg.name)
-            g_pc += 4
+            emit_instr("XCHG")
+            emit_instr("SHLD", arg.name, comment="store proc arg 1")
             
         # generate code to save proc second arg - in (B),C
         if proc.num_args >= 2:
@@ -166,38 +248,32 @@ def emit_proc():
             if arg is None:
                 fatal("cannot find argument %s for procedure %s" % (argName, procName))
             if arg.size == 1:
-                g_code.append("LXI H,%s  ; store proc arg 2" % arg.name)
-                g_code.append("MOV M,C")
-                g_pc += 4
+                emit_instr("LXI", "H", arg.name, comment="store proc arg 2")
+                emit_instr("MOV", "M", "C")
             else:
-                g_code.append("MOV L,C")
-                g_code.append("MOV H,B")
-                g_code.append("SHLD %s  ; store proc arg 2" % arg.name)
-                g_pc += 5
+                emit_instr("MOV", "L", "C")
+                emit_instr("MOV", "H", "B")
+                emit_instr("SHLD", arg.name, comment="store proc arg 2")
                 
         # generate code to save proc third+ args - on stack at SP + 2 in reverse order
         if proc.num_args > 2:
-            g_code.append("LXI H,00002H  ; get ext args on stack")
-            g_code.append("DAD SP")
-            g_pc += 4
+            emit_instr("LXI", "H", "00002H", comment="get ext args on stack")
+            emit_instr("DAD", "SP")
             names = list(proc.arg_names[2:])
             names.reverse()
             for n in names:
                 arg = lookup_sym(n)
                 if arg is None:
                     fatal("cannot find argument %s for procedure %s" % (argName, procName))
-                g_code.append("MOV A,M  ; proc ext arg load")
-                g_code.append("STA %s  ; assign LSB" % arg.name)
-                g_pc += 4
+                emit_instr("MOV", "A", "M", comment="proc ext arg load")
+                emit_instr("STA", arg.name, comment="assign LSB")
                 if arg.size == 1:
                     if n != names[-1]:
-                        g_code.append("INX H  ; skip to next arg")
-                        g_pc += 1
+                        emit_instr("INX", "H", comment="skip to next arg")
                 else:
-                    g_code.append("INX H")
-                    g_code.append("MOV A,M")
-                    g_code.append("STA %s+1  ; assign MSB" % arg.name)
-                    g_pc += 5
+                    emit_instr("INX", "H")
+                    emit_instr("MOV", "A", "M")
+                    emit_instr("STA", "%s+1" % arg.name, comment="assign MSB")
     emit_code()
     
     # restore the first statement of the procedure
@@ -226,28 +302,20 @@ def p_statement(p):
 def p_code_statement(p):
     r'''code_statement : control_statement
                        | exec_statement'''
-    global g_exec_state, g_proc_stack, g_case_flag, g_code, g_pc
-    global g_case_list, g_sym_list, g_state_count
+    global g_exec_state, g_proc_stack, g_top_start
     if not g_exec_state:
         g_exec_state = True
         if len(g_proc_stack) > 0:
             emit_proc()
-    if g_case_flag:
-        cl = g_case_list[-1]
-        if cl[1]:
-            cl[1] = False
-        else:
-            label = new_label()
-            es = pop_statement()
-            cl[2].append(label)
-            emit_label(label)
-            for sym in es:
-                if isinstance(sym, CodeBlock):
-                    g_pc += sym.size
-                g_sym_list.append(sym)
-                g_state_count += 1
-            g_code.append("JMP %s  ; end CASE" % cl[2][0])
-            g_pc += 3
+        elif g_top_start is None:
+            # the first top level statement, later statements only
+            # rewind the symbol table back to their own start
+            emit_code()
+            g_top_start = len(g_sym_list) - g_state_count
+    # statements of an IF or ELSE are not cases of their own
+    case = current_case(len(g_do_stack))
+    if (case is not None) and (p.stack[-1].type not in ("THEN", "ELSE")):
+        case.next_statement()
     p[0] = p[1]
                   
                   
@@ -276,7 +344,7 @@ def p_label_statement(p):
     if lookup_sym(p[1]) is not None:
         fatal("name %s already defined, line %d" % (p[1], p.lineno(1)))
     emit_label(p[1])
-    print("declare label:", g_sym_list[-1])
+    log(INFO, "declare", "declare label: %s", g_sym_list[-1])
     
    
 def p_declare_statement(p):
@@ -318,7 +386,7 @@ def p_declare_name(p):
     
 def p_declare_literal(p):
     r'''declare_literal : IDENT LITERALLY STRING'''
-    print("declare literal: %s = \'%s\'" % (p[1], p[3]))
+    log(INFO, "declare", "declare literal: %s = \'%s\'", p[1], p[3])
     
     
 def p_variable_type(p):
@@ -330,12 +398,11 @@ def p_variable_type(p):
 def check_args(name, size):
     """Check the current procedure to see if this variable is a argument.
        If so, record argument variable size."""
-    global g_proc_stack, g_proc_list
-    for proc in g_proc_list:
-        if proc.name == g_proc_stack[-1]:
-            for n in range(proc.num_args):
-                if proc.arg_names[n] == name:
-                    proc.arg_widths[n] = size
+    global g_proc_stack, g_symtab
+    proc = g_symtab.procs[g_proc_stack[-1]]
+    for n in range(proc.num_args):
+        if proc.arg_names[n] == name:
+            proc.arg_widths[n] = size
                     
     
 def p_declare_variable(p):
@@ -356,8 +423,8 @@ def p_declare_variable(p):
         proc = lookup_sym(g_proc_stack[-1])
         if isinstance(proc, ExternalProcedure):
             return
-    g_uni_list.append(Variable(name, 0, size, None))
-    print("declare variable:", g_uni_list[-1])
+    add_uni(Variable(name, 0, size, None))
+    log(INFO, "declare", "declare variable: %s", g_uni_list[-1])
     
     
 def p_declare_variable_list(p):
@@ -371,8 +438,8 @@ def p_declare_variable_list(p):
         if len(g_proc_stack) > 0:
             check_args(name, size)
             name = "_%s_%s" % (g_proc_stack[-1], name)
-        g_uni_list.append(Variable(name, 0, size, None))
-        print("declare variable", g_uni_list[-1])
+        add_uni(Variable(name, 0, size, None))
+        log(INFO, "declare", "declare variable: %s", g_uni_list[-1])
     
     
 def p_vars_list(p):
@@ -406,9 +473,16 @@ def p_declare_variable_init(p):
         size = 1
     else:
         size = 2
-    g_sym_list.append(Variable(name, g_pc, size, p[5]))
+    add_sym(Variable(name, g_pc, size, p[5]))
     g_pc += size
-    print("declare variable:", g_sym_list[-1])
+    log(INFO, "declare", "declare variable: %s", g_sym_list[-1])
+    
+    
+def at_address(addr):
+    """Get the address of an AT declaration, AT (.X) is at the label X"""
+    if isinstance(addr, Reference):
+        return addr.name
+    return addr
     
     
 def p_declare_variable_at(p):
@@ -426,7 +500,7 @@ def p_declare_variable_at(p):
     else:
         size = 2
     if len(p) == 7:
-        ref = p[5]
+        ref = at_address(p[5])
         idx = 0
     else:
         sym = lookup_sym(p[6])
@@ -436,8 +510,8 @@ def p_declare_variable_at(p):
             warning("AT target %s width different than variable, line %d" % (p[6], p.lineno(6)))
         idx = p[8] * sym.elem_size
         ref = sym.name
-    g_sym_list.append(AtVariable(name, ref, size, idx))
-    print("declare variable:", g_sym_list[-1])
+    add_sym(AtVariable(name, ref, size, idx))
+    log(INFO, "declare", "declare variable: %s", g_sym_list[-1])
     
     
 def p_declare_variable_based(p):
@@ -459,8 +533,8 @@ def p_declare_variable_based(p):
         fatal("target variable %s does not exist, line %d" % (p[3], p.lineno(3)))
     if (not isinstance(sym, Variable)) or isinstance(sym, Array) or (sym.size != 2):
         fatal("target variable %s not ADDRESS, line %d" % (p[3], p.lineno(3)))
-    g_sym_list.append(BasedVariable(name, sym.name, size, None))
-    print("declare variable:", g_sym_list[-1])
+    add_sym(BasedVariable(name, sym.name, size, None))
+    log(INFO, "declare", "declare variable: %s", g_sym_list[-1])
     
     
 def p_declare_variable_ext(p):
@@ -473,8 +547,8 @@ def p_declare_variable_ext(p):
         size = 1
     else:
         size = 2
-    g_sym_list.append(AtVariable(name, name, size, None))
-    print("declare variable:", g_sym_list[-1])
+    add_sym(AtVariable(name, name, size, None))
+    log(INFO, "declare", "declare variable: %s", g_sym_list[-1])
 
 def p_init_data(p):
     r'''init_data : number
@@ -498,8 +572,8 @@ def p_declare_array(p):
     else:
         elementSize = 2
     size = p[3] * elementSize
-    g_uni_list.append(Array(name, 0, size, None, elementSize))
-    print("declare array:", g_uni_list[-1])
+    add_uni(Array(name, 0, size, None, elementSize))
+    log(INFO, "declare", "declare array: %s", g_uni_list[-1])
     
     
 def p_declare_array_init1(p):
@@ -519,9 +593,9 @@ def p_declare_array_init1(p):
     else:
         elementSize = 2
     size = len(p[3]) * elementSize
-    g_sym_list.append(Array(name, g_pc, size, p[3], elementSize))
+    add_sym(Array(name, g_pc, size, p[3], elementSize))
     g_pc += size
-    print("declare array:", g_sym_list[-1])
+    log(INFO, "declare", "declare array: %s", g_sym_list[-1])
     
     
 def p_declare_array_init2(p):
@@ -541,9 +615,9 @@ def p_declare_array_init2(p):
     else:
         elementSize = 2
     size = p[3] * elementSize
-    g_sym_list.append(Array(name, g_pc, size, p[8], elementSize))
+    add_sym(Array(name, g_pc, size, p[8], elementSize))
     g_pc += size
-    print("declare array:", g_sym_list[-1])
+    log(INFO, "declare", "declare array: %s", g_sym_list[-1])
     
     
 def p_array_init_list(p):
@@ -604,9 +678,9 @@ def p_declare_string(p):
                 data.append(d)
                 size += elementSize
             
-    g_sym_list.append(Array(name, g_pc, size, data, elementSize))
+    add_sym(Array(name, g_pc, size, data, elementSize))
     g_pc += size
-    print("declare string:", g_sym_list[-1])
+    log(INFO, "declare", "declare string: %s", g_sym_list[-1])
    
    
 def p_declare_array_at(p):
@@ -623,8 +697,8 @@ def p_declare_array_at(p):
     else:
         elementSize = 2
     size = p[3] * elementSize
-    g_sym_list.append(AtArray(name, p[8], size, None, elementSize))
-    print("declare array:", g_sym_list[-1])
+    add_sym(AtArray(name, at_address(p[8]), size, None, elementSize))
+    log(INFO, "declare", "declare array: %s", g_sym_list[-1])
     
     
 def p_declare_array_based(p):
@@ -646,8 +720,8 @@ def p_declare_array_based(p):
         fatal("target variable %s does not exist, line %d" % (p[3], p.lineno(3)))
     if (not isinstance(sym, Variable)) or isinstance(sym, Array) or (sym.size != 2):
         fatal("target variable %s not ADDRESS, line %d" % (p[3], p.lineno(3)))
-    g_sym_list.append(BasedArray(name, sym.name, size, None, elementSize))
-    print("declare array:", g_sym_list[-1])
+    add_sym(BasedArray(name, sym.name, size, None, elementSize))
+    log(INFO, "declare", "declare array: %s", g_sym_list[-1])
     
     
 def p_declare_array_ext(p):
@@ -661,8 +735,8 @@ def p_declare_array_ext(p):
     else:
         elementSize = 2
     size = p[3] * elementSize
-    g_sym_list.append(AtArray(name, name, size, None, elementSize))
-    print("declare array:", g_sym_list[-1])
+    add_sym(AtArray(name, name, size, None, elementSize))
+    log(INFO, "declare", "declare array: %s", g_sym_list[-1])
     
     
 def p_declare_struct_based(p):
@@ -683,8 +757,8 @@ def p_declare_struct_based(p):
             size = 2
         smap[item[0]] = (offset, size)
         offset += size
-    g_sym_list.append(BasedStruct(name, p[3], offset, smap))
-    print("declare struct:", g_sym_list[-1])
+    add_sym(BasedStruct(name, p[3], offset, smap))
+    log(INFO, "declare", "declare struct: %s", g_sym_list[-1])
     
 def p_struct_list(p):
     r'''struct_list : struct_list1 IDENT variable_type
@@ -726,17 +800,17 @@ def p_procedure_arg0(p):
         size = 1
     else:
         size = 2
-    g_proc_list.append(UserProcedure(p[1], 0, size))
+    add_proc(UserProcedure(p[1], 0, size))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg0_noret(p):
     r'''procedure_arg0_noret : IDENT COLON PROCEDURE SEMICOLON'''
     global g_proc_list, g_proc_stack
-    g_proc_list.append(UserProcedure(p[1], 0, 0))
+    add_proc(UserProcedure(p[1], 0, 0))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg1(p):
@@ -746,17 +820,17 @@ def p_procedure_arg1(p):
         size = 1
     else:
         size = 2
-    g_proc_list.append(UserProcedure(p[1], 1, size, (p[5],)))
+    add_proc(UserProcedure(p[1], 1, size, (p[5],)))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg1_noret(p):
     r'''procedure_arg1_noret : IDENT COLON PROCEDURE LPARENS IDENT RPARENS SEMICOLON'''
     global g_proc_list, g_proc_stack
-    g_proc_list.append(UserProcedure(p[1], 1, 0, (p[5],)))
+    add_proc(UserProcedure(p[1], 1, 0, (p[5],)))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg2(p):
@@ -766,17 +840,17 @@ def p_procedure_arg2(p):
         size = 1
     else:
         size = 2
-    g_proc_list.append(UserProcedure(p[1], 2, size, (p[5],p[7])))
+    add_proc(UserProcedure(p[1], 2, size, (p[5],p[7])))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg2_noret(p):
     r'''procedure_arg2_noret : IDENT COLON PROCEDURE LPARENS IDENT COMMA IDENT RPARENS SEMICOLON'''
     global g_proc_list, g_proc_stack
-    g_proc_list.append(UserProcedure(p[1], 2, 0, (p[5],p[7])))
+    add_proc(UserProcedure(p[1], 2, 0, (p[5],p[7])))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg2_ext(p):
@@ -786,17 +860,17 @@ def p_procedure_arg2_ext(p):
         size = 1
     else:
         size = 2
-    g_proc_list.append(ExternalProcedure(p[1], 2, size, (p[5],p[7])))
+    add_proc(ExternalProcedure(p[1], 2, size, (p[5],p[7])))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg2_noret_ext(p):
     r'''procedure_arg2_noret_ext : IDENT COLON PROCEDURE LPARENS IDENT COMMA IDENT RPARENS EXTERNAL SEMICOLON'''
     global g_proc_list, g_proc_stack
-    g_proc_list.append(ExternalProcedure(p[1], 2, 0, (p[5],p[7])))
+    add_proc(ExternalProcedure(p[1], 2, 0, (p[5],p[7])))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg3(p):
@@ -806,16 +880,16 @@ def p_procedure_arg3(p):
         size = 1
     else:
         size = 2
-    g_proc_list.append(UserProcedure(p[1], 3, size, (p[5],p[7],p[9])))
+    add_proc(UserProcedure(p[1], 3, size, (p[5],p[7],p[9])))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_procedure_arg3_noret(p):
     r'''procedure_arg3_noret : IDENT COLON PROCEDURE LPARENS IDENT COMMA IDENT COMMA IDENT RPARENS SEMICOLON'''
-    g_proc_list.append(UserProcedure(p[1], 3, 0, (p[5],p[7],p[9])))
+    add_proc(UserProcedure(p[1], 3, 0, (p[5],p[7],p[9])))
     g_proc_stack.append(p[1])
-    print("declare procedure", g_proc_list[-1])
+    log(INFO, "declare", "declare procedure: %s", g_proc_list[-1])
     
     
 def p_do_statement(p):
@@ -838,52 +912,517 @@ def p_cond_expr(p):
         
 def p_do_while_statement(p):
     r'''do_while_statement : DO WHILE cond_expr SEMICOLON'''
-    global g_pc, g_code, g_do_stack, g_sym_list
+    global g_do_stack, g_sym_list
     #print("DOWHILE:", p[3])
     mark_statement()
     label1 = new_label()
     label2 = new_label()
     emit_label(label1)
-    collapse_left(p[3])
-    g_code.append("XRA A  ; A = 0")
-    g_code.append("CMP E  ; rel result")
-    g_code.append("JZ %s  ; skip while" % label2)
-    g_pc += 5
+    collapse_branch(p[3], label2, False)
     g_do_stack.append((label2, label1))
     p[0] = 0
     
     
 def p_do_case_statement(p):
     r'''do_case_statement : DO CASE expr SEMICOLON'''
-    global g_pc, g_code, g_do_stack, g_case_flag, g_case_list
-    print("DOCASE:", p[3])
+    global g_do_stack, g_case_list, g_sym_list, g_state_count
+    log(DEBUG, "parse", "DOCASE: %s", p[3])
     mark_statement()
-    label1 = new_label()
-    label2 = new_label()
     width = collapse_left(p[3])
-    if width == 1:
-        g_code.append("MVI D,000H  ; zero pad CASE MSB")
-        g_pc += 2
-    g_code.append("LXI H,%s  ; CASE table" % label1)
-    g_code.append("XCHG")
-    g_code.append("DAD H  ; index << 1")
-    g_code.append("DAD D  ; CASE table offset")
-    g_code.append("MOV E,M")
-    g_code.append("INX H")
-    g_code.append("MOV D,M")
-    g_code.append("XCHG")
-    g_code.append("PCHL  ; go to CASE")
-    g_pc += 12
-    g_do_stack.append((label2,))
-    g_case_flag = True
-    g_case_list.append([label1, True, [label2]])
+    emit_code()
+    # the dispatch code is filled in by END once the cases are known
+    block = CodeBlock(g_pc, 0, [], current_proc())
+    g_sym_list.append(block)
+    g_state_count += 1
+    case = DoCase(new_label(), new_label(), width, block)
+    emit_label(case.labels[0])
+    g_do_stack.append((case.end, None, case))
+    g_case_list.append(case)
     p[0] = 0;
     
     
+def current_case(depth):
+    """Get the DO CASE whose statements are at the given DO nesting
+       depth, or None"""
+    global g_do_stack
+    if depth > 0:
+        labels = g_do_stack[depth - 1]
+        if (labels is not None) and (len(labels) > 2) and isinstance(labels[2], DoCase):
+            return labels[2]
+    return None
+    
+    
+class DoCase(object):
+    """A DO CASE statement.  Each statement of the CASE is labeled and
+       jumps to the end of the CASE, the last one falls through.  The
+       dispatch is chosen at END when the number of cases and their
+       size are known: up to three cases use a compare chain, more use
+       a table of byte offsets from the first case if they all fit in
+       255 bytes, otherwise a table of addresses.  With g_case_check a
+       selector out of range skips the CASE."""
+       
+    def __init__(self, table, end, width, block):
+        self.table = table
+        self.end = end
+        self.width = width
+        self.block = block
+        self.labels = [new_label()]
+        self.count = 0
+        self.opened = False
+        self.kind = None
+        
+    def __repr__(self):
+        return "DoCase(%s,%d)" % (self.table, self.count)
+        
+    def next_statement(self):
+        """Close the case ended by the statement just compiled and
+           label the next one"""
+        if not self.opened:
+            # the DO CASE statement itself
+            self.opened = True
+            return
+        emit_code()
+        emit_instr("JMP", self.end, comment="end CASE")
+        label = new_label()
+        self.labels.append(label)
+        emit_label(label)
+        self.count += 1
+        
+    def reopen(self):
+        """Continue the last case, an ELSE is part of the same statement"""
+        global g_pc, g_pc_save, g_sym_list
+        if self.count == 0:
+            return
+        g_sym_list.pop()
+        block = g_sym_list.pop()
+        g_pc -= block.size
+        g_pc_save = g_pc
+        self.labels.pop()
+        self.count -= 1
+        
+    def span(self):
+        """Get the size of the code from the first to the last case"""
+        global g_sym_list
+        size = 0
+        n = g_sym_list.index(self.block) + 1
+        while True:
+            sym = g_sym_list[n]
+            if isinstance(sym, Label) and (sym.name == self.labels[-1]):
+                return size
+            if isinstance(sym, CodeBlock):
+                size += sum(instr.size for instr in sym.cdata)
+            n += 1
+        
+    def emit_end(self, label):
+        """Fill in the dispatch code"""
+        global g_pc, g_case_check
+        num = self.count
+        self.reopen()
+        self.count = num
+        code = []
+        loaded = False
+        if g_case_check:
+            if self.width == 2:
+                code.append(Instr("MOV", "A", "D"))
+                code.append(Instr("ORA", "A"))
+                code.append(Instr("JNZ", self.end, comment="CASE out of range"))
+            if num < 0x100:
+                code.append(Instr("MOV", "A", "E"))
+                code.append(Instr("CPI", "%03XH" % num))
+                code.append(Instr("JNC", self.end, comment="CASE out of range"))
+                loaded = True
+        if (num > 1) and (num <= 3):
+            if not loaded:
+                code.append(Instr("MOV", "A", "E", comment="CASE compare"))
+            for n in range(1, num):
+                code.append(Instr("DCR", "A"))
+                code.append(Instr("JZ", self.labels[n], comment="CASE %d" % n))
+        elif num > 3:
+            if self.width == 1:
+                code.append(Instr("MVI", "D", "000H", comment="zero pad CASE MSB"))
+            code.append(Instr("LXI", "H", self.table, comment="CASE table"))
+            code.append(Instr("DAD", "D"))
+            if self.span() < 0x100:
+                self.kind = "DB"
+                code.append(Instr("MOV", "E", "M", comment="CASE offset"))
+                code.append(Instr("MVI", "D", "000H"))
+                code.append(Instr("LXI", "H", self.labels[0]))
+                code.append(Instr("DAD", "D"))
+            else:
+                self.kind = "DW"
+                code.append(Instr("DAD", "D", comment="index << 1"))
+                code.append(Instr("MOV", "A", "M"))
+                code.append(Instr("INX", "H"))
+                code.append(Instr("MOV", "H", "M"))
+                code.append(Instr("MOV", "L", "A"))
+            code.append(Instr("PCHL", comment="go to CASE"))
+        self.block.cdata = code
+        self.block.size = sum(instr.size for instr in code)
+        g_pc += self.block.size
+        
+    def table_data(self):
+        """Get the CASE table entries"""
+        if self.kind == "DB":
+            return ["%s-%s" % (l, self.labels[0]) for l in self.labels]
+        return self.labels
+        
+        
+def scan_do_body(p):
+    """Get the tokens of the body of the DO statement being reduced by
+       scanning ahead of the parser to the matching END.  Returns None if
+       there is no matching END."""
+    lexer = p.lexer.clone()
+    lexer.begin('INITIAL')
+    lexer.lexpos = p.lexpos(len(p) - 1) + 1
+    toks = []
+    depth = 1
+    try:
+        for tok in iter(lexer.token, None):
+            if tok.type == 'DO':
+                depth += 1
+            elif tok.type == 'END':
+                depth -= 1
+                if depth == 0:
+                    return toks
+            toks.append(tok)
+    except lex.LexError:
+        pass
+    return None
+    
+    
+def scan_do_uses(name, toks):
+    """Find how a DO variable is used in the tokens of the loop body.
+       Returns (arrays, other, leave): the arrays subscripted by just the
+       variable, once for each subscript, True if the variable is used
+       any other way, and True if the body can leave the loop early.
+       Returns None if the body may change the variable."""
+    arrays = []
+    other = False
+    leave = False
+    for n in range(len(toks)):
+        tok = toks[n]
+        if tok.type in ('CALL', 'COLON'):
+            return None
+        if tok.type in ('GO', 'RETURN'):
+            leave = True
+        if tok.type != 'IDENT':
+            continue
+        if isinstance(lookup_sym(tok.value), UserProcedure):
+            return None
+        if tok.value != name:
+            continue
+        prev = toks[n - 1].type if n > 0 else 'SEMICOLON'
+        next = toks[n + 1].type if (n + 1) < len(toks) else 'SEMICOLON'
+        if (prev == 'PERIOD') or (next == 'ASSIGN'):
+            return None
+        if (next in ('EQUAL', 'COMMA')) and (prev in ('SEMICOLON', 'THEN', 'ELSE', 'COMMA', 'DO')):
+            return None
+        if (prev == 'LPARENS') and (next == 'RPARENS') and (n >= 2) and (toks[n - 2].type == 'IDENT'):
+            array = lookup_sym(toks[n - 2].value)
+            ref = (n >= 3) and (toks[n - 3].type == 'PERIOD')
+            member = ((n + 2) < len(toks)) and (toks[n + 2].type == 'PERIOD')
+            if isinstance(array, Array) and not (isinstance(array, BasedArray) or ref or member):
+                arrays.append(array)
+                continue
+        other = True
+    return (arrays, other, leave)
+    
+    
+g_bc_ops = set(("CALL", "CZ", "CNZ", "CC", "CNC", "RST", "LDIR", "DJNZ"))
+g_bc_read_ops = set(("DAD", "DSBC", "LDAX", "STAX"))
+
+
+def keeps_bc(code):
+    """Test that a list of symbols has no code which changes B or C,
+       a call is taken to change them"""
+    for sym in code:
+        if isinstance(sym, CodeBlock):
+            if not keeps_bc(sym.cdata):
+                return False
+        elif not isinstance(sym, Instr):
+            continue
+        elif sym.op in g_bc_ops:
+            return False
+        elif (sym.arg1 in ("B", "C")) and not ((sym.op in g_alu_ops) or
+                                               (sym.op in g_nop_ops) or
+                                               (sym.op in g_bc_read_ops)):
+            return False
+    return True
+    
+    
+class DoLoop(object):
+    """A strength-reduced DO loop with constant bounds whose body does not
+       change the loop variable.  The variable stays in memory, updated
+       once per iteration and compared for equality with the first value
+       past the end.  If the body does not read it, the variable is used
+       as a down counter instead.  A BYTE count is held in B when the
+       body leaves B and C alone, otherwise in memory as saving B costs
+       more than DCR M.  An ADDRESS count is held in B,C and pushed
+       around a body which changes them.  Arrays subscripted by the
+       variable are reached through pointers stepped with it."""
+       
+    def __init__(self, sym, start, last, step, arrays, counter):
+        self.sym = sym
+        self.start = start
+        self.last = last
+        self.step = step
+        self.count = ((last - start) // step) + 1
+        self.counter = counter
+        self.ptrs = []
+        for array in arrays:
+            self.ptrs.append((new_label(), array))
+            
+    def __repr__(self):
+        return "DoLoop(%s,%d,%d,%d)" % (self.sym.name, self.start, self.last, self.step)
+        
+    def load(self, value):
+        """Store a value in the loop variable"""
+        if self.sym.size == 1:
+            emit_instr("MVI", "A", "%03XH" % value)
+            emit_instr("STA", self.sym.name, comment="DO assign")
+        else:
+            emit_instr("LXI", "H", "%05XH" % value)
+            emit_instr("SHLD", self.sym.name, comment="DO assign")
+        
+    def emit_start(self, label):
+        """Emit the code before the loop body, label is the loop top"""
+        global g_loop_ptrs, g_uni_list, g_sym_list, g_state_count
+        for (ptr, array) in self.ptrs:
+            addr = element_address(array, self.start)
+            emit_instr("LXI", "H", addr, comment="DO pointer")
+            emit_instr("SHLD", ptr)
+            add_uni(Variable(ptr, 0, 2, None))
+            g_loop_ptrs[(array.name, self.sym.name)] = ptr
+        if not self.counter:
+            self.load(self.start)
+            emit_label(label)
+            return
+        # the count is loaded by END once the body is known, an ADDRESS
+        # count may also need to be saved at the top of the loop
+        emit_code()
+        self.block = CodeBlock(g_pc, 0, [], current_proc())
+        g_sym_list.append(self.block)
+        g_state_count += 1
+        emit_label(label)
+        if self.count > 0x100:
+            self.top = CodeBlock(g_pc, 0, [], current_proc())
+            g_sym_list.append(self.top)
+            g_state_count += 1
+        
+    def emit_count(self, inreg):
+        """Fill in the code which loads the counter, in B or B,C unless
+           inreg is False, and decide if it is saved around the body"""
+        global g_pc, g_sym_list
+        count = self.count
+        if inreg and (count <= 0x100):
+            code = [Instr("MVI", "B", "%03XH" % (count & 0xff), comment="DO count")]
+        elif count > 0x100:
+            code = [Instr("LXI", "B", "%05XH" % count, comment="DO count")]
+        else:
+            code = [Instr("MVI", "A", "%03XH" % (count & 0xff)),
+                    Instr("STA", self.sym.name, comment="DO count")]
+        self.block.cdata = code
+        self.block.size = sum(instr.size for instr in code)
+        g_pc += self.block.size
+        if count <= 0x100:
+            return
+        if inreg:
+            g_sym_list.remove(self.top)
+        else:
+            self.top.cdata = [Instr("PUSH", "B", comment="save DO count")]
+            self.top.size = self.top.cdata[0].size
+            g_pc += self.top.size
+        
+    def emit_end(self, label):
+        """Emit the code after the loop body, label is the loop top"""
+        global g_loop_ptrs, g_sym_list, g_code
+        inreg = False
+        if self.counter:
+            n = g_sym_list.index(self.block) + 1
+            inreg = keeps_bc(g_sym_list[n:]) and keeps_bc(g_code)
+            self.emit_count(inreg)
+        for (ptr, array) in self.ptrs:
+            step = self.step * array.elem_size
+            emit_instr("LHLD", ptr)
+            if step <= 3:
+                for n in range(step):
+                    emit_instr("INX", "H")
+            else:
+                emit_instr("LXI", "D", "%05XH" % step)
+                emit_instr("DAD", "D")
+            emit_instr("SHLD", ptr, comment="DO pointer update")
+            del g_loop_ptrs[(array.name, self.sym.name)]
+        name = self.sym.name
+        end = self.last + self.step
+        if inreg and (self.count <= 0x100):
+            emit_instr("DCR", "B", comment="DO count")
+            emit_instr("JNZ", label)
+        elif self.counter and (self.count <= 0x100):
+            emit_instr("LXI", "H", name)
+            emit_instr("DCR", "M", comment="DO count")
+            emit_instr("JNZ", label)
+        elif self.counter:
+            if not inreg:
+                emit_instr("POP", "B", comment="restore DO count")
+            emit_instr("DCX", "B", comment="DO count")
+            emit_instr("MOV", "A", "B")
+            emit_instr("ORA", "C")
+            emit_instr("JNZ", label)
+        elif self.sym.size == 1:
+            emit_instr("LDA", name, comment="DO load")
+            if self.step == 1:
+                emit_instr("INR", "A", comment="DO update")
+            else:
+                emit_instr("ADI", "%03XH" % self.step, comment="DO update")
+            emit_instr("STA", name, comment="DO assign")
+            emit_instr("CPI", "%03XH" % end, comment="DO end")
+            emit_instr("JNZ", label)
+        else:
+            emit_instr("LHLD", name, comment="DO load")
+            if self.step == 1:
+                emit_instr("INX", "H", comment="DO update")
+            else:
+                emit_instr("LXI", "D", "%05XH" % self.step)
+                emit_instr("DAD", "D", comment="DO update")
+            emit_instr("SHLD", name, comment="DO assign")
+            emit_instr("MOV", "A", "L")
+            emit_instr("CPI", "%03XH" % (end & 0xff), comment="DO end")
+            emit_instr("JNZ", label)
+            if end > 0xff:
+                emit_instr("MOV", "A", "H")
+                emit_instr("CPI", "%03XH" % (end >> 8))
+                emit_instr("JNZ", label)
+        self.load(self.last)
+        
+        
+class BlockMove(DoLoop):
+    """A DO loop with constant bounds on the Z80 whose body only copies
+       one array to another element by element, or fills a BYTE array
+       with a constant.  The loop is a single LDIR, the code compiled for
+       the body is discarded at the END."""
+    
+    def __init__(self, sym, start, last, dest, source):
+        DoLoop.__init__(self, sym, start, last, 1, [], False)
+        self.dest = dest
+        self.source = source
+        
+    def __repr__(self):
+        return "BlockMove(%s,%d,%d)" % (self.sym.name, self.start, self.last)
+        
+    def emit_start(self, label):
+        """Emit the block move, the body which follows is not used"""
+        global g_sym_list
+        dest = element_address(self.dest, self.start)
+        if isinstance(self.source, int):
+            emit_instr("LXI", "H", dest, comment="DO fill")
+            emit_instr("MVI", "M", "%03XH" % self.source)
+            if self.count > 1:
+                emit_instr("LXI", "D", element_address(self.dest, self.start + 1))
+                emit_instr("LXI", "B", "%05XH" % (self.count - 1))
+                emit_instr("LDIR")
+        else:
+            emit_instr("LXI", "H", element_address(self.source, self.start), comment="DO copy")
+            emit_instr("LXI", "D", dest)
+            emit_instr("LXI", "B", "%05XH" % (self.count * self.dest.elem_size))
+            emit_instr("LDIR")
+        self.load(self.last)
+        emit_code()
+        self.block = g_sym_list[-1]
+        
+    def emit_end(self, label):
+        """Discard the code of the loop body"""
+        global g_sym_list, g_pc, g_pc_save
+        while g_sym_list[-1] is not self.block:
+            sym = g_sym_list.pop()
+            if isinstance(sym, CodeBlock):
+                g_pc -= sym.size
+        g_pc_save = g_pc
+        
+        
+def element_address(array, index):
+    """Get the address operand of a constant array element"""
+    offset = index * array.elem_size
+    if isinstance(array, AtArray) and isinstance(array.addr, int):
+        return "%05XH" % (array.addr + offset)
+    addr = array.addr if isinstance(array, AtArray) else array.name
+    if offset > 0:
+        addr += " + %05XH" % offset
+    return addr
+    
+    
+def block_move(name, sym, start, last, toks):
+    """Get a BlockMove for a DO loop whose body is just A(I) = B(I) or
+       A(I) = constant, otherwise None"""
+    types = [tok.type for tok in toks]
+    if types[:5] != ['IDENT', 'LPARENS', 'IDENT', 'RPARENS', 'EQUAL']:
+        return None
+    dest = lookup_sym(toks[0].value)
+    if (toks[2].value != name) or not isinstance(dest, Array) or isinstance(dest, BasedArray):
+        return None
+    if types[5:] == ['IDENT', 'LPARENS', 'IDENT', 'RPARENS', 'SEMICOLON']:
+        source = lookup_sym(toks[5].value)
+        if (toks[7].value != name) or not isinstance(source, Array) or \
+           isinstance(source, BasedArray) or (source.elem_size != dest.elem_size):
+            return None
+    elif (types[5:] in (['DECNUMBER', 'SEMICOLON'], ['HEXNUMBER', 'SEMICOLON'],
+                        ['BINNUMBER', 'SEMICOLON'])) and (dest.elem_size == 1):
+        source = toks[5].value
+        if source > 0xff:
+            return None
+    else:
+        return None
+    if (last - start + 1) * dest.elem_size > 0xffff:
+        return None
+    # a word copy between overlapping arrays is not a byte copy
+    if (dest.elem_size == 2) and (isinstance(dest, AtArray) or isinstance(source, AtArray)):
+        return None
+    return BlockMove(sym, start, last, dest, source)
+    
+    
+def do_loop(p, sym):
+    """Get a DoLoop for a DO statement if it can be strength-reduced,
+       otherwise None"""
+    if len(p) == 10:
+        step = p[8]
+    else:
+        step = 1
+    (start, end) = (p[4], p[6])
+    if not (isinstance(start, int) and isinstance(end, int) and isinstance(step, int)):
+        return None
+    if (step <= 0) or (start > end) or (const_width(end) > sym.size):
+        return None
+    last = start + (((end - start) // step) * step)
+    if (last + step) > ((1 << (8 * sym.size)) - 1):
+        return None
+    if (sym.name not in plain_names()) or isinstance(sym, Struct):
+        return None
+    if re.search(r'\.\s*%s\b' % re.escape(p[2]), p.lexer.lexdata, re.IGNORECASE):
+        return None
+    toks = scan_do_body(p)
+    if toks is None:
+        return None
+    if (g_target == "z80") and (step == 1):
+        move = block_move(p[2], sym, start, last, toks)
+        if move is not None:
+            return move
+    uses = scan_do_uses(p[2], toks)
+    if uses is None:
+        return None
+    (arrays, other, leave) = uses
+    # a pointer only pays for its update when used more than once
+    ptrs = []
+    for array in arrays:
+        if arrays.count(array) < 2:
+            other = True
+        elif array not in ptrs:
+            ptrs.append(array)
+    return DoLoop(sym, start, last, step, ptrs, not (other or leave))
+    
+    
 def p_do_to_statement(p):
     r'''do_to_statement : DO IDENT EQUAL expr TO expr SEMICOLON
                         | DO IDENT EQUAL expr TO expr BY expr SEMICOLON'''
-    global g_pc, g_code, g_do_stack
+    global g_do_stack
     #print("DOTO: %s %s %s" % (p[2], p[4], p[6]))
     if not isinstance(p[2], int):
         sym = lookup_sym(p[2])
@@ -894,21 +1433,23 @@ def p_do_to_statement(p):
     mark_statement()
     label1 = new_label()
     label2 = new_label()
+    loop = do_loop(p, sym)
+    if loop is not None:
+        loop.emit_start(label1)
+        g_do_stack.append((label2, label1, loop))
+        p[0] = 0
+        return
     label3 = new_label()
     toWidth = collapse_left(p[4])
     if toWidth > sym.size:
         fatal("DO variable %s overflow, line %d" % (p[2], p.lineno(1)))
     if sym.size == 1:
-        g_code.append("MOV A,E")
-        g_pc += 1
+        emit_instr("MOV", "A", "E")
     else:
         if toWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        g_code.append("XCHG     ; from D,E")
-        g_pc += 1
-    g_code.append("JMP %s  ; DO first iter" % label3)
-    g_pc += 3
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+        emit_instr("XCHG", comment="from D,E")
+    emit_instr("JMP", label3, comment="DO first iter")
     emit_label(label1)
     toWidth = collapse_left(p[6])
     if toWidth > sym.size:
@@ -917,100 +1458,82 @@ def p_do_to_statement(p):
     if byFlag:
         leftFlag = isinstance(p[8][0], Operator)
         if leftFlag:
-            g_code.append("PUSH D  ; save left DO")
-            g_pc += 1
+            emit_instr("PUSH", "D", comment="save left DO")
         byWidth = collapse_right(p[8])
         if byWidth > sym.size:
             fatal("DO variable %s overflow, line %d" % (p[2], p.lineno(1)))
         if leftFlag:
-            g_code.append("POP D  ; restore left DO")
-            g_pc += 1
+            emit_instr("POP", "D", comment="restore left DO")
     if sym.size == 1:
-        g_code.append("LDA %s  ; DO load" % sym.name)
-        g_pc += 3
+        emit_instr("LDA", sym.name, comment="DO load")
         if len(p) == 10:
             if byFlag:
-                g_code.append("ADD C  ; DO update")
-                g_pc += 1
+                emit_instr("ADD", "C", comment="DO update")
             else:
-                g_code.append("ADI %03XH  ; DO update" % p[8])
-                g_pc += 2
+                emit_instr("ADI", "%03XH" % p[8], comment="DO update")
         else:
-            g_code.append("INR A   ; DO update")
-            g_pc += 1
-        g_code.append("CMP E   ; DO <=")
-        g_code.append("JZ %s   ; = " % label3)
-        g_code.append("JNC %s  ; > DO complete" % label2)
-        g_pc += 7
+            emit_instr("INR", "A", comment="DO update")
+        emit_instr("CMP", "E", comment="DO <=")
+        emit_instr("JZ", label3, comment="=")
+        emit_instr("JNC", label2, comment="> DO complete")
     else:
         label4 = new_label()
         if byFlag and (byWidth == 1):
-            g_code.append("MVI B,000H  ; zero pad MSB")
-            g_pc += 2
+            emit_instr("MVI", "B", "000H", comment="zero pad MSB")
         if toWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        g_code.append("LHLD %s  ; DO load" % sym.name)
-        g_pc += 3
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+        emit_instr("LHLD", sym.name, comment="DO load")
         if len(p) == 10:
             if byFlag:
-                g_code.append("DAD B  ; DO update")
-                g_pc += 1
+                emit_instr("DAD", "B", comment="DO update")
             else:
-                g_code.append("LXI B,%05XH" % p[8])
-                g_code.append("DAD B  ; DO update")
-                g_pc += 4
-        else:
-            g_code.append("INX H    ; DO update")
-            g_pc += 1
-        g_code.append("MOV A,H")
-        g_code.append("CMP D   ; DO <=")
-        g_code.append("JZ %s   ; =" % label4)
-        g_code.append("JNC %s  ; > DO complete" % label2)
-        g_code.append("JMP %s  ; <" % label3)
-        g_pc += 11
+                emit_instr("LXI", "B", "%05XH" % p[8])
+                emit_instr("DAD", "B", comment="DO update")
+        else:
+            emit_instr("INX", "H", comment="DO update")
+        emit_instr("MOV", "A", "H")
+        emit_instr("CMP", "D", comment="DO <=")
+        emit_instr("JZ", label4, comment="=")
+        emit_instr("JNC", label2, comment="> DO complete")
+        emit_instr("JMP", label3, comment="<")
         emit_label(label4)
-        g_code.append("MOV A,L")
-        g_code.append("CMP E   ; DO <=")
-        g_code.append("JZ %s   ; =" % label3)
-        g_code.append("JNC %s  ; > DO complete" % label2)
-        g_pc += 8
+        emit_instr("MOV", "A", "L")
+        emit_instr("CMP", "E", comment="DO <=")
+        emit_instr("JZ", label3, comment="=")
+        emit_instr("JNC", label2, comment="> DO complete")
     emit_label(label3)
     if sym.size == 1:
-        g_code.append("STA %s  ; DO assign" % sym.name)
-        g_pc += 3
+        emit_instr("STA", sym.name, comment="DO assign")
     else:
-        g_code.append("SHLD %s  ; DO assign" % sym.name)
-        g_pc += 3
+        emit_instr("SHLD", sym.name, comment="DO assign")
     g_do_stack.append((label2,label1))
     p[0] = 0
     
     
 def p_end_statement(p):
     r'''end_statement : END SEMICOLON'''
-    global g_do_stack, g_pc, g_code, g_case_flag
+    global g_do_stack
     try:
         labels = g_do_stack.pop()
     except IndexError:
         fatal("unmatched END, line %d" % p.lineno(1))
     mark_statement()
     if labels is not None:
-        if len(labels) > 1:
-            g_code.append("JMP %s  ; END" % labels[1])
-            g_pc += 3
+        if len(labels) > 2:
+            labels[2].emit_end(labels[1])
+        elif len(labels) > 1:
+            emit_instr("JMP", labels[1], comment="END")
         if isinstance(labels[0], tuple):
             for l in labels[0]:
                 emit_label(l)
         else:
             emit_label(labels[0])
-    if g_case_flag:
-        g_case_flag = False
     p[0] = 0
     
 
 def p_end_procedure(p):
     r'''end_procedure : END IDENT SEMICOLON'''
-    global g_proc_stack, g_code, g_pc, g_ret
+    global g_proc_stack, g_code, g_ret
     try:
         top = g_proc_stack.pop()
     except IndexError:
@@ -1022,25 +1545,20 @@ def p_end_procedure(p):
         if (not g_ret) and (proc.size != 0):
             fatal("proc %s missing RETURN, line %d" % (top, p.lineno(2)))
         else:
-            if (len(g_code) == 0) or (get_instr(g_code[-1]) != 'RET'):
-                g_code.append("RET  ; proc return")
-                g_pc += 1
+            if (len(g_code) == 0) or (g_code[-1].op != 'RET'):
+                emit_instr("RET", comment="proc return")
     g_ret = False
          
          
 def p_if_then_statement(p):
     r'''if_then_statement : IF cond_expr THEN code_statement'''
-    global g_pc, g_code, g_sym_list, g_do_stack, g_state_count
+    global g_pc, g_sym_list, g_do_stack, g_state_count
     es = pop_statement()
     #print("IFTHEN:", es)
     oldpc = g_pc
     mark_statement()
-    collapse_left(p[2])
     label = new_label()
-    g_code.append("XRA A  ; A = 0")
-    g_code.append("CMP E  ; rel result")
-    g_code.append("JZ %s  ; skip if" % label)
-    g_pc += 5
+    collapse_branch(p[2], label, False)
     emit_code()
     size = g_pc - oldpc
     for sym in es:
@@ -1062,13 +1580,15 @@ def p_if_then_statement(p):
         
 def p_else_statement(p):
     r'''else_statement : ELSE code_statement'''
-    global g_pc, g_code, g_sym_list, g_state_count, g_do_stack
+    global g_pc, g_sym_list, g_state_count, g_do_stack
     es = pop_statement()
+    case = current_case(len(g_do_stack) - min(p[2], 1))
+    if case is not None:
+        case.reopen()
     label1 = new_label()
     label2 = g_sym_list.pop()
     #print("ELSE:", label1, label2, g_do_stack, p[2])
-    g_code.append("JMP %s  ; skip else" % label1)
-    g_pc += 3
+    emit_instr("JMP", label1, comment="skip else")
     emit_label(label2.name)
     mark_statement()
     for sym in es:
@@ -1090,11 +1610,9 @@ def p_else_statement(p):
         
 def p_goto_statement(p):
     r'''goto_statement : GO TO IDENT SEMICOLON'''
-    global g_pc, g_code
     #print("GOTO:", p[3])
     mark_statement()
-    g_code.append("JMP %s  ; GO TO" % p[3])
-    g_pc += 3
+    emit_instr("JMP", p[3], comment="GO TO")
     p[0] = 0
     
     
@@ -1103,7 +1621,6 @@ def p_call_statement(p):
                        | CALL IDENT LPARENS expr RPARENS SEMICOLON
                        | CALL IDENT LPARENS expr COMMA expr RPARENS SEMICOLON
                        | CALL IDENT LPARENS expr COMMA expr COMMA expr RPARENS SEMICOLON'''
-    global g_pc, g_code
     proc = lookup_sym(p[2])
     if proc is None:
         fatal("unknown proc %s, line %d" % (p[2], p.lineno(1)))
@@ -1139,7 +1656,7 @@ def p_call_statement(p):
 def p_return_statement(p):
     r'''return_statement : RETURN SEMICOLON
                          | RETURN expr SEMICOLON'''
-    global g_pc, g_code, g_proc_stack, g_ret
+    global g_proc_stack, g_ret
     #print("RETURN")
     if len(g_proc_stack) == 0:
         fatal("return not allowed outside proc, line %d" % p.lineno(1))
@@ -1152,10 +1669,8 @@ def p_return_statement(p):
         if width > proc.size:
             fatal("return overflow, line %d" % p.lineno(1))
         elif width < proc.size:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-    g_code.append("RET  ; proc return")
-    g_pc += 1
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+    emit_instr("RET", comment="proc return")
     g_ret = True
     p[0] = 0
     
@@ -1186,7 +1701,6 @@ def p_assign_statement(p):
  
  
 def assign_array(name, index, assignWidth, pad): 
-    global g_code, g_pc
     sym = lookup_sym(name)
     elemWidth = sym.elem_size
     numElement = sym.size // elemWidth
@@ -1197,16 +1711,21 @@ def assign_array(name, index, assignWidth, pad):
         warning("BYTE array element overflow %s"  % name)
     if (elemWidth > assignWidth) and (not pad):
         pad = True
-        g_code.append("MVI D,000H  ; zero pad elem MSB")
-        g_pc += 2
-    g_code.append("PUSH D  ; save left array");
-    g_pc += 1
+        emit_instr("MVI", "D", "000H", comment="zero pad elem MSB")
+    ptr = loop_pointer(sym, index)
+    if ptr is not None:
+        emit_instr("LHLD", ptr, comment="store arr DO pointer")
+        emit_instr("MOV", "M", "E", comment="arr assign from (D),C")
+        if elemWidth == 2:
+            emit_instr("INX", "H")
+            emit_instr("MOV", "M", "D")
+        return pad
+    emit_instr("PUSH", "D", comment="save left array")
     indexWidth = collapse_left(index)
     if indexWidth == 1:
-        g_code.append("MVI D,000H  ; zero pad index MSB");
-        g_pc += 2
+        emit_instr("MVI", "D", "000H", comment="zero pad index MSB")
     if isinstance(sym, BasedArray):
-        g_code.append("LHLD %s  ; store arr based" % sym.addr)
+        emit_instr("LHLD", sym.addr, comment="store arr based")
     else:
         if isinstance(sym, AtArray):
             if isinstance(sym.addr, int):
@@ -1215,25 +1734,20 @@ def assign_array(name, index, assignWidth, pad):
                 name = sym.addr
         else:
             name = sym.name
-        g_code.append("LXI H,%s  ; store arr" % name)
-    g_pc += 3
+        emit_instr("LXI", "H", name, comment="store arr")
     if elemWidth == 2:
-        g_code.append("XCHG")
-        g_code.append("DAD H  ; index << 1")
-        g_pc += 2
-    g_code.append("DAD D  ; arr offset")
-    g_code.append("POP D  ; arr restore left")
-    g_code.append("MOV M,E  ; arr assign from (D),C")
-    g_pc += 3
+        emit_instr("XCHG")
+        emit_instr("DAD", "H", comment="index << 1")
+    emit_instr("DAD", "D", comment="arr offset")
+    emit_instr("POP", "D", comment="arr restore left")
+    emit_instr("MOV", "M", "E", comment="arr assign from (D),C")
     if elemWidth == 2:
-        g_code.append("INX H")
-        g_code.append("MOV M,D")
-        g_pc += 2
+        emit_instr("INX", "H")
+        emit_instr("MOV", "M", "D")
     return pad
         
         
 def assign_scalar(name, width, last, pad):
-    global g_code, g_pc
     sym = lookup_sym(name)
     if isinstance(sym, BasedVariable):
         name = sym.addr
@@ -1243,7 +1757,7 @@ def assign_scalar(name, width, last, pad):
         if width != 1:
             warning("BYTE variable overflow %s" % name)
         if isinstance(sym, BasedVariable):
-            g_code.append("LHLD %s  ; assign based" % name)
+            emit_instr("LHLD", name, comment="assign based")
         else:
             if isinstance(sym, AtVariable):
                 if isinstance(sym.addr, int):
@@ -1252,26 +1766,21 @@ def assign_scalar(name, width, last, pad):
                     name = sym.addr 
                 if sym.value > 0:
                     name += " + %05XH" % sym.value
-            g_code.append("LXI H,%s   ; assign" % name)
-        g_code.append("MOV M,E    ; from E")
-        g_pc += 4
+            emit_instr("LXI", "H", name, comment="assign")
+        emit_instr("MOV", "M", "E", comment="from E")
     else:
         if (width == 1) and (not pad):
             pad = True
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
         if isinstance(sym, BasedVariable):
-            g_code.append("LHLD %s  ; assign based" % name)
-            g_code.append("MOV M,E")
-            g_code.append("INX H")
-            g_code.append("MOV M,D  ; from D,E")
-            g_pc += 6
-        else:
-            g_code.append("XCHG    ; from D,E")
-            g_pc += 1
+            emit_instr("LHLD", name, comment="assign based")
+            emit_instr("MOV", "M", "E")
+            emit_instr("INX", "H")
+            emit_instr("MOV", "M", "D", comment="from D,E")
+        else:
+            emit_instr("XCHG", comment="from D,E")
             if sym.name == "STACKPTR":
-                g_code.append("SPHL  ; assign STACKPTR")
-                g_pc += 1
+                emit_instr("SPHL", comment="assign STACKPTR")
             else:
                 if isinstance(sym, AtVariable):
                     if isinstance(sym.addr, int):
@@ -1280,11 +1789,9 @@ def assign_scalar(name, width, last, pad):
                         name = sym.addr
                     if sym.value > 0:
                         name += " + %05XH" % sym.value
-                g_code.append("SHLD %s ; assign" % name)
-                g_pc += 3
+                emit_instr("SHLD", name, comment="assign")
             if not last:
-                g_code.append("XCHG    ; restore D,E")
-                g_pc += 1
+                emit_instr("XCHG", comment="restore D,E")
     return pad
     
     
@@ -1357,85 +1864,85 @@ def p_rel_expr(p):
     
 def p_add_expr(p):
     '''add_expr : expr PLUS expr'''
-    p[0] = (AdditionOp(p[1], p[3]),)
+    p[0] = simplify((AdditionOp(p[1], p[3]),))
     #print("ADD: %s" % p[0])
     
     
 def p_sub_expr(p):
     '''sub_expr : expr MINUS expr'''
-    p[0] = (SubtractionOp(p[1], p[3]),)
+    p[0] = simplify((SubtractionOp(p[1], p[3]),))
     #print("SUB:", p[0])
     
     
 def p_mul_expr(p):
     r'''mul_expr : expr ASTERIX expr'''
-    p[0] = (MultiplicationOp(p[1], p[3]),)
+    p[0] = simplify((MultiplicationOp(p[1], p[3]),))
     #print("MUL:", p[0])
     
 
 def p_div_expr(p):
     r'''div_expr : expr DIV expr'''
-    p[0] = (DivisionOp(p[1], p[3]),)
+    p[0] = simplify((DivisionOp(p[1], p[3]),))
     #print("DIV:", p[0])
     
 
 def p_mod_expr(p):
     r'''mod_expr : expr MOD expr'''
-    p[0] = (ModOp(p[1], p[3]),)
+    p[0] = simplify((ModOp(p[1], p[3]),))
     #print("MOD:", p[0])
     
 
 def p_and_expr(p):
     r'''and_expr : expr AND expr'''
-    p[0] = (AndOp(p[1], p[3]),)
+    p[0] = simplify((AndOp(p[1], p[3]),))
     #print("AND:", p[0])
     
 
 def p_or_expr(p):
     r'''or_expr : expr OR expr'''
-    p[0] = (OrOp(p[1], p[3]),)
+    p[0] = simplify((OrOp(p[1], p[3]),))
     #print("OR:", p[0])
     
 
 def p_not_expr(p):
     r'''not_expr : NOT expr'''
-    p[0] = (NotOp(p[2]),)
+    p[0] = simplify((NotOp(p[2]),))
     #print("NOT:", p[0])
     
 
 def p_eq_expr(p):
     r'''eq_expr : expr EQUAL expr'''
-    p[0] = (EqualOp(p[1], p[3]),)
+    p[0] = simplify((EqualOp(p[1], p[3]),))
     #print("EQUAL:", p[0])
     
 
 def p_noteq_expr(p):
     '''noteq_expr : expr NOTEQUAL expr'''
-    p[0] = (NotEqualOp(p[1], p[3]),)
+    p[0] = simplify((NotEqualOp(p[1], p[3]),))
     #print("NOTEQ:", p[0])
     
 
 def p_lt_expr(p):
     '''lt_expr : expr LESSTHAN expr'''
-    p[0] = (LessThanOp(p[1], p[3]),)
+    p[0] = simplify((LessThanOp(p[1], p[3]),))
     #print("LT:", p[0])
     
 
 def p_lteq_expr(p):
     '''lteq_expr : expr LESSTHANEQUAL expr'''
-    p[0] = (LessThanEqualOp(p[1], p[3]),)
+    p[0] = simplify((LessThanEqualOp(p[1], p[3]),))
     #print("LTEQ:", p[0])
 
     
 def p_gt_expr(p):
     '''gt_expr : expr GREATERTHAN expr'''
-    p[0] = (GreaterThanOp(p[1], p[3]),)
+    p[0] = simplify((GreaterThanOp(p[1], p[3]),))
     #print("GT: %s" % p[0])
  
  
 def p_gteq_expr(p):
     r'''gteq_expr : expr GREATERTHANEQUAL expr'''
-    p[0] = (GreaterThanEqualOp(p[1], p[3]),)
+    p[0] = simplify((GreaterThanEqualOp(p[1], p[3]),))
     #print("GTEQ: %s" % p[0])
  
  
@@ -1472,7 +1979,7 @@ def p_element_expr(p):
             elif isinstance(sym, Procedure):
                 if sym.size == 0:
                     fatal("procedure %s does not return a value, line %d" % (sym.name, p.lineno(1)))
-                p[0] = (ProcCall1(p[1], p[3]),)
+                p[0] = simplify((ProcCall1(p[1], p[3]),))
         else:
             if isinstance(sym, Procedure):
                 p[0] = (ProcCall0(p[1]),)
@@ -1482,7 +1989,7 @@ def p_element_expr(p):
             
 def p_proc_call2(p):
     r'''proc_call2 : IDENT LPARENS expr COMMA expr RPARENS'''
-    p[0] = (ProcCall2(p[1], p[3], p[5]),)
+    p[0] = simplify((ProcCall2(p[1], p[3], p[5]),))
     #print("PROC2: %s" % p[0])
     
     
@@ -1510,7 +2017,7 @@ def p_inplace_assign(p):
 def p_reference(p):
     r'''reference : PERIOD IDENT
                   | PERIOD LPARENS ref_init_list RPARENS'''
-    global g_anon_list
+    global g_anon_list, g_symtab
     if len(p) == 3:
         sym = lookup_sym(p[2])
         if sym is None:
@@ -1527,6 +2034,7 @@ def p_reference(p):
             else:
                 bdata.append(b)
         g_anon_list.append(Array(name, 0, len(bdata), bdata, 1))
+        g_symtab.add_anon(g_anon_list[-1])
     p[0] = Reference(name)
     
     
@@ -1574,6 +2082,8 @@ def p_number(p):
     
     
 def p_error(t):
+    if t is None:
+        fatal("syntax error at end of input")
     fatal("syntax error at %s(%s), line %d" % (t.value, t.type, t.lexer.lineno))
   
   
@@ -1593,7 +2103,18 @@ precedence = (
     ('left', 'HEXNUMBER', 'DECNUMBER', 'BINNUMBER'),
 )
 
-parser = yacc.yacc()
+def build_parser():
+    """Create the parser from the cached LALR tables.  The tables are only
+       regenerated, without a debug file, when the grammar signature
+       changes."""
+    load_table('parsetab', TABDIR)
+    return yacc.yacc(debug=False, outputdir=TABDIR)
+    
+
+# time to load or build the parser, reported by --stats
+load_start = perf_counter()
+parser = build_parser()
+PARSER_LOAD_TIME = perf_counter() - load_start
    
    
 class Operator(object): pass
@@ -1611,19 +2132,15 @@ class UnaryOp(Operator):
         return (not left) and (not isinstance(self.arg1, int)) and isinstance(self.arg1[0], BinaryOp)
         
     def get_arg(self, left):
-        global g_pc, g_code
         saveLeft = self.check_save(left)
         if saveLeft:
-            g_code.append("PUSH D  ; save left unary")
-            g_pc += 1
+            emit_instr("PUSH", "D", comment="save left unary")
         return collapse_left(self.arg1)
         
     def exit(self, left):
-        global g_pc, g_code
         saveLeft = self.check_save(left)
         if saveLeft:
-            g_code.append("POP D  ; restore left unary")
-            g_pc += 1
+            emit_instr("POP", "D", comment="restore left unary")
         
         
 class BinaryOp(Operator):
@@ -1640,16 +2157,13 @@ class BinaryOp(Operator):
         return (not isinstance(self.arg2, int)) and isinstance(self.arg2[0], Operator)
         
     def get_args(self):
-        global g_pc, g_code
         leftWidth = collapse_left(self.arg1)
         saveLeft = self.check_save()
         if saveLeft:
-            g_code.append("PUSH D ; save left binary")
-            g_pc += 1
+            emit_instr("PUSH", "D", comment="save left binary")
         rightWidth = collapse_right(self.arg2)
         if saveLeft:
-            g_code.append("POP D  ; restore left binary")
-            g_pc += 1
+            emit_instr("POP", "D", comment="restore left binary")
         return (leftWidth, rightWidth)
         
         
@@ -1662,15 +2176,11 @@ class ProcCall0(Operator):
         return "ProcCall0(%s)" % self.name
     
     def _collapse_common(self, proc, left):
-        global g_pc, g_code
-        g_code.append("CALL %s  ; proc call" % proc.name)
-        g_pc += 3
+        emit_instr("CALL", proc.name, comment="proc call")
         if (not left) and (proc.size > 0):
-            g_code.append("MOV C,E  ; proc ret right to (B),C")
-            g_pc += 1
+            emit_instr("MOV", "C", "E", comment="proc ret right to (B),C")
             if proc.size == 2:
-                g_code.append("MOV B,D")
-                g_pc += 1
+                emit_instr("MOV", "B", "D")
         return proc.size
     
     def collapse_left(self):
@@ -1704,13 +2214,11 @@ class ProcCallAddr(Operator):
         return "ProcCallAddr(%s)" % self.name
     
     def _collapse_common(self, sym, left):
-        global g_pc, g_code
         label = new_label()
-        g_code.append("LXI H,%s ; proc ret" % label)
-        g_code.append("PUSH H")
-        g_code.append("LHLD %s  ; proc address" % sym.name)
-        g_code.append("PCHL     ; proc call")
-        g_pc += 8
+        emit_instr("LXI", "H", label, comment="proc ret")
+        emit_instr("PUSH", "H")
+        emit_instr("LHLD", sym.name, comment="proc address")
+        emit_instr("PCHL", comment="proc call")
         emit_label(label)
     
     def collapse_left(self):
@@ -1734,21 +2242,16 @@ class ProcCall1(UnaryOp):
         self.name = name
         
     def _collapse_common(self, proc, left):
-        global g_pc, g_code
         argWidth = self.get_arg(left)
         if argWidth > proc.arg_widths[0]:
             fatal("argument overflow for procedure %s arg 1" % proc.name)
         elif argWidth < proc.arg_widths[0]:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        g_code.append("CALL %s  ; proc call" % proc.name)
-        g_pc += 3
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+        emit_instr("CALL", proc.name, comment="proc call")
         if (not left) and (proc.size > 0):
-            g_code.append("MOV C,E  ; proc ret right to (B),C")
-            g_pc += 1
+            emit_instr("MOV", "C", "E", comment="proc ret right to (B),C")
             if proc.size == 2:
-                g_code.append("MOV B,D")
-                g_pc += 1
+                emit_instr("MOV", "B", "D")
         self.exit(left)
         return proc.size
         
@@ -1781,26 +2284,20 @@ class ProcCall2(BinaryOp):
         self.name = name
         
     def _collapse_common(self, proc, left):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         if leftWidth > proc.arg_widths[0]:
             fatal("argument overflow for procedure %s arg 1" % proc.name)
         if rightWidth > proc.arg_widths[1]:
             fatal("argument overflow for procedure %s arg 2" % proc.name)
         if leftWidth < proc.arg_widths[0]:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
         if rightWidth < proc.arg_widths[1]:
-            g_code.append("MVI B,000H  ; zero pad MSB")
-            g_pc += 2
-        g_code.append("CALL %s  ; proc call" % proc.name)
-        g_pc += 3
+            emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+        emit_instr("CALL", proc.name, comment="proc call")
         if (not left) and (proc.size > 0):
-            g_code.append("MOV C,E  ; proc ret right to (B),C")
-            g_pc += 1
+            emit_instr("MOV", "C", "E", comment="proc ret right to (B),C")
             if proc.size == 2:
-                g_code.append("MOV B,D")
-                g_pc += 1
+                emit_instr("MOV", "B", "D")
         return proc.size
         
     def collapse_left(self):
@@ -1833,27 +2330,21 @@ class ProcCallExt(ProcCall2):
         self.ext_args = args
         
     def _collapse_common(self, proc, left):
-        global g_pc, g_code
         for n in range(len(self.ext_args)):
             arg = self.ext_args[n]
             argWidth = collapse_left(arg)
             if argWidth > proc.arg_widths[n+2]:
                 fatal("argument overflow for procedure %s arg" % proc.name)
             elif argWidth < proc.arg_widths[n+2]:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("PUSH D  ; proc ext arg")
-            g_pc += 1
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("PUSH", "D", comment="proc ext arg")
         width = ProcCall2._collapse_common(self, proc, left)
         if not left:
-            g_code.append("MOV C,E  ; proc ext right to (B),C")
-            g_pc += 1
+            emit_instr("MOV", "C", "E", comment="proc ext right to (B),C")
             if width == 2:
-                g_code.append("MOV B,D")
-                g_pc += 1
+                emit_instr("MOV", "B", "D")
         for arg in self.ext_args:
-            g_code.append("POP H  ; proc ext arg discard")
-            g_pc += 1
+            emit_instr("POP", "H", comment="proc ext arg discard")
         return proc.size
         
     def collapse_left(self):
@@ -1878,446 +2369,610 @@ class ProcCallExt(ProcCall2):
 class AdditionOp(BinaryOp):
 
     def collapse_left(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("ADD E    ; + left")
-            g_code.append("MOV E,A  ; result to E")
-            g_pc += 3
+            emit_instr("MOV", "A", "C")
+            emit_instr("ADD", "E", comment="+ left")
+            emit_instr("MOV", "E", "A", comment="result to E")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("XCHG   ; from D,E")
-            g_code.append("DAD B  ; + left")
-            g_code.append("XCHG   ; result to D,E")
-            g_pc += 3
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("XCHG", comment="from D,E")
+            emit_instr("DAD", "B", comment="+ left")
+            emit_instr("XCHG", comment="result to D,E")
         return maxWidth
         
     def collapse_right(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("ADD E    ; + right")
-            g_code.append("MOV C,A  ; result to C")
-            g_pc += 3
+            emit_instr("MOV", "A", "C")
+            emit_instr("ADD", "E", comment="+ right")
+            emit_instr("MOV", "C", "A", comment="result to C")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("XCHG     ; from D,E")
-            g_code.append("DAD B    ; + right")
-            g_code.append("MOV C,L  ; result to B,C")
-            g_code.append("MOV B,H")
-            g_pc += 4
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("XCHG", comment="from D,E")
+            emit_instr("DAD", "B", comment="+ right")
+            emit_instr("MOV", "C", "L", comment="result to B,C")
+            emit_instr("MOV", "B", "H")
         return maxWidth
         
 class SubtractionOp(BinaryOp):
         
     def collapse_left(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,E")
-            g_code.append("SUB C    ; - left")
-            g_code.append("MOV E,A  ; result to E")
-            g_pc += 3
+            emit_instr("MOV", "A", "E")
+            emit_instr("SUB", "C", comment="- left")
+            emit_instr("MOV", "E", "A", comment="result to E")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,E")
-            g_code.append("SUB C    ; - left")
-            g_code.append("MOV E,A")
-            g_code.append("MOV A,D")
-            g_code.append("SBB B")
-            g_code.append("MOV D,A  ; result to D,E")
-            g_pc += 6
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "E")
+            emit_instr("SUB", "C", comment="- left")
+            emit_instr("MOV", "E", "A")
+            emit_instr("MOV", "A", "D")
+            emit_instr("SBB", "B")
+            emit_instr("MOV", "D", "A", comment="result to D,E")
         return maxWidth
         
     def collapse_right(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,E")
-            g_code.append("SUB C    ; - right")
-            g_code.append("MOV C,A  ; result to C")
-            g_pc += 3
+            emit_instr("MOV", "A", "E")
+            emit_instr("SUB", "C", comment="- right")
+            emit_instr("MOV", "C", "A", comment="result to C")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,E")
-            g_code.append("SUB C    ; - right")
-            g_code.append("MOV C,A")
-            g_code.append("MOV A,D")
-            g_code.append("SBB B")
-            g_code.append("MOV B,A  ; result to B,C")
-            g_pc += 6
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "E")
+            emit_instr("SUB", "C", comment="- right")
+            emit_instr("MOV", "C", "A")
+            emit_instr("MOV", "A", "D")
+            emit_instr("SBB", "B")
+            emit_instr("MOV", "B", "A", comment="result to B,C")
         return maxWidth
         
         
 class MultiplicationOp(BinaryOp):
-    """Generate code for * operator"""
-    
-    def _collapse_common(self, left, rightWidth):
-        global g_pc, g_code
-        label1 = new_label()
-        label2 = new_label()
-        if rightWidth == 1:
-            g_code.append("MVI B,008H  ; * count")
+    """Generate code for * operator.  A constant multiplier is expanded
+       into a DAD chain, other multiplies call the __MUL16 routine."""
+    
+    def const_arg(self):
+        """Get the constant multiplier and the other argument.  Returns
+           (None, None) if there is no constant or the DAD chain would
+           be too long."""
+        if isinstance(self.arg2, int):
+            (value, arg) = (self.arg2, self.arg1)
+        elif isinstance(self.arg1, int):
+            (value, arg) = (self.arg1, self.arg2)
         else:
-            g_code.append("MVI A,010H  ; * count")
-        g_code.append("LXI H,00000H  ; * init")
-        g_pc += 5
-        emit_label(label1)
-        if rightWidth == 2:
-            g_code.append("PUSH PSW  ; * save count")
-            g_code.append("MOV A,B")
-            g_code.append("RAR")
-            g_code.append("MOV B,A")
-            g_pc += 4
-        g_code.append("MOV A,C")
-        g_code.append("RAR")
-        g_code.append("MOV C,A")
-        g_code.append("JNC %s  ; * check bits of right arg" % label2)
-        g_code.append("DAD D")
-        g_pc += 7
-        emit_label(label2)
-        g_code.append("XCHG")
-        g_code.append("DAD H")
-        g_code.append("XCHG")
-        g_pc += 3
+            return (None, None)
+        bits = bin(value)[3:]
+        cost = len(bits) + bits.count("1")
+        if (value >= 0x100) and ((value & 0xff) == 0):
+            # low byte moved up, chain for the high byte only
+            cost = len(bin(value >> 8)[3:]) + bin(value).count("1") - 1
+        if cost > MUL_CHAIN_MAX:
+            return (None, None)
+        return (value, arg)
+    
+    def _collapse_const(self, left, value, arg):
+        width = collapse_left(arg)
+        if (value >= 0x100) and ((value & 0xff) == 0):
+            emit_instr("MOV", "H", "E", comment="* 256")
+            emit_instr("MVI", "L", "000H")
+            value >>= 8
+            if value > 1:
+                emit_instr("XCHG")
+                self._chain(value)
+            self._result(left)
+            return
+        if width == 1:
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+        self._chain(value)
+        self._result(left)
+        
+    def _chain(self, value):
+        """HL = DE * value using a DAD chain"""
+        bits = bin(value)[3:]
+        if value == 0:
+            emit_instr("LXI", "H", "00000H", comment="* 0")
+            bits = ""
+        elif "1" in bits:
+            emit_instr("MOV", "L", "E", comment="* %d" % value)
+            emit_instr("MOV", "H", "D")
+        else:
+            emit_instr("XCHG", comment="* %d" % value)
+        for bit in bits:
+            emit_instr("DAD", "H")
+            if bit == "1":
+                emit_instr("DAD", "D")
+    
+    def _collapse_common(self, left):
+        (leftWidth, rightWidth) = self.get_args()
+        if leftWidth == 1:
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
         if rightWidth == 1:
-            g_code.append("DCR B  ; check count")
-            g_pc += 1
-        else:
-            g_code.append("POP PSW ;  * check count")
-            g_code.append("DCR A")
-            g_pc += 2
-        g_code.append("JNZ %s ;  * more bits" % label1)
-        g_pc += 3
+            emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+        emit_instr("CALL", use_runtime("__MUL16"), comment="*")
+        self._result(left)
+        
+    def _result(self, left):
         if left:
-            g_code.append("XCHG  ; * result do D,E")
-            g_pc += 1
+            emit_instr("XCHG", comment="* result to D,E")
         else:
-            g_code.append("MOV C,L  ; * result to B,C")
-            g_code.append("MOV B,H")
-            g_pc += 2
+            emit_instr("MOV", "C", "L", comment="* result to B,C")
+            emit_instr("MOV", "B", "H")
 
     def collapse_left(self):
-        global g_pc, g_code
-        (leftWidth, rightWidth) = self.get_args()
-        if leftWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        self._collapse_common(True, rightWidth)
+        (value, arg) = self.const_arg()
+        if value is not None:
+            self._collapse_const(True, value, arg)
+        else:
+            self._collapse_common(True)
         return 2
         
     def collapse_right(self):
-        global g_pc, g_code
-        (leftWidth, rightWidth) = self.get_args()
-        if leftWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        self._collapse_common(False, rightWidth)
+        (value, arg) = self.const_arg()
+        if value is not None:
+            self._collapse_const(False, value, arg)
+        else:
+            self._collapse_common(False)
         return 2
         
         
+def power_of_two(node):
+    """Get n if node is the constant 2**n, otherwise None"""
+    if isinstance(node, int) and (node > 0) and ((node & (node - 1)) == 0):
+        return node.bit_length() - 1
+    return None
+    
+    
+def rotate_right_a(count):
+    """Rotate A right by a constant count, the shorter way round"""
+    count &= 7
+    if count <= 4:
+        for n in range(count):
+            emit_instr("RRC")
+    else:
+        for n in range(8 - count):
+            emit_instr("RLC")
+            
+            
+def shift_zero(width, name, count):
+    """Load the result of a shift by the whole width of (D),E"""
+    if width == 1:
+        emit_instr("MVI", "E", "000H", comment="%s %d" % (name, count))
+    else:
+        emit_instr("LXI", "D", "00000H", comment="%s %d" % (name, count))
+        
+        
+def shift_right_const(width, count):
+    """Shift (D),E right by a constant count, in place"""
+    if count >= (8 * width):
+        shift_zero(width, "SHR", count)
+        return
+    if (width == 2) and (count >= 8):
+        emit_instr("MOV", "E", "D", comment="SHR 8")
+        emit_instr("MVI", "D", "000H")
+        width = 1
+        count -= 8
+    if count == 0:
+        return
+    if width == 1:
+        emit_instr("MOV", "A", "E")
+        rotate_right_a(count)
+        emit_instr("ANI", "%03XH" % (0xff >> count), comment="SHR %d" % count)
+        emit_instr("MOV", "E", "A")
+    else:
+        for n in range(count):
+            emit_instr("MOV", "A", "D")
+            emit_instr("ORA", "A", comment="clear carry")
+            emit_instr("RAR")
+            emit_instr("MOV", "D", "A")
+            emit_instr("MOV", "A", "E")
+            emit_instr("RAR")
+            emit_instr("MOV", "E", "A")
+            
+            
+def shift_left_byte(reg, count):
+    """Shift a register left by a constant count below 8, in place"""
+    emit_instr("MOV", "A", reg)
+    if count <= 5:
+        for n in range(count):
+            emit_instr("ADD", "A")
+    else:
+        rotate_right_a(8 - count)
+        emit_instr("ANI", "%03XH" % ((0xff << count) & 0xff))
+    emit_instr("MOV", reg, "A", comment="SHL %d" % count)
+    
+    
+def shift_left_const(width, count):
+    """Shift (D),E left by a constant count, in place"""
+    if count >= (8 * width):
+        shift_zero(width, "SHL", count)
+        return
+    if count == 0:
+        return
+    if width == 1:
+        shift_left_byte("E", count)
+    elif count >= 8:
+        emit_instr("MOV", "D", "E", comment="SHL 8")
+        emit_instr("MVI", "E", "000H")
+        if count > 8:
+            shift_left_byte("D", count - 8)
+    else:
+        emit_instr("XCHG")
+        for n in range(count):
+            emit_instr("DAD", "H")
+        emit_instr("XCHG", comment="SHL %d" % count)
+            
+            
+def result_right(width):
+    """Move an operator result from (D),E to (B),C"""
+    emit_instr("MOV", "C", "E", comment="result to (B),C")
+    if width == 2:
+        emit_instr("MOV", "B", "D")
+        
+        
 class DivisionOp(BinaryOp):
-    """Generate code for / operator"""
+    """Generate code for / operator.  Power of two divisors are shifts,
+       others call the __DIV16 routine.  The quotient is always an
+       ADDRESS, whatever the divisor."""
+    
+    def shift_count(self, width):
+        """Get the shift count for a power of two divisor, or None
+           if the divide is cheaper as a __DIV16 call"""
+        count = power_of_two(self.arg2)
+        if (count is not None) and (width == 2) and (count > 3) and (count < 8):
+            return None
+        return count
     
     def _collapse_common(self, left):
-        global g_pc, g_code
-        label1 = new_label()
-        label2 = new_label()
-        g_code.append("LXI H,00000H  ; / init")
-        g_pc += 3
-        emit_label(label1)
-        g_code.append("MOV A,E")
-        g_code.append("SUB C")
-        g_code.append("MOV E,A")
-        g_code.append("MOV A,D")
-        g_code.append("SBB B")
-        g_code.append("JC %s  ; / complete" % label2)
-        g_code.append("MOV D,A")
-        g_code.append("INX H")
-        g_code.append("JMP %s  ; more /" % label1)
-        g_pc += 13
-        emit_label(label2)
-        if left:
-            g_code.append("XCHG  ; / result to D,E")
-            g_pc += 1
+        width = collapse_left(self.arg1)
+        count = self.shift_count(width)
+        if count is not None:
+            shift_right_const(width, count)
+            if width == 1:
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+                width = 2
         else:
-            g_code.append("MOV C,L  ; / result to B,C")
-            g_code.append("MOV B,H")
-            g_pc += 2
+            if width == 1:
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            width = 2
+            saveLeft = self.check_save()
+            if saveLeft:
+                emit_instr("PUSH", "D", comment="save left binary")
+            if collapse_right(self.arg2) == 1:
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            if saveLeft:
+                emit_instr("POP", "D", comment="restore left binary")
+            emit_instr("CALL", use_runtime("__DIV16"), comment="/")
+        if not left:
+            result_right(width)
+        return width
         
     def collapse_left(self):
-        global g_pc, g_code
-        (leftWidth, rightWidth) = self.get_args()
-        if rightWidth == 1:
-            g_code.append("MVI B,000H  ; zero pad MSB")
-            g_pc += 2
-        if leftWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        self._collapse_common(True)
-        return 2
+        return self._collapse_common(True)
         
     def collapse_right(self):
-        global g_pc, g_code
-        (leftWidth, rightWidth) = self.get_args()
-        if rightWidth == 1:
-            g_code.append("MVI B,000H  ; zero pad MSB")
-            g_pc += 2
-        if leftWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        self._collapse_common(False)
-        return 2
+        return self._collapse_common(False)
+        
         
 class ModOp(BinaryOp):
+    """Generate code for MOD operator.  Power of two moduli are masks,
+       others call the __DIV16 routine."""
 
     def _collapse_common(self, left):
-        global g_pc, g_code
-        label1 = new_label()
-        emit_label(label1)
-        g_code.append("MOV A,E")
-        g_code.append("SUB C")
-        g_code.append("MOV E,A")
-        g_code.append("MOV A,D")
-        g_code.append("SBB B")
-        g_code.append("MOV D,A")
-        g_code.append("JNC %s  ; more MOD" % label1)
-        g_code.append("XCHG")
-        g_code.append("DAD B")
-        g_pc += 11
-        if left:
-            g_code.append("XCHG  ; MOD left to D,E")
-            g_pc += 1
+        width = collapse_left(self.arg1)
+        count = power_of_two(self.arg2)
+        if (count is not None) and (count <= 8):
+            emit_instr("MOV", "A", "E")
+            emit_instr("ANI", "%03XH" % ((1 << count) - 1), comment="MOD %d" % (1 << count))
+            emit_instr("MOV", "E", "A")
+            if width == 2:
+                emit_instr("MVI", "D", "000H")
+        elif count is not None:
+            if width == 2:
+                emit_instr("MOV", "A", "D")
+                emit_instr("ANI", "%03XH" % ((1 << (count - 8)) - 1), comment="MOD %d" % (1 << count))
+                emit_instr("MOV", "D", "A")
         else:
-            g_code.append("MOV C,L")
-            g_code.append("MOV B,H  ; MOD right to B,C")
-            g_pc += 2
+            if width == 1:
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            width = 2
+            saveLeft = self.check_save()
+            if saveLeft:
+                emit_instr("PUSH", "D", comment="save left binary")
+            if collapse_right(self.arg2) == 1:
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            if saveLeft:
+                emit_instr("POP", "D", comment="restore left binary")
+            emit_instr("CALL", use_runtime("__DIV16"), comment="MOD")
+            emit_instr("XCHG", comment="MOD remainder to D,E")
+        if not left:
+            result_right(width)
+        return width
         
     def collapse_left(self):
-        global g_pc, g_code
-        (leftWidth, rightWidth) = self.get_args()
-        if leftWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        if rightWidth == 1:
-            g_code.append("MVI B,000H  ; zero pad MSB")
-            g_pc += 2
-        self._collapse_common(True)
-        return 2
+        return self._collapse_common(True)
         
     def collapse_right(self):
-        global g_pc, g_code
-        (leftWidth, rightWidth) = self.get_args()
-        if leftWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
-        if rightWidth == 1:
-            g_code.append("MVI B,000H  ; zero pad MSB")
-            g_pc += 2
-        self._collapse_common(False)
-        return 2
+        return self._collapse_common(False)
         
         
 class AndOp(BinaryOp):
 
     def collapse_left(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("ANA E    ; & left")
-            g_code.append("MOV E,A  ; result to E")
-            g_pc += 3
+            emit_instr("MOV", "A", "C")
+            emit_instr("ANA", "E", comment="& left")
+            emit_instr("MOV", "E", "A", comment="result to E")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,C")
-            g_code.append("ANA E    ; & left")
-            g_code.append("MOV E,A")
-            g_code.append("MOV A,B")
-            g_code.append("ANA D")
-            g_code.append("MOV D,A  ; result to D,E")
-            g_pc += 6
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "C")
+            emit_instr("ANA", "E", comment="& left")
+            emit_instr("MOV", "E", "A")
+            emit_instr("MOV", "A", "B")
+            emit_instr("ANA", "D")
+            emit_instr("MOV", "D", "A", comment="result to D,E")
         return maxWidth
     
     def collapse_right(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("ANA E    ; & right")
-            g_code.append("MOV C,A  ; result to C")
-            g_pc += 3
+            emit_instr("MOV", "A", "C")
+            emit_instr("ANA", "E", comment="& right")
+            emit_instr("MOV", "C", "A", comment="result to C")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,C")
-            g_code.append("ANA E    ; & right")
-            g_code.append("MOV C,A")
-            g_code.append("MOV A,B")
-            g_code.append("ANA D")
-            g_code.append("MOV B,A  ; result to B,C")
-            g_pc += 6
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "C")
+            emit_instr("ANA", "E", comment="& right")
+            emit_instr("MOV", "C", "A")
+            emit_instr("MOV", "A", "B")
+            emit_instr("ANA", "D")
+            emit_instr("MOV", "B", "A", comment="result to B,C")
         return maxWidth
         
         
 class OrOp(BinaryOp):
 
     def collapse_left(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("ORA E    ; | left")
-            g_code.append("MOV E,A  ; result to E")
-            g_pc += 3
+            emit_instr("MOV", "A", "C")
+            emit_instr("ORA", "E", comment="| left")
+            emit_instr("MOV", "E", "A", comment="result to E")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,C")
-            g_code.append("ORA E    ; | left")
-            g_code.append("MOV E,A")
-            g_code.append("MOV A,B")
-            g_code.append("ORA D")
-            g_code.append("MOV D,A  ; result to D,E")
-            g_pc += 6
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "C")
+            emit_instr("ORA", "E", comment="| left")
+            emit_instr("MOV", "E", "A")
+            emit_instr("MOV", "A", "B")
+            emit_instr("ORA", "D")
+            emit_instr("MOV", "D", "A", comment="result to D,E")
         return maxWidth
     
     def collapse_right(self):
-        global g_pc, g_code
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("ORA E    ; | right")
-            g_code.append("MOV C,A  ; result to C")
-            g_pc += 3
+            emit_instr("MOV", "A", "C")
+            emit_instr("ORA", "E", comment="| right")
+            emit_instr("MOV", "C", "A", comment="result to C")
         else:
             if rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
             elif leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,C")
-            g_code.append("ORA E    ; | right")
-            g_code.append("MOV C,A")
-            g_code.append("MOV A,B")
-            g_code.append("ORA D")
-            g_code.append("MOV B,A  ; result to B,C")
-            g_pc += 6
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "C")
+            emit_instr("ORA", "E", comment="| right")
+            emit_instr("MOV", "C", "A")
+            emit_instr("MOV", "A", "B")
+            emit_instr("ORA", "D")
+            emit_instr("MOV", "B", "A", comment="result to B,C")
         return maxWidth
         
         
 class NotOp(UnaryOp):
 
     def collapse_left(self):
-        global g_pc, g_code
         width = self.get_arg(True)
         if width != 1:
             fatal("NOT argument BYTE overflow")
-        g_code.append("MOV A,E")
-        g_code.append("CMA      ; NOT left")
-        g_code.append("ANI 001H")
-        g_code.append("MOV E,A  ; result to E")
-        g_pc += 5
+        emit_instr("MOV", "A", "E")
+        emit_instr("CMA", comment="NOT left")
+        emit_instr("ANI", "001H")
+        emit_instr("MOV", "E", "A", comment="result to E")
         self.exit(False)
         return 1
     
     def collapse_right(self):
-        global g_pc, g_code
         width = self.get_arg(False)
         if width != 1:
             fatal("NOT argument BYTE overflow")
-        g_code.append("MOV A,E")
-        g_code.append("CMA      ; NOT right")
-        g_code.append("ANI 001H")
-        g_code.append("MOV C,A  ; result to C")
-        g_pc += 5
+        emit_instr("MOV", "A", "E")
+        emit_instr("CMA", comment="NOT right")
+        emit_instr("ANI", "001H")
+        emit_instr("MOV", "C", "A", comment="result to C")
         self.exit(False)
         return width
         
         
-class EqualOp(BinaryOp):
+class RelationOp(BinaryOp):
+    """Base class for relational operators.  branch() compiles the
+       relation in a control flow context, jumping on the flags instead
+       of creating a 0/1 result."""
+       
+    relation = None
+    
+    def branch(self, label, sense):
+        """Jump to label if the relation is equal to sense (True or False),
+           fall through otherwise"""
+        rel = self.relation
+        if not sense:
+            rel = g_rel_inverse[rel]
+        leftWidth = collapse_left(self.arg1)
+        value = self.arg2
+        if isinstance(value, int):
+            # x > n is x >= n+1 and x <= n is x < n+1
+            if rel in (">", "<="):
+                value += 1
+                rel = {">" : ">=", "<=" : "<"}[rel]
+            if value < 0x10000:
+                self._branch_const(rel, leftWidth, value, label)
+                return
+            value = self.arg2
+            rel = self.relation if sense else g_rel_inverse[self.relation]
+        saveLeft = self.check_save()
+        if saveLeft:
+            emit_instr("PUSH", "D", comment="save left binary")
+        rightWidth = collapse_right(value)
+        if saveLeft:
+            emit_instr("POP", "D", comment="restore left binary")
+        if max(leftWidth, rightWidth) == 1:
+            self._branch_byte(rel, label)
+        else:
+            if leftWidth == 1:
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            elif rightWidth == 1:
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            self._branch_word(rel, label)
+            
+    def _branch_const(self, rel, width, value, label):
+        if (width == 1) and (value < 0x100):
+            emit_instr("MOV", "A", "E")
+            if (value == 0) and (rel in ("=", "<>")):
+                emit_instr("ORA", "A", comment="%s 0" % rel)
+            else:
+                emit_instr("CPI", "%03XH" % value, comment=rel)
+        elif rel in ("=", "<>"):
+            if width == 1:
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            if g_target == "z80":
+                emit_instr("LXI", "H", "%05XH" % value)
+                emit_instr("ORA", "A", comment="clear carry")
+                emit_instr("DSBC", "D", comment=rel)
+                emit_instr(g_rel_jumps[rel], label)
+                return
+            emit_instr("MOV", "A", "E")
+            emit_instr("XRI", "%03XH" % (value & 0xff), comment=rel)
+            emit_instr("MOV", "L", "A")
+            emit_instr("MOV", "A", "D")
+            emit_instr("XRI", "%03XH" % (value >> 8))
+            emit_instr("ORA", "L")
+        else:
+            if width == 1:
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "E")
+            emit_instr("SUI", "%03XH" % (value & 0xff), comment=rel)
+            emit_instr("MOV", "A", "D")
+            emit_instr("SBI", "%03XH" % (value >> 8))
+        emit_instr(g_rel_jumps[rel], label)
+        
+    def _branch_byte(self, rel, label):
+        if rel in (">", "<="):
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment=rel)
+        else:
+            emit_instr("MOV", "A", "E")
+            emit_instr("CMP", "C", comment=rel)
+        emit_instr(g_rel_jumps[rel], label)
+            
+    def _branch_word(self, rel, label):
+        if (rel in ("=", "<>")) and (g_target == "z80"):
+            emit_instr("XCHG", comment="from D,E")
+            emit_instr("ORA", "A", comment="clear carry")
+            emit_instr("DSBC", "B", comment=rel)
+        elif rel in ("=", "<>"):
+            emit_instr("MOV", "A", "E")
+            emit_instr("XRA", "C", comment=rel)
+            emit_instr("MOV", "L", "A")
+            emit_instr("MOV", "A", "D")
+            emit_instr("XRA", "B")
+            emit_instr("ORA", "L")
+        elif rel in (">", "<="):
+            emit_instr("MOV", "A", "C")
+            emit_instr("SUB", "E", comment=rel)
+            emit_instr("MOV", "A", "B")
+            emit_instr("SBB", "D")
+        else:
+            emit_instr("MOV", "A", "E")
+            emit_instr("SUB", "C", comment=rel)
+            emit_instr("MOV", "A", "D")
+            emit_instr("SBB", "B")
+        emit_instr(g_rel_jumps[rel], label)
+        
+        
+# relation with the opposite result
+g_rel_inverse = {"=" : "<>", "<>" : "=", "<" : ">=", ">=" : "<", ">" : "<=", "<=" : ">"}
+
+# jump taken when a relation is true after comparing left with right,
+# for > and <= the comparison is right with left
+g_rel_jumps = {"=" : "JZ", "<>" : "JNZ", "<" : "JC", ">=" : "JNC", ">" : "JC", "<=" : "JNC"}
+        
+        
+class EqualOp(RelationOp):
+
+    relation = "="
     
     def _collapse_common(self, left):
-        global g_pc, g_code, g_sym_list
+        global g_sym_list
         label1 = new_label()
         label2 = new_label()
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("CMP E ; =")
-            g_code.append("JNZ %s ; !=" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment="=")
+            emit_instr("JNZ", label1, comment="!=")
         else:
             if leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
             elif rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,C")
-            g_code.append("CMP E  ; =")
-            g_code.append("JNZ %s ; !=" % label1)
-            g_code.append("MOV A,B")
-            g_code.append("CMP D  ; =")
-            g_code.append("JNZ %s ; !=" % label1)
-            g_pc += 10
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment="=")
+            emit_instr("JNZ", label1, comment="!=")
+            emit_instr("MOV", "A", "B")
+            emit_instr("CMP", "D", comment="=")
+            emit_instr("JNZ", label1, comment="!=")
         if left:
-            g_code.append("MVI E,001H  ; rel true left")
+            emit_instr("MVI", "E", "001H", comment="rel true left")
         else:
-            g_code.append("MVI C,001H  ; rel true right")
-        g_code.append("JMP %s" % label2)
-        g_pc += 5
+            emit_instr("MVI", "C", "001H", comment="rel true right")
+        emit_instr("JMP", label2)
         emit_label(label1)
         if left:
-            g_code.append("MVI E,000H  ; rel false left")
+            emit_instr("MVI", "E", "000H", comment="rel false left")
         else:
-            g_code.append("MVI C,000H  ; rel false right")
-        g_pc += 2
+            emit_instr("MVI", "C", "000H", comment="rel false right")
         emit_label(label2)
         
     def collapse_left(self):
@@ -2329,51 +2984,46 @@ class EqualOp(BinaryOp):
         return 1
         
         
-class NotEqualOp(BinaryOp):
+class NotEqualOp(RelationOp):
+
+    relation = "<>"
     
     def _collapse_common(self, left):
-        global g_pc, g_code, g_sym_list
+        global g_sym_list
         label1 = new_label()
         label2 = new_label()
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("CMP E ; <>")
-            g_code.append("JZ %s ; =" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment="<>")
+            emit_instr("JZ", label1, comment="=")
         else:
             label3 = new_label()
             label4 = new_label()
             if leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
             elif rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,C")
-            g_code.append("CMP E  ; <>")
-            g_code.append("JZ %s  ; =" % label3)
-            g_code.append("JMP %s ; !=" % label4)
-            g_pc += 8
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment="<>")
+            emit_instr("JZ", label3, comment="=")
+            emit_instr("JMP", label4, comment="!=")
             emit_label(label3)
-            g_code.append("MOV A,B")
-            g_code.append("CMP D  ; <>")
-            g_code.append("JZ %s ; =" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "B")
+            emit_instr("CMP", "D", comment="<>")
+            emit_instr("JZ", label1, comment="=")
             emit_label(label4)
         if left:
-            g_code.append("MVI E,001H  ; rel true left")
+            emit_instr("MVI", "E", "001H", comment="rel true left")
         else:
-            g_code.append("MVI C,001H  ; rel true right")
-        g_code.append("JMP %s" % label2)
-        g_pc += 5
+            emit_instr("MVI", "C", "001H", comment="rel true right")
+        emit_instr("JMP", label2)
         emit_label(label1)
         if left:
-            g_code.append("MVI E,000H  ; rel false left")
+            emit_instr("MVI", "E", "000H", comment="rel false left")
         else:
-            g_code.append("MVI C,000H  ; rel false right")
-        g_pc += 2
+            emit_instr("MVI", "C", "000H", comment="rel false right")
         emit_label(label2)
         
     def collapse_left(self):
@@ -2385,53 +3035,48 @@ class NotEqualOp(BinaryOp):
         return 1
         
         
-class LessThanOp(BinaryOp):
+class LessThanOp(RelationOp):
+
+    relation = "<"
 
     def _collapse_common(self, left):
-        global g_pc, g_code, g_sym_list
+        global g_sym_list
         label1 = new_label()
         label2 = new_label()
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("CMP E  ; < ")
-            g_code.append("JC %s" % label1)
-            g_code.append("JZ %s" % label1)
-            g_pc += 8
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment="<")
+            emit_instr("JC", label1)
+            emit_instr("JZ", label1)
         else:
             label3 = new_label()
             label4 = new_label()
             if leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
             elif rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,D")
-            g_code.append("CMP B  ; <")
-            g_code.append("JZ %s   ; =" % label3)
-            g_code.append("JNC %s  ; >" % label1)
-            g_code.append("JMP %s  ; <" % label4)
-            g_pc += 11
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "D")
+            emit_instr("CMP", "B", comment="<")
+            emit_instr("JZ", label3, comment="=")
+            emit_instr("JNC", label1, comment=">")
+            emit_instr("JMP", label4, comment="<")
             emit_label(label3)
-            g_code.append("MOV A,E")
-            g_code.append("CMP C  ; <")
-            g_code.append("JNC %s ; >=" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "E")
+            emit_instr("CMP", "C", comment="<")
+            emit_instr("JNC", label1, comment=">=")
             emit_label(label4)
         if left:
-            g_code.append("MVI E,001H  ; rel true left")
+            emit_instr("MVI", "E", "001H", comment="rel true left")
         else:
-            g_code.append("MVI C,001H  ; rel true right")
-        g_code.append("JMP %s" % label2)
-        g_pc += 5
+            emit_instr("MVI", "C", "001H", comment="rel true right")
+        emit_instr("JMP", label2)
         emit_label(label1)
         if left:
-            g_code.append("MVI E,000H  ; rel false left")
+            emit_instr("MVI", "E", "000H", comment="rel false left")
         else:
-            g_code.append("MVI C,000H  ; rel false right")
-        g_pc += 2
+            emit_instr("MVI", "C", "000H", comment="rel false right")
         emit_label(label2)
         
     def collapse_left(self):
@@ -2443,53 +3088,48 @@ class LessThanOp(BinaryOp):
         return 1
         
         
-class GreaterThanOp(BinaryOp):
+class GreaterThanOp(RelationOp):
+
+    relation = ">"
 
     def _collapse_common(self, left):
-        global g_pc, g_code, g_sym_list
+        global g_sym_list
         label1 = new_label()
         label2 = new_label()
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("CMP E  ; > ")
-            g_code.append("JNC %s" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment=">")
+            emit_instr("JNC", label1)
         else:
             label3 = new_label()
             label4 = new_label()
             if leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
             elif rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,D")
-            g_code.append("CMP B   ; >")
-            g_code.append("JC %s   ; <" % label1)
-            g_code.append("JZ %s   ; =" % label3)
-            g_code.append("JMP %s  ; >" % label4)
-            g_pc += 11
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "D")
+            emit_instr("CMP", "B", comment=">")
+            emit_instr("JC", label1, comment="<")
+            emit_instr("JZ", label3, comment="=")
+            emit_instr("JMP", label4, comment=">")
             emit_label(label3)
-            g_code.append("MOV A,E")
-            g_code.append("CMP C  ; >")
-            g_code.append("JC %s  ; <" % label1)
-            g_code.append("JZ %s  ; =" % label1)
-            g_pc += 8
+            emit_instr("MOV", "A", "E")
+            emit_instr("CMP", "C", comment=">")
+            emit_instr("JC", label1, comment="<")
+            emit_instr("JZ", label1, comment="=")
             emit_label(label4)
         if left:
-            g_code.append("MVI E,001H  ; rel true left")
+            emit_instr("MVI", "E", "001H", comment="rel true left")
         else:
-            g_code.append("MVI C,001H  ; rel true right")
-        g_code.append("JMP %s" % label2)
-        g_pc += 5
+            emit_instr("MVI", "C", "001H", comment="rel true right")
+        emit_instr("JMP", label2)
         emit_label(label1)
         if left:
-            g_code.append("MVI E,000H  ; rel false left")
+            emit_instr("MVI", "E", "000H", comment="rel false left")
         else:
-            g_code.append("MVI C,000H  ; rel false right")
-        g_pc += 2
+            emit_instr("MVI", "C", "000H", comment="rel false right")
         emit_label(label2)
         
     def collapse_left(self):
@@ -2501,55 +3141,50 @@ class GreaterThanOp(BinaryOp):
         return 1
         
         
-class LessThanEqualOp(BinaryOp):
+class LessThanEqualOp(RelationOp):
+
+    relation = "<="
 
     def _collapse_common(self, left):
-        global g_pc, g_code, g_sym_list
+        global g_sym_list
         label1 = new_label()
         label2 = new_label()
         label3 = new_label()
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("CMP E   ; <=")
-            g_code.append("JC %s" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment="<=")
+            emit_instr("JC", label1)
             emit_label(label3)
         else:
             label3 = new_label()
             label4 = new_label()
             if leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
             elif rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,D")
-            g_code.append("CMP B  ; <=")
-            g_code.append("JZ %s ; =" % label3)
-            g_code.append("JNC %s  ; >" % label1)
-            g_code.append("JMP %s  ; <" % label4)
-            g_pc += 11
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "D")
+            emit_instr("CMP", "B", comment="<=")
+            emit_instr("JZ", label3, comment="=")
+            emit_instr("JNC", label1, comment=">")
+            emit_instr("JMP", label4, comment="<")
             emit_label(label3)
-            g_code.append("MOV A,E")
-            g_code.append("CMP C  ; <=")
-            g_code.append("JZ %s  ; =" % label4)
-            g_code.append("JNC %s  ; >" % label1)
-            g_pc += 8
+            emit_instr("MOV", "A", "E")
+            emit_instr("CMP", "C", comment="<=")
+            emit_instr("JZ", label4, comment="=")
+            emit_instr("JNC", label1, comment=">")
             emit_label(label4)
         if left:
-            g_code.append("MVI E,001H  ; rel true left")
+            emit_instr("MVI", "E", "001H", comment="rel true left")
         else:
-            g_code.append("MVI C,001H  ; rel true right")
-        g_code.append("JMP %s" % label2)
-        g_pc += 5
+            emit_instr("MVI", "C", "001H", comment="rel true right")
+        emit_instr("JMP", label2)
         emit_label(label1)
         if left:
-            g_code.append("MVI E,000H  ; rel false left")
+            emit_instr("MVI", "E", "000H", comment="rel false left")
         else:
-            g_code.append("MVI C,000H  ; rel false right")
-        g_pc += 2
+            emit_instr("MVI", "C", "000H", comment="rel false right")
         emit_label(label2)
         
     def collapse_left(self):
@@ -2561,53 +3196,48 @@ class LessThanEqualOp(BinaryOp):
         return 1
         
         
-class GreaterThanEqualOp(BinaryOp):
+class GreaterThanEqualOp(RelationOp):
+
+    relation = ">="
 
     def _collapse_common(self, left):
-        global g_pc, g_code, g_sym_list
+        global g_sym_list
         label1 = new_label()
         label2 = new_label()
         (leftWidth, rightWidth) = self.get_args()
         maxWidth = max(leftWidth, rightWidth)
         if maxWidth == 1:
-            g_code.append("MOV A,C")
-            g_code.append("CMP E  ; >= ")
-            g_code.append("JZ %s   ; = " % label3)
-            g_code.append("JNC %s" % label1)
-            g_pc += 8
+            emit_instr("MOV", "A", "C")
+            emit_instr("CMP", "E", comment=">=")
+            emit_instr("JZ", label3, comment="=")
+            emit_instr("JNC", label1)
         else:
             label3 = new_label()
             label4 = new_label()
             if leftWidth == 1:
-                g_code.append("MVI D,000H  ; zero pad MSB")
-                g_pc += 2
+                emit_instr("MVI", "D", "000H", comment="zero pad MSB")
             elif rightWidth == 1:
-                g_code.append("MVI B,000H  ; zero pad MSB")
-                g_pc += 2
-            g_code.append("MOV A,D")
-            g_code.append("CMP B  ; >=")
-            g_code.append("JZ %s  ; =" % label3)
-            g_code.append("JC %s  ; <" % label1)
-            g_code.append("JMP %s ; >" % label4)
-            g_pc += 11
+                emit_instr("MVI", "B", "000H", comment="zero pad MSB")
+            emit_instr("MOV", "A", "D")
+            emit_instr("CMP", "B", comment=">=")
+            emit_instr("JZ", label3, comment="=")
+            emit_instr("JC", label1, comment="<")
+            emit_instr("JMP", label4, comment=">")
             emit_label(label3)
-            g_code.append("MOV A,E")
-            g_code.append("CMP C  ; >=")
-            g_code.append("JC %s  ; <" % label1)
-            g_pc += 5
+            emit_instr("MOV", "A", "E")
+            emit_instr("CMP", "C", comment=">=")
+            emit_instr("JC", label1, comment="<")
             emit_label(label4)
         if left:
-            g_code.append("MVI E,001H  ; rel true left")
+            emit_instr("MVI", "E", "001H", comment="rel true left")
         else:
-            g_code.append("MVI C,001H  ; rel true right")
-        g_code.append("JMP %s" % label2)
-        g_pc += 5
+            emit_instr("MVI", "C", "001H", comment="rel true right")
+        emit_instr("JMP", label2)
         emit_label(label1)
         if left:
-            g_code.append("MVI E,000H  ; rel false left")
+            emit_instr("MVI", "E", "000H", comment="rel false left")
         else:
-            g_code.append("MVI C,000H  ; rel false right")
-        g_pc += 2
+            emit_instr("MVI", "C", "000H", comment="rel false right")
         emit_label(label2)
         
     def collapse_left(self):
@@ -2622,17 +3252,15 @@ class GreaterThanEqualOp(BinaryOp):
 class BoolOp(UnaryOp):
 
     def _collapse_common(self, left):
-        global g_pc, g_code
         width = self.get_arg(left)
         if width != 1:
             fatal("bool expression BYTE overflow")
-        g_code.append("MOV A,E")
-        g_code.append("ANI 001H  ; bool")
+        emit_instr("MOV", "A", "E")
+        emit_instr("ANI", "001H", comment="bool")
         if left:
-            g_code.append("MOV E,A   ; left to E")
+            emit_instr("MOV", "E", "A", comment="left to E")
         else:
-            g_code.append("MOV C,A   ; right to C")
-        g_pc += 4
+            emit_instr("MOV", "C", "A", comment="right to C")
         self.exit(left)
     
     def collapse_left(self):
@@ -2651,16 +3279,13 @@ class InplaceAssignOp(UnaryOp):
         self.name = name
         
     def _collapse_common(self, left):
-        global g_code, g_pc
         sym = lookup_sym(self.name)
         width = self.get_arg(left)
         assign_scalar(self.name, width, False, False)
         if not left:
-            g_code.append("MOV C,E  ; inp assign right")
-            g_pc += 1
+            emit_instr("MOV", "C", "E", comment="inp assign right")
             if width == 2:
-                g_code.append("MOV D,B")
-                g_pc += 1
+                emit_instr("MOV", "D", "B")
         self.exit(left)
         return sym.size
         
@@ -2671,6 +3296,242 @@ class InplaceAssignOp(UnaryOp):
         return self._collapse_common(False)
     
     
+def const_width(value):
+    """Get the register width of a constant"""
+    if value < 0x100:
+        return 1
+    return 2
+    
+    
+def node_width(node):
+    """Get the width of an expression node, or None if it is only known
+       after code generation"""
+    if isinstance(node, int):
+        return const_width(node)
+    sym = node[0]
+    if isinstance(sym, Array):
+        return sym.elem_size
+    if isinstance(sym, Variable) and not isinstance(sym, (Struct, Reference)):
+        if sym.name in g_flag_names:
+            return 1
+        return sym.size
+    if isinstance(sym, MultiplicationOp):
+        return 2
+    return None
+    
+    
+def fold_arg(node):
+    """Get the (value, width) of a constant expression node, or None"""
+    if isinstance(node, int):
+        return (node, const_width(node))
+    if not isinstance(node, tuple):
+        return None
+    op = node[0]
+    if isinstance(op, ProcCall1) and (op.name == "DOUBLE") and isinstance(op.arg1, int):
+        return (op.arg1, 2)
+    return None
+    
+    
+def make_const(value, width):
+    """Get a folded constant of the width of the expression it replaces.
+       A word constant below 100H is DOUBLE() of the byte constant."""
+    value &= (1 << (width * 8)) - 1
+    if const_width(value) != width:
+        return (ProcCall1("DOUBLE", value),)
+    return value
+    
+    
+def fold_builtin(op):
+    """Fold a builtin procedure call with constant arguments"""
+    sym = lookup_sym(op.name)
+    if not isinstance(sym, BuiltinProcedure):
+        return None
+    if isinstance(op, ProcCall1):
+        arg = op.arg1
+        if sym.name in ("LENGTH", "LAST"):
+            if (not isinstance(arg, tuple)) or (not isinstance(arg[0], Array)) or (len(arg) != 1):
+                return None
+            num = arg[0].size // arg[0].elem_size
+            if sym.name == "LAST":
+                if num == 0:
+                    return None
+                num -= 1
+            return num
+        if (not isinstance(arg, int)) or (arg < 0x100):
+            return None
+        if sym.name == "LOW":
+            return arg & 0xff
+        if sym.name == "HIGH":
+            return arg >> 8
+    elif isinstance(op, ProcCall2) and not isinstance(op, ProcCallExt):
+        (arg, count) = (op.arg1, op.arg2)
+        if not (isinstance(arg, int) and isinstance(count, int)):
+            return None
+        width = const_width(arg)
+        if sym.name == "SHL":
+            return make_const(arg << count, width)
+        if sym.name == "SHR":
+            return make_const(arg >> count, width)
+    return None
+    
+    
+def simplify(node):
+    """Fold constants and apply algebraic identities to an expression
+       node whose arguments are already simplified.  The result has the
+       same width as the node it replaces."""
+    if not (isinstance(node, tuple) and isinstance(node[0], Operator)):
+        return node
+    op = node[0]
+    if isinstance(op, (ProcCall1, ProcCall2)):
+        value = fold_builtin(op)
+        if value is None:
+            return node
+        return value
+    if isinstance(op, NotOp):
+        if isinstance(op.arg1, int) and (op.arg1 < 0x100):
+            return (~op.arg1) & 1
+        return node
+    if not isinstance(op, BinaryOp):
+        return node
+    (a, b) = (op.arg1, op.arg2)
+    
+    # both arguments constant
+    (constA, constB) = (fold_arg(a), fold_arg(b))
+    if (constA is not None) and (constB is not None):
+        ((a, widthA), (b, widthB)) = (constA, constB)
+        width = max(widthA, widthB)
+        value = None
+        if isinstance(op, AdditionOp):
+            value = make_const(a + b, width)
+        elif isinstance(op, SubtractionOp):
+            value = make_const(a - b, width)
+        # the width is the one the operator has at run time
+        elif isinstance(op, MultiplicationOp):
+            value = make_const(a * b, 2)
+        elif isinstance(op, DivisionOp) and (b != 0):
+            value = make_const(a // b, 2)
+        elif isinstance(op, ModOp) and (b != 0):
+            if power_of_two(b) is None:
+                widthA = 2
+            value = make_const(a % b, widthA)
+        elif isinstance(op, AndOp):
+            value = make_const(a & b, width)
+        elif isinstance(op, OrOp):
+            value = make_const(a | b, width)
+        elif isinstance(op, EqualOp):
+            value = int(a == b)
+        elif isinstance(op, NotEqualOp):
+            value = int(a != b)
+        elif isinstance(op, LessThanOp):
+            value = int(a < b)
+        elif isinstance(op, GreaterThanOp):
+            value = int(a > b)
+        elif isinstance(op, LessThanEqualOp):
+            value = int(a <= b)
+        elif isinstance(op, GreaterThanEqualOp):
+            value = int(a >= b)
+        if value is None:
+            return node
+        return value
+        
+    # identities, these must keep the width of the expression
+    if isinstance(op, AdditionOp):
+        if b == 0:
+            return a
+        if a == 0:
+            return b
+    elif isinstance(op, SubtractionOp):
+        if b == 0:
+            return a
+    elif isinstance(op, MultiplicationOp):
+        if isinstance(a, int):
+            # constant multiplier on the right
+            (a, b) = (b, a)
+            node = (MultiplicationOp(a, b),)
+        if (b == 1) and (node_width(a) == 2):
+            return a
+    elif isinstance(op, DivisionOp):
+        if (b == 1) and (node_width(a) == 2):
+            return a
+    elif isinstance(op, AndOp):
+        if (b == 0xff) and (node_width(a) == 1):
+            return a
+        if (a == 0xff) and (node_width(b) == 1):
+            return b
+    return node
+    
+    
+def has_side_effects(node):
+    """Check if evaluating an expression node can change program state"""
+    if isinstance(node, int) or (node is None):
+        return False
+    op = node[0]
+    if isinstance(op, (ProcCall0, ProcCallAddr, InplaceAssignOp)):
+        return True
+    if isinstance(op, (ProcCall1, ProcCall2)):
+        if not isinstance(lookup_sym(op.name), BuiltinProcedure):
+            return True
+    if isinstance(op, BinaryOp):
+        return has_side_effects(op.arg1) or has_side_effects(op.arg2)
+    if isinstance(op, UnaryOp):
+        return has_side_effects(op.arg1)
+    if (len(node) > 1) and not isinstance(node[1], str):
+        return has_side_effects(node[1])
+    return False
+    
+    
+def is_condition(node):
+    """Check if an expression node only has the values 0 and 1"""
+    if isinstance(node, int):
+        return False
+    op = node[0]
+    if isinstance(op, (RelationOp, BoolOp)):
+        return True
+    if isinstance(op, NotOp):
+        return is_condition(op.arg1)
+    if isinstance(op, (AndOp, OrOp)):
+        return is_condition(op.arg1) and is_condition(op.arg2)
+    return False
+    
+    
+def collapse_branch(node, label, sense):
+    """Generate code for a condition in a control flow context.  Jumps to
+       label if the condition is equal to sense (True or False), falls
+       through otherwise.  AND and OR of conditions are short circuit
+       when the right side has no side effects."""
+    if isinstance(node, int):
+        if ((node & 0xff) != 0) == sense:
+            emit_instr("JMP", label, comment="constant condition")
+        return
+    op = node[0]
+    if isinstance(op, RelationOp):
+        op.branch(label, sense)
+    elif isinstance(op, NotOp) and is_condition(op.arg1):
+        collapse_branch(op.arg1, label, not sense)
+    elif isinstance(op, (AndOp, OrOp)) and is_condition(node) and \
+         not has_side_effects(op.arg2):
+        if isinstance(op, AndOp) == sense:
+            # both sides must match sense
+            skip = new_label()
+            collapse_branch(op.arg1, skip, not sense)
+            collapse_branch(op.arg2, label, sense)
+            emit_label(skip)
+        else:
+            collapse_branch(op.arg1, label, sense)
+            collapse_branch(op.arg2, label, sense)
+    elif isinstance(op, BoolOp):
+        if collapse_left(op.arg1) != 1:
+            fatal("bool expression BYTE overflow")
+        emit_instr("MOV", "A", "E")
+        emit_instr("RRC", comment="bool")
+        emit_instr("JC" if sense else "JNC", label)
+    else:
+        collapse_left(node)
+        emit_instr("XRA", "A", comment="A = 0")
+        emit_instr("CMP", "E", comment="rel result")
+        emit_instr("JNZ" if sense else "JZ", label)
+    
+    
 def collapse_left(node):
     if isinstance(node, int):
         return collapse_const_left(node)
@@ -2690,14 +3551,11 @@ def collapse_right(node):
    
    
 def collapse_const_left(node):
-    global g_pc, g_code
     if node < 0x100:
-        g_code.append("MVI E,%03XH  ; load const left" % node)
-        g_pc += 2
+        emit_instr("MVI", "E", "%03XH" % node, comment="load const left")
         width = 1
     elif node < 0x10000:
-        g_code.append("LXI D,%05XH  ; load const left" % node)
-        g_pc += 3
+        emit_instr("LXI", "D", "%05XH" % node, comment="load const left")
         width = 2
     else:
         fatal("constant too large %d" % node)
@@ -2705,14 +3563,11 @@ def collapse_const_left(node):
         
         
 def collapse_const_right(node):
-    global g_pc, g_code
     if node < 0x100:
-        g_code.append("MVI C,%03XH  ; load const right" % node)
-        g_pc += 2
+        emit_instr("MVI", "C", "%03XH" % node, comment="load const right")
         width = 1
     elif node < 0x10000:
-        g_code.append("LXI B,%05XH  ; load const right" % node)
-        g_pc += 3
+        emit_instr("LXI", "B", "%05XH" % node, comment="load const right")
         width = 2
     else:
         fatal("constant too large %d" % node)
@@ -2720,7 +3575,7 @@ def collapse_const_right(node):
        
        
 def collapse_variable_left(node):
-    global g_pc, g_code, sg_flag_names
+    global sg_flag_names
     if isinstance(node[0], Array):
         width = collapse_array_left(node)
     elif isinstance(node[0], Reference):
@@ -2738,7 +3593,7 @@ def collapse_variable_left(node):
             if node.name in g_flag_names:
                 return collapse_flags_left(node)
             if isinstance(node, BasedVariable):
-                g_code.append("LHLD %s  ; load based left" % name)
+                emit_instr("LHLD", name, comment="load based left")
             else:
                 if isinstance(node, AtVariable):
                     if isinstance(node.addr, int):
@@ -2747,21 +3602,18 @@ def collapse_variable_left(node):
                         name = node.addr
                     if node.value > 0:
                         name += " + %05XH" % node.value
-                g_code.append("LXI H,%s  ; load var left" % name)
-            g_code.append("MOV E,M   ; to E")
-            g_pc += 4
+                emit_instr("LXI", "H", name, comment="load var left")
+            emit_instr("MOV", "E", "M", comment="to E")
         else:
             if node.name == "STACKPTR":
-                g_code.append("LXI H,00000H  ; load STACKPTR left")
-                g_code.append("DAD SP")
-                g_code.append("XCHG  ; to D,E")
-                g_pc += 5
+                emit_instr("LXI", "H", "00000H", comment="load STACKPTR left")
+                emit_instr("DAD", "SP")
+                emit_instr("XCHG", comment="to D,E")
             elif isinstance(node, BasedVariable):
-                g_code.append("LHLD %s  ; load based left" % name)
-                g_code.append("MOV E,M")
-                g_code.append("INX H")
-                g_code.append("MOV D,M  ; to D,E")
-                g_pc += 6
+                emit_instr("LHLD", name, comment="load based left")
+                emit_instr("MOV", "E", "M")
+                emit_instr("INX", "H")
+                emit_instr("MOV", "D", "M", comment="to D,E")
             else:
                 if isinstance(node, AtVariable):
                     if isinstance(node.addr, int):
@@ -2770,14 +3622,21 @@ def collapse_variable_left(node):
                         name = node.addr 
                     if node.value > 0:
                         name += " + %05XH" % node.value
-                g_code.append("LHLD %s ; load var left" % name)
-                g_code.append("XCHG    ; to D,E")
-                g_pc += 4
+                emit_instr("LHLD", name, comment="load var left")
+                emit_instr("XCHG", comment="to D,E")
     return width
     
     
+def loop_pointer(array, index):
+    """Get the pointer to an array element in a strength-reduced DO loop,
+       None if the index is not the loop variable"""
+    global g_loop_ptrs
+    if isinstance(index, tuple) and (len(index) == 1) and isinstance(index[0], Variable):
+        return g_loop_ptrs.get((array.name, index[0].name))
+    return None
+    
+    
 def collapse_array_left(node):
-    global g_pc, g_code
     index = node[1]
     node = node[0]
     elemWidth = node.elem_size
@@ -2785,38 +3644,36 @@ def collapse_array_left(node):
         numElement = node.size // elemWidth
         if (numElement != 0) and (index > (numElement - 1)):
             warning("array %s index %d overflow" % (node.name, index))
-    indexWidth = collapse_left(index)
-    if indexWidth == 1:
-        g_code.append("MVI D,000H  ; zero pad index MSB")
-        g_pc += 2
-    if isinstance(node, BasedArray):
-        g_code.append("LHLD %s  ; load arr based left" % node.addr)
+    ptr = loop_pointer(node, index)
+    if ptr is not None:
+        emit_instr("LHLD", ptr, comment="load arr DO pointer left")
     else:
-        if isinstance(node, AtArray):
-            if isinstance(node.addr, int):
-                name = "%05XH" % node.addr
-            else:
-                name = node.addr
+        indexWidth = collapse_left(index)
+        if indexWidth == 1:
+            emit_instr("MVI", "D", "000H", comment="zero pad index MSB")
+        if isinstance(node, BasedArray):
+            emit_instr("LHLD", node.addr, comment="load arr based left")
         else:
-            name = node.name
-        g_code.append("LXI H,%s  ; load arr left" % name)
-    g_pc += 3 
-    if elemWidth == 2:
-        g_code.append("XCHG")
-        g_code.append("DAD H  ; index << 1")
-        g_pc += 2
-    g_code.append("DAD D    ; arr offset")
-    g_code.append("MOV E,M  ; arr element to (D),E")
-    g_pc += 2
+            if isinstance(node, AtArray):
+                if isinstance(node.addr, int):
+                    name = "%05XH" % node.addr
+                else:
+                    name = node.addr
+            else:
+                name = node.name
+            emit_instr("LXI", "H", name, comment="load arr left")
+        if elemWidth == 2:
+            emit_instr("XCHG")
+            emit_instr("DAD", "H", comment="index << 1")
+        emit_instr("DAD", "D", comment="arr offset")
+    emit_instr("MOV", "E", "M", comment="arr element to (D),E")
     if elemWidth == 2:
-        g_code.append("INX H")
-        g_code.append("MOV D,M")
-        g_pc += 2
+        emit_instr("INX", "H")
+        emit_instr("MOV", "D", "M")
     return elemWidth
  
  
 def collapse_reference_left(node):
-    global g_pc, g_code
     index = node[1]
     node = node[0]
     sym = lookup_sym(node.name)
@@ -2827,77 +3684,82 @@ def collapse_reference_left(node):
     if index is None:
         if isinstance(sym, BasedArray):
             sym = lookup_sym(sym.addr)
-            g_code.append("LHLD %s  ; load ref right" % sym.name)
+            emit_instr("LHLD", sym.name, comment="load ref right")
         else:
-            g_code.append("LXI D,%s  ; load ref left" % name)
-        g_pc += 3
+            emit_instr("LXI", "D", name, comment="load ref left")
     else:
         elemWidth = sym.elem_size
         indexWidth = collapse_left(index)
         if indexWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
         if isinstance(sym, BasedArray):
             sym = lookup_sym(sym.addr)
-            g_code.append("LHLD %s  ; load ref right" % sym.name)
+            emit_instr("LHLD", sym.name, comment="load ref right")
         else:
-            g_code.append("LXI H,%s  ; load ref left" % name)
-        g_pc += 3 
+            emit_instr("LXI", "H", name, comment="load ref left")
         if elemWidth == 2:
-            g_code.append("XCHG")
-            g_code.append("DAD H  ; index << 1")
-            g_pc += 2
-        g_code.append("DAD D    ; ref offset")
-        g_code.append("XCHG     ; to D,E")
-        g_pc += 2
+            emit_instr("XCHG")
+            emit_instr("DAD", "H", comment="index << 1")
+        emit_instr("DAD", "D", comment="ref offset")
+        emit_instr("XCHG", comment="to D,E")
     return 2
   
   
+def index_struct(node, desc, lsb, msb):
+    """Load a struct item through an index register on the Z80, where
+       the item offset fits the signed displacement.  Returns False if
+       the item must be loaded through H,L."""
+    (offset, itemWidth) = desc
+    if (g_target != "z80") or (offset + itemWidth > 0x80):
+        return False
+    emit_instr("LIXD", node.addr, comment="load struct based")
+    emit_instr("LDX", lsb, "%03XH" % offset, comment="struct item")
+    if itemWidth == 2:
+        emit_instr("LDX", msb, "%03XH" % (offset + 1))
+    return True
+    
+    
 def collapse_struct_left(node):
-    global g_pc, g_code
     item = node[1]
     node = node[0]
     desc = node.value[item]
     itemWidth = desc[1]
-    g_code.append("LHLD %s  ; load struct based left" % node.addr)
-    g_code.append("LXI D,%05XH" % desc[0])
-    g_code.append("DAD D     ; struct offset")
-    g_code.append("MOV E,M   ; to (D),E")
-    g_pc += 8
+    if index_struct(node, desc, "E", "D"):
+        return itemWidth
+    emit_instr("LHLD", node.addr, comment="load struct based left")
+    emit_instr("LXI", "D", "%05XH" % desc[0])
+    emit_instr("DAD", "D", comment="struct offset")
+    emit_instr("MOV", "E", "M", comment="to (D),E")
     if itemWidth == 2:
-        g_code.append("INX H")
-        g_code.append("MOV D,M")
-        g_pc += 2
+        emit_instr("INX", "H")
+        emit_instr("MOV", "D", "M")
     return itemWidth
     
     
 def collapse_flags_left(node):
-    global g_pc, g_code
     #print("FLAGS", node.name)
     label1 = new_label()
     label2 = new_label()
     if node.name == "ZERO":
-        g_code.append("JNZ %s  ; ZERO" % label1)
+        emit_instr("JNZ", label1, comment="ZERO")
     elif node.name == "CARRY":
-        g_code.append("JNC %s  ; CARRY" % label1)
+        emit_instr("JNC", label1, comment="CARRY")
     elif node.name == "PARITY":
-        g_code.append("JPO %s  ; PARITY" % label1)
+        emit_instr("JPO", label1, comment="PARITY")
     elif node.name == "SIGN":
-        g_code.append("JP %s  ; SIGN" % label1)
+        emit_instr("JP", label1, comment="SIGN")
     else:
         fatal("flag %s not supported" % node.name)
-    g_code.append("MVI E,001H  ; flags true left")
-    g_code.append("JMP %s" % label2)
-    g_pc += 8
+    emit_instr("MVI", "E", "001H", comment="flags true left")
+    emit_instr("JMP", label2)
     emit_label(label1)
-    g_code.append("MVI E,000H  ; flags false left")
-    g_pc += 2
+    emit_instr("MVI", "E", "000H", comment="flags false left")
     emit_label(label2)
     return 1
      
      
 def collapse_variable_right(node):
-    global g_pc, g_code, g_flag_names
+    global g_flag_names
     if isinstance(node[0], Array):
         width = collapse_array_right(node)
     elif isinstance(node[0], Reference):
@@ -2915,7 +3777,7 @@ def collapse_variable_right(node):
             if node.name in g_flag_names:
                 return collapse_flags_right(node)
             if isinstance(node, BasedVariable):
-                g_code.append("LHLD %s  ; load based right")
+                emit_instr("LHLD", name, comment="load based right")
             else:
                 if isinstance(node, AtVariable):
                     if isinstance(node.addr, int):
@@ -2924,22 +3786,19 @@ def collapse_variable_right(node):
                         name = node.addr
                     if node.value > 0:
                         name += " + %05XH" % node.value
-                g_code.append("LXI H,%s  ; load var right" % name)
-            g_code.append("MOV C,M   ; to C")
-            g_pc += 4
+                emit_instr("LXI", "H", name, comment="load var right")
+            emit_instr("MOV", "C", "M", comment="to C")
         else:
             if node.name == "STACKPTR":
-                g_code.append("LXI H,00000H  ; load STACKPTR")
-                g_code.append("DAD SP")
-                g_code.append("MOV C,L")
-                g_code.append("MOV B,H ; to B,C")
-                g_pc += 6
+                emit_instr("LXI", "H", "00000H", comment="load STACKPTR")
+                emit_instr("DAD", "SP")
+                emit_instr("MOV", "C", "L")
+                emit_instr("MOV", "B", "H", comment="to B,C")
             elif isinstance(node, BasedVariable):
-                g_code.append("LHLD %s  ; load based right" % name)
-                g_code.append("MOV C,M")
-                g_code.append("INX H")
-                g_code.append("MOV B,M  ; to B,C")
-                g_pc += 6
+                emit_instr("LHLD", name, comment="load based right")
+                emit_instr("MOV", "C", "M")
+                emit_instr("INX", "H")
+                emit_instr("MOV", "B", "M", comment="to B,C")
             else:
                 if isinstance(node, AtVariable):
                     if isinstance(node.addr, int):
@@ -2948,15 +3807,13 @@ def collapse_variable_right(node):
                         name = node.addr 
                     if node.value > 0:
                         name += " + %05XH" % node.value
-                g_code.append("LHLD %s ; load var right" % name)
-                g_code.append("MOV C,L")
-                g_code.append("MOV B,H ; to B,C")
-                g_pc += 5
+                emit_instr("LHLD", name, comment="load var right")
+                emit_instr("MOV", "C", "L")
+                emit_instr("MOV", "B", "H", comment="to B,C")
     return width
   
   
 def collapse_array_right(node): 
-    global g_pc, g_code
     index = node[1]
     node = node[0]
     elemWidth = node.elem_size
@@ -2964,14 +3821,20 @@ def collapse_array_right(node):
         numElement = node.size // elemWidth
         if (numElement != 0) and (index > (numElement - 1)):
             warning("array %s index %d overflow" % (node.name, index))
-    g_code.append("PUSH D  ; save left array")
-    g_pc += 1
+    ptr = loop_pointer(node, index)
+    if ptr is not None:
+        emit_instr("LHLD", ptr, comment="load arr DO pointer right")
+        emit_instr("MOV", "C", "M", comment="arr element to (B),C")
+        if elemWidth == 2:
+            emit_instr("INX", "H")
+            emit_instr("MOV", "B", "M")
+        return elemWidth
+    emit_instr("PUSH", "D", comment="save left array")
     indexWidth = collapse_left(index)
     if indexWidth == 1:
-        g_code.append("MVI D,000H  ; zero pad index MSB")
-        g_pc += 2
+        emit_instr("MVI", "D", "000H", comment="zero pad index MSB")
     if isinstance(node, BasedArray):
-        g_code.append("LHLD %s  ; load arr based right" % node.addr)
+        emit_instr("LHLD", node.addr, comment="load arr based right")
     else:
         if isinstance(node, AtArray):
             if isinstance(node.addr, int):
@@ -2980,26 +3843,20 @@ def collapse_array_right(node):
                 name = node.addr
         else:
             name = node.name
-        g_code.append("LXI H,%s  ; load arr right" % name)
-    g_pc += 3 
+        emit_instr("LXI", "H", name, comment="load arr right")
     if elemWidth == 2:
-        g_code.append("XCHG")
-        g_code.append("DAD H  ; index << 1")
-        g_pc += 2
-    g_code.append("DAD D    ; arr offset")
-    g_code.append("MOV C,M  ; arr element to (B),C")
-    g_pc += 2
+        emit_instr("XCHG")
+        emit_instr("DAD", "H", comment="index << 1")
+    emit_instr("DAD", "D", comment="arr offset")
+    emit_instr("MOV", "C", "M", comment="arr element to (B),C")
     if elemWidth == 2:
-        g_code.append("INX H")
-        g_code.append("MOV B,M")
-        g_pc += 2
-    g_code.append("POP D  ; restore left array")
-    g_pc += 1
+        emit_instr("INX", "H")
+        emit_instr("MOV", "B", "M")
+    emit_instr("POP", "D", comment="restore left array")
     return elemWidth
     
     
 def collapse_reference_right(node):
-    global g_pc, g_code
     index = node[1]
     node = node[0]
     sym = lookup_sym(node.name)
@@ -3010,82 +3867,71 @@ def collapse_reference_right(node):
     if index is None:
         if isinstance(sym, BasedArray):
             sym = lookup_sym(sym.addr)
-            g_code.append("LHLD %s  ; load ref right" % sym.name)
+            emit_instr("LHLD", sym.name, comment="load ref right")
         else:
-            g_code.append("LXI B,%s  ; load ref right" % name)
-        g_pc += 3
+            emit_instr("LXI", "B", name, comment="load ref right")
     else:
         elemWidth = sym.elem_size
-        g_code.append("PUSH D  ; save left ref")
-        g_pc += 1
+        emit_instr("PUSH", "D", comment="save left ref")
         indexWidth = collapse_left(index)
         if indexWidth == 1:
-            g_code.append("MVI D,000H  ; zero pad MSB")
-            g_pc += 2
+            emit_instr("MVI", "D", "000H", comment="zero pad MSB")
         if isinstance(sym, BasedArray):
             sym = lookup_sym(sym.addr)
-            g_code.append("LHLD %s  ; load ref right" % sym.name)
+            emit_instr("LHLD", sym.name, comment="load ref right")
         else:
-            g_code.append("LXI H,%s  ; load ref right" % name)
-        g_pc += 3 
+            emit_instr("LXI", "H", name, comment="load ref right")
         if elemWidth == 2:
-            g_code.append("XCHG")
-            g_code.append("DAD H  ; index << 1")
-            g_pc += 2
-        g_code.append("DAD D    ; ref offset")
-        g_code.append("MOV C,L  ; to B,C")
-        g_code.append("MOV B,H")
-        g_code.append("POP D  ; restore left ref")
-        g_pc += 4
+            emit_instr("XCHG")
+            emit_instr("DAD", "H", comment="index << 1")
+        emit_instr("DAD", "D", comment="ref offset")
+        emit_instr("MOV", "C", "L", comment="to B,C")
+        emit_instr("MOV", "B", "H")
+        emit_instr("POP", "D", comment="restore left ref")
     return 2
     
 
 def collapse_struct_right(node):
-    global g_pc, g_code
     item = node[1]
     node = node[0]
     desc = node.value[item]
     itemWidth = desc[1]
-    g_code.append("LHLD %s  ; load struct based right" % node.addr)
-    g_code.append("LXI B,%05XH" % desc[0])
-    g_code.append("DAD B     ; struct offset")
-    g_code.append("MOV C,M   ; to (B),C")
-    g_pc += 8
+    if index_struct(node, desc, "C", "B"):
+        return itemWidth
+    emit_instr("LHLD", node.addr, comment="load struct based right")
+    emit_instr("LXI", "B", "%05XH" % desc[0])
+    emit_instr("DAD", "B", comment="struct offset")
+    emit_instr("MOV", "C", "M", comment="to (B),C")
     if itemWidth == 2:
-        g_code.append("INX H")
-        g_code.append("MOV B,M")
-        g_pc += 2
+        emit_instr("INX", "H")
+        emit_instr("MOV", "B", "M")
     return itemWidth
     
     
 def collapse_flags_right(node):
-    global g_pc, g_code
     #print("FLAGS", node.name)
     label1 = new_label()
     label2 = new_label()
     if node.name == "ZERO":
-        g_code.append("JNZ %s  ; ZERO" % label1)
+        emit_instr("JNZ", label1, comment="ZERO")
     elif node.name == "CARRY":
-        g_code.append("JNC %s  ; CARRY" % label1)
+        emit_instr("JNC", label1, comment="CARRY")
     elif node.name == "PARITY":
-        g_code.append("JPO %s  ; PARITY" % label1)
+        emit_instr("JPO", label1, comment="PARITY")
     elif node.name == "SIGN":
-        g_code.append("JP %s  ; SIGN" % label1)
+        emit_instr("JP", label1, comment="SIGN")
     else:
         fatal("flag %s not supported" % node.name)
-    g_code.append("MVI C,001H  ; flags true right")
-    g_code.append("JMP %s" % label2)
-    g_pc += 8
+    emit_instr("MVI", "C", "001H", comment="flags true right")
+    emit_instr("JMP", label2)
     emit_label(label1)
-    g_code.append("MVI C,000H  ; flags false right")
-    g_pc += 2
+    emit_instr("MVI", "C", "000H", comment="flags false right")
     emit_label(label2)
     return 1
     
     
 def builtin_length(node, left):
     """Generate code for builtin LENGTH() procedure"""
-    global g_code, g_pc
     #print("LENGTH: %s" % node)
     sym = node.arg1[0]
     if not isinstance(sym, Array):
@@ -3097,21 +3943,19 @@ def builtin_length(node, left):
         width = 1
     if width == 1:
         if left:
-            g_code.append("MVI E,%03XH  ; LENGTH low left" % numElem)
+            emit_instr("MVI", "E", "%03XH" % numElem, comment="LENGTH low left")
         else:
-            g_code.append("MVI C,%03XH  ; LENGTH low right" % numElem)
-        g_pc += 2
+            emit_instr("MVI", "C", "%03XH" % numElem, comment="LENGTH low right")
     else:
         if left:
-            g_code.append("LXI D,%05XH  ; LENGTH high left" % numElem)
+            emit_instr("LXI", "D", "%05XH" % numElem, comment="LENGTH high left")
         else:
-            g_code.append("LXI B,%05XH  ; LENGTH high right" % numElem)
+            emit_instr("LXI", "B", "%05XH" % numElem, comment="LENGTH high right")
     return width
     
     
 def builtin_last(node, left):
     """Generate code for builtin LAST() procedure"""
-    global g_code, g_pc
     #print("LAST:", node)
     sym = node.arg1[0]
     if not isinstance(sym, Array):
@@ -3125,261 +3969,970 @@ def builtin_last(node, left):
         width = 1
     if width == 1:
         if left:
-            g_code.append("MVI E,%03XH  ; LAST low left" % index)
+            emit_instr("MVI", "E", "%03XH" % index, comment="LAST low left")
         else:
-            g_code.append("MVI C,%03XH  ; LAST low right" % index)
-        g_pc += 2
+            emit_instr("MVI", "C", "%03XH" % index, comment="LAST low right")
     else:
         if left:
-            g_code.append("LXI D,%05XH  ; LAST high left" % index)
+            emit_instr("LXI", "D", "%05XH" % index, comment="LAST high left")
         else:
-            g_code.append("LXI B,%05XH  ; LAST high right" % index)
-        g_pc += 3
+            emit_instr("LXI", "B", "%05XH" % index, comment="LAST high right")
     return width
     
     
 def builtin_low(node, left):
     """Generate code for builtin LOW() procedure"""
-    global g_pc, g_code
     #print("LOW: %s" % node)
     width = node.get_arg(left)
     if width != 2:
         fatal("LOW argument not ADDRESS");
     if not left:
-        g_code.append("MOV C,E  ; LOW right")
-        g_pc += 1
+        emit_instr("MOV", "C", "E", comment="LOW right")
     node.exit(left)
     return 1
     
     
 def builtin_high(node, left):
     """Generate code for builtin HIGH() procedure"""
-    global g_pc, g_code
     #print("HIGH: %s" % node)
     width = node.get_arg(left)
     if width != 2:
         fatal("HIGH argument not ADDRESS");
     if left:
-        g_code.append("MOV E,D  ; HIGH left")
+        emit_instr("MOV", "E", "D", comment="HIGH left")
     else:
-        g_code.append("MOV C,D  ; HIGH right")
-    g_pc += 1
+        emit_instr("MOV", "C", "D", comment="HIGH right")
     node.exit(left)
     return 1
     
     
 def builtin_double(node, left):
     """Generate code for builtin DOUBLE() procedure"""
-    global g_pc, g_code
     width = node.get_arg(left)
     if width != 1:
         fatal("DOUBLE argument not BYTE");
     if left:
-        g_code.append("MVI D,000H  ; DOUBLE left")
-        g_pc += 2
+        emit_instr("MVI", "D", "000H", comment="DOUBLE left")
     else:
-        g_code.append("MOV C,E")
-        g_code.append("MVI B,000H  ; DOUBLE right")
-        g_pc += 3
+        emit_instr("MOV", "C", "E")
+        emit_instr("MVI", "B", "000H", comment="DOUBLE right")
     node.exit(left)
     return 2
     
     
+def builtin_shift(node, name, width):
+    """Get the value and count arguments of a shift or rotate builtin.
+       A constant count is returned as an int and not loaded, otherwise
+       the count is in C and None is returned."""
+    if isinstance(node.arg2, int):
+        count = node.arg2
+        leftWidth = collapse_left(node.arg1)
+        rightWidth = const_width(count)
+    else:
+        count = None
+        (leftWidth, rightWidth) = node.get_args()
+    if (rightWidth != 1) or (leftWidth > width):
+        warning("%s arg overflow" % name)
+    return (leftWidth, count)
+    
+    
 def builtin_shr(node, left):
-    """Generate code for builtin SHR() procedure"""
-    global g_pc, g_code
+    """Generate code for builtin SHR() procedure.  A constant count is
+       unrolled, a variable count calls __SHR8 or __SHR16."""
     #print("SHR:", left)
-    (leftWidth, rightWidth) = node.get_args()
-    if rightWidth != 1:
-        warning("SHR arg 2 overflow")
-    label1 = new_label()
-    emit_label(label1)
-    g_code.append("ORA A  ; clear carry")
-    g_pc += 1
-    if leftWidth == 2:
-        g_code.append("MOV A,D")
-        g_code.append("RAR")
-        g_code.append("MOV D,A")
-        g_pc += 3
-    g_code.append("MOV A,E")
-    g_code.append("RAR  ; SHR")
-    g_code.append("MOV E,A")
-    g_code.append("DCR C")
-    g_code.append("JNZ %s  ; more SHR" % label1)
-    g_pc += 7
+    (leftWidth, count) = builtin_shift(node, "SHR", 2)
+    if count is None:
+        emit_instr("CALL", use_runtime("__SHR%d" % (leftWidth * 8)), comment="SHR")
+    else:
+        shift_right_const(leftWidth, count)
     if not left:
-        g_code.append("MOV C,E  ; SHR right")
-        g_pc += 1
-        if leftWidth == 2:
-            g_code.append("MOV D,B")
-            g_pc += 1
+        result_right(leftWidth)
     return leftWidth
     
     
 def builtin_shl(node, left):
-    """Generate code for builtin SHL() procedure"""
-    global g_pc, g_code
+    """Generate code for builtin SHL() procedure.  A constant count is
+       unrolled, a variable count calls __SHL8 or __SHL16."""
     #print("SHL:", left)
-    (leftWidth, rightWidth) = node.get_args()
-    if rightWidth != 1:
-        warning("SHL arg 2 overflow")
-    label1 = new_label()
-    emit_label(label1)
-    g_code.append("ORA A  ; clear carry")
-    g_code.append("MOV A,E")
-    g_code.append("RAL  ; SHL")
-    g_code.append("MOV E,A")
-    g_pc += 4
-    if leftWidth == 2:
-        g_code.append("MOV A,D")
-        g_code.append("RAL")
-        g_code.append("MOV D,A")
-        g_pc += 3
-    g_code.append("DCR C")
-    g_code.append("JNZ %s  ; more SHL" % label1)
-    g_pc += 4
+    (leftWidth, count) = builtin_shift(node, "SHL", 2)
+    if count is None:
+        emit_instr("CALL", use_runtime("__SHL%d" % (leftWidth * 8)), comment="SHL")
+    else:
+        shift_left_const(leftWidth, count)
     if not left:
-        g_code.append("MOV C,E  ; SHL right")
-        g_pc += 1
-        if leftWidth == 2:
-            g_code.append("MOV D,B")
-            g_pc += 1
+        result_right(leftWidth)
     return leftWidth
     
     
 def builtin_ror(node, left):
-    """Generate code for builtin ROR() procedure"""
-    global g_pc, g_code
+    """Generate code for builtin ROR() procedure.  A constant count is
+       unrolled, a variable count calls __ROR8."""
     #print("ROR:", left)
-    (leftWidth, rightWidth) = node.get_args()
-    if (leftWidth != 1) or (rightWidth != 1):
-        fatal("SHL arg overflow")
-    label1 = new_label()
-    emit_label(label1)
-    g_code.append("MOV A,E")
-    g_code.append("RRC  ; ROR")
-    g_code.append("MOV E,A")
-    g_code.append("DCR C")
-    g_code.append("JNZ %s  ; more ROR" % label1)
-    g_pc += 7
+    (leftWidth, count) = builtin_shift(node, "ROR", 1)
+    if leftWidth != 1:
+        fatal("ROR arg overflow")
+    if count is None:
+        emit_instr("CALL", use_runtime("__ROR8"), comment="ROR")
+    elif (count & 7) != 0:
+        emit_instr("MOV", "A", "E")
+        rotate_right_a(count)
+        emit_instr("MOV", "E", "A", comment="ROR %d" % count)
     if not left:
-        g_code.append("MOV C,E  ; ROR right")
-        g_pc += 1
+        result_right(1)
     return 1
     
     
 def builtin_rol(node, left):
-    """Generate code for builtin ROL() procedure"""
-    global g_pc, g_code
+    """Generate code for builtin ROL() procedure.  A constant count is
+       unrolled, a variable count calls __ROL8."""
     #print("ROL:", left)
-    (leftWidth, rightWidth) = node.get_args()
-    if (leftWidth != 1) or (rightWidth != 1):
-        warning("ROL arg overflow")
-    label1 = new_label()
-    emit_label(label1)
-    g_code.append("MOV A,E")
-    g_code.append("RLC  ; ROL")
-    g_code.append("MOV E,A")
-    g_code.append("DCR C")
-    g_code.append("JNZ %s  ; more ROL" % label1)
-    g_pc += 7
+    (leftWidth, count) = builtin_shift(node, "ROL", 1)
+    if count is None:
+        emit_instr("CALL", use_runtime("__ROL8"), comment="ROL")
+    elif (count & 7) != 0:
+        emit_instr("MOV", "A", "E")
+        rotate_right_a(8 - (count & 7))
+        emit_instr("MOV", "E", "A", comment="ROL %d" % count)
     if not left:
-        g_code.append("MOV C,E  ; ROL right")
-        g_pc += 1
+        result_right(1)
     return 1
     
     
-def pop2(idx, removeSize):
-    """Remove two instructions"""
-    global g_pc, g_code
-    g_code.pop(idx + 1)
-    g_code.pop(idx)
-    g_pc -= removeSize
+g_peep_rules = {}
+g_peep_window = 1
+
+
+def peephole(name, pattern, removeSize):
+    """Register a peephole rule.  removeSize is the number of code bytes
+       saved each time the rule fires."""
+    def register(handler):
+        global g_peep_rules, g_peep_window
+        rule = PeepholeRule(name, pattern, handler, removeSize)
+        g_peep_rules.setdefault(rule.pattern[0][0], []).append(rule)
+        g_peep_window = max(g_peep_window, len(rule.pattern))
+        return handler
+    return register
     
     
-def replace2(idx, newLine, removeSize):
-    """Replace two instructions with one"""
-    global g_pc, g_code
-    g_code.pop(idx + 1)
-    g_code.pop(idx)
-    g_code.insert(idx, newLine)
-    g_pc -= removeSize
-    
-    
-def opt0():
-    global g_code
-    for n in range(len(g_code) - 1):
-        thisn = strip_comment(g_code[n])
-        nextn = strip_comment(g_code[n+1])
-        if (thisn == 'XCHG') and (nextn == 'XCHG'):
-            print("opt: XCHG")
-            pop2(n, 2)
-            return True
-        elif (thisn == 'MOV C,M') and (nextn == 'MOV A,C'):
-            print("opt: MOVMCA")
-            replace2(n, "MOV A,M  ; OPT MOVMCA", 1)
-            return True
-    return False
+@peephole("XCHG", ("XCHG", "XCHG"), 2)
+def opt_xchg(code):
+    return []
+    
+    
+@peephole("MOVMCA", ("MOV C,M", "MOV A,C"), 1)
+def opt_movmca(code):
+    return [Instr("MOV", "A", "M", "OPT MOVMCA")]
+    
+    
+@peephole("MVIED", ("MVI E,*", "MVI D,*"), 1)
+def opt_mvied(code):
+    low = int(code[0].arg2.rstrip('H'), 16)
+    high = int(code[1].arg2.rstrip('H'), 16)
+    return [Instr("LXI", "D", "%05XH" % ((high << 8) + low), "OPT MVIED")]
+    
+    
+@peephole("MVICB", ("MVI C,*", "MVI B,*"), 1)
+def opt_mvicb(code):
+    low = int(code[0].arg2.rstrip('H'), 16)
+    high = int(code[1].arg2.rstrip('H'), 16)
+    return [Instr("LXI", "B", "%05XH" % ((high << 8) + low), "OPT MVICB")]
+    
     
+@peephole("MVICA", ("MVI C,*", "MOV A,C"), 1)
+def opt_mvica(code):
+    val = int(code[0].arg2.rstrip('H'), 16)
+    return [Instr("MVI", "A", "%03XH" % val, "OPT MVICA")]
     
-def opt1():
-    global g_code
-    for n in range(len(g_code) - 1):
-        thisn = strip_arg2(g_code[n])
-        nextn = strip_arg2(g_code[n+1])
-        if (thisn == "MVI E") and (nextn == "MVI D"):
-            print("opt: MVIED")
-            low = int(get_arg2(g_code[n]).rstrip('H'), 16)
-            high = int(get_arg2(g_code[n+1]).rstrip('H'), 16)
-            replace2(n, "LXI D,%05XH  ; OPT MVIED" % ((high << 8) + low), 1)
+    
+@peephole("CALLRET", ("CALL *", "RET"), 1)
+def opt_callret(code):
+    return [Instr("JMP", code[0].arg1, comment="OPT CALLRET")]
+    
+    
+def rule_savings(old, new, executed = True):
+    """Get the (bytes, cycles) saved by replacing the instructions old
+       with new.  No cycles are saved by code which is never executed."""
+    size = 0
+    cycles = 0
+    for instr in old:
+        size += instr.size
+        cycles += instr_cycles(instr)
+    for instr in new:
+        size -= instr.size
+        cycles -= instr_cycles(instr)
+    if not executed:
+        cycles = 0
+    return (size, cycles)
+    
+    
+def count_rule(rule, block, old, new = (), extra = 0, executed = True):
+    """Record a hit of a whole program optimization in block, which
+       replaced the instructions old with new.  extra are T-states saved
+       elsewhere, such as by a jump which is no longer taken."""
+    if g_stats is not None:
+        (size, cycles) = rule_savings(old, new, executed)
+        if executed:
+            cycles += extra
+        g_stats.rules.add(rule, block.proc, size, cycles)
+        
+        
+def optimize():
+    """Perform peephole optimization on a code block.  The block is
+       scanned once; after a rewrite only the window around the rewrite
+       site is checked again."""
+    global g_pc, g_code, g_peep_rules, g_peep_window
+    n = 0
+    while n < len(g_code):
+        for rule in g_peep_rules.get(g_code[n].op, ()):
+            if not rule.match(g_code, n):
+                continue
+            end = n + len(rule.pattern)
+            newCode = rule.handler(g_code[n:end])
+            if newCode is None:
+                continue
+            log(DEBUG, "opt", "opt: %s", rule.name)
+            if g_stats is not None:
+                g_block_hits.append((rule.name,) + rule_savings(g_code[n:end], newCode))
+            for instr in g_code[n:end]:
+                g_pc -= instr.size
+            for instr in newCode:
+                g_pc += instr.size
+            g_code[n:end] = newCode
+            n = max(0, n - g_peep_window + 1)
+            break
+        else:
+            n += 1
+
+
+g_reg_pairs = {"B" : ("B", "C"), "D" : ("D", "E"), "H" : ("H", "L")}
+g_cond_ops = set(("JNZ", "JZ", "JNC", "JC", "JPO", "JPE", "JP", "JM",
+                  "RNZ", "RZ", "RNC", "RC", "RPO", "RPE", "RP", "RM"))
+g_alu_ops = set(("ADD", "ADC", "SUB", "SBB", "ANA", "XRA", "ORA",
+                 "ADI", "ACI", "SUI", "SBI", "ANI", "XRI", "ORI",
+                 "RLC", "RRC", "RAL", "RAR", "CMA", "DAA", "IN"))
+g_nop_ops = set(("CMP", "CPI", "PUSH", "SPHL", "STC", "CMC", "NOP",
+                 "EI", "DI", "OUT"))
+
+
+def parse_number(s):
+    """Get the value of a number operand, None if not a number"""
+    try:
+        if s.endswith('H'):
+            return int(s[:-1], 16)
+        return int(s)
+    except ValueError:
+        return None
+
+
+def parse_address(arg):
+    """Split an address operand such as "X + 00002H" into a (name, offset)
+       tuple.  The name is None for an absolute address.  Returns None if
+       the operand is not understood."""
+    parts = arg.split('+')
+    base = parts[0].strip()
+    offset = 0
+    for part in parts[1:]:
+        n = parse_number(part.strip())
+        if n is None:
+            return None
+        offset += n
+    if base[:1].isdigit():
+        n = parse_number(base)
+        if n is None:
+            return None
+        return (None, n + offset)
+    if (len(base) == 0) or not (base.replace('_', 'A').isalnum()):
+        return None
+    return (base, offset)
+
+
+class RegisterTracker(object):
+    """The values held in registers and memory within a basic block.
+       A value is a ("#", n) constant, the low ("<") or high (">") byte
+       of a (name, offset) address, or a number standing for a value
+       which is not known but is the same wherever it appears.  Memory
+       is only tracked at named addresses.  plain is the set of data
+       names which no other name can alias."""
+
+    def __init__(self, plain):
+        self.plain = plain
+        self.fresh = 0
+        self.flush()
+
+    def flush(self):
+        """Forget everything, at a label or a call"""
+        self.regs = {}
+        self.mem = {}
+
+    def value(self, reg):
+        """Get the value in a register, which is given a new value if
+           not known"""
+        v = self.regs.get(reg)
+        if v is None:
+            self.fresh += 1
+            v = self.regs[reg] = self.fresh
+        return v
+
+    def cell(self, key):
+        """Get the value of a memory byte, which is given a new value
+           if not known"""
+        v = self.mem.get(key)
+        if v is None:
+            self.fresh += 1
+            v = self.mem[key] = self.fresh
+        return v
+
+    def set(self, reg, v):
+        if v is None:
+            self.regs.pop(reg, None)
+        else:
+            self.regs[reg] = v
+
+    def same(self, reg, v):
+        return (v is not None) and (self.regs.get(reg) == v)
+
+    def address(self, pair):
+        """Get the memory key of the address in a register pair, None
+           if not a named address"""
+        (hi, lo) = g_reg_pairs[pair]
+        vh = self.regs.get(hi)
+        vl = self.regs.get(lo)
+        if isinstance(vl, tuple) and (vl[0] == "<") and (vh == (">",) + vl[1:]):
+            return vl[1:]
+        return None
+
+    def operand(self, arg):
+        """Get the memory key of a direct address operand"""
+        addr = parse_address(arg)
+        if (addr is None) or (addr[0] is None):
+            return None
+        return addr
+
+    def clobber(self, key):
+        """Forget memory which a store to key may change"""
+        if (key is not None) and (key[0] in self.plain):
+            name = key[0]
+            self.mem = dict((k, v) for (k, v) in self.mem.items()
+                            if (k[0] != name) and (k[0] in self.plain))
+        else:
+            self.mem.clear()
+
+    def load(self, reg, key):
+        if key is None:
+            self.set(reg, None)
+            return False
+        v = self.cell(key)
+        if self.same(reg, v):
             return True
-        elif (thisn == "MVI C") and (nextn == "MVI B"):
-            print("opt: MVICB")
-            low = int(get_arg2(g_code[n]).rstrip('H'), 16)
-            high = int(get_arg2(g_code[n+1]).rstrip('H'), 16)
-            replace2(n, "LXI B,%05XH  ; OPT MVICB" % ((high << 8) + low), 1)
+        self.set(reg, v)
+        return False
+
+    def store(self, key, v):
+        if (key is not None) and (self.mem.get(key) == v):
             return True
-        elif (thisn == "MVI C") and (nextn == "MOV A"):
-            reg = get_arg2(g_code[n+1])
-            if reg == 'C':
-                print("opt: MVICA")
-                val = int(get_arg2(g_code[n]).rstrip('H'), 16)
-                replace2(n, "MVI A,%03XH  ; OPT MVICA" % val, 1)
+        self.clobber(key)
+        if key is not None:
+            self.mem[key] = v
+        return False
+
+    def load_pair(self, pair, arg):
+        (hi, lo) = g_reg_pairs[pair]
+        addr = parse_address(arg)
+        if addr is None:
+            (vh, vl) = (None, None)
+        elif addr[0] is None:
+            (vh, vl) = (("#", (addr[1] >> 8) & 0xff), ("#", addr[1] & 0xff))
+        else:
+            (vh, vl) = ((">",) + addr, ("<",) + addr)
+        if self.same(hi, vh) and self.same(lo, vl):
+            return True
+        self.set(hi, vh)
+        self.set(lo, vl)
+        return False
+
+    def step_pair(self, pair, delta):
+        """Update a register pair for INX or DCX"""
+        (hi, lo) = g_reg_pairs[pair]
+        vh = self.regs.get(hi)
+        vl = self.regs.get(lo)
+        key = self.address(pair)
+        if key is not None:
+            key = (key[0], key[1] + delta)
+            (vh, vl) = ((">",) + key, ("<",) + key)
+        elif isinstance(vh, tuple) and (vh[0] == "#") and isinstance(vl, tuple) and (vl[0] == "#"):
+            n = (((vh[1] << 8) + vl[1]) + delta) & 0xffff
+            (vh, vl) = (("#", n >> 8), ("#", n & 0xff))
+        else:
+            (vh, vl) = (None, None)
+        self.set(hi, vh)
+        self.set(lo, vl)
+
+    def step(self, instr):
+        """Update the state for an instruction.  Returns True if the
+           instruction only loads or stores a value already in place
+           and can be removed."""
+        op = instr.op
+        arg1 = instr.arg1
+        arg2 = instr.arg2
+        if op == "MOV":
+            if arg2 == "M":
+                return self.load(arg1, self.address("H"))
+            v = self.value(arg2)
+            if arg1 == "M":
+                return self.store(self.address("H"), v)
+            if self.same(arg1, v):
                 return True
-    return False
-    
-    
-def opt2():
-    global g_code
-    for n in range(len(g_code) - 1):
-        thisn = get_instr(g_code[n])
-        nextn = get_instr(g_code[n+1])
-        if (thisn == "CALL")  and (nextn == "RET"):
-                print("opt: CALLRET")
-                addr = get_arg1(g_code[n])
-                replace2(n, "JMP %s  ; OPT CALLRET" % addr, 1)
+            self.set(arg1, v)
+        elif op == "MVI":
+            n = parse_number(arg2)
+            v = None if n is None else ("#", n)
+            if arg1 == "M":
+                if v is None:
+                    self.clobber(self.address("H"))
+                    return False
+                return self.store(self.address("H"), v)
+            if self.same(arg1, v):
                 return True
-    return False
+            self.set(arg1, v)
+        elif op == "LXI":
+            if arg1 != "SP":
+                return self.load_pair(arg1, arg2)
+        elif op == "LDA":
+            return self.load("A", self.operand(arg1))
+        elif op == "STA":
+            return self.store(self.operand(arg1), self.value("A"))
+        elif op == "LDAX":
+            return self.load("A", self.address(arg1))
+        elif op == "STAX":
+            return self.store(self.address(arg1), self.value("A"))
+        elif op == "LHLD":
+            key = self.operand(arg1)
+            if key is None:
+                self.set("H", None)
+                self.set("L", None)
+                return False
+            vl = self.cell(key)
+            vh = self.cell((key[0], key[1] + 1))
+            if self.same("H", vh) and self.same("L", vl):
+                return True
+            self.set("H", vh)
+            self.set("L", vl)
+        elif op == "SHLD":
+            key = self.operand(arg1)
+            vl = self.value("L")
+            vh = self.value("H")
+            if key is None:
+                self.mem.clear()
+                return False
+            keyh = (key[0], key[1] + 1)
+            if (self.mem.get(key) == vl) and (self.mem.get(keyh) == vh):
+                return True
+            self.clobber(key)
+            self.mem[key] = vl
+            self.mem[keyh] = vh
+        elif op == "XCHG":
+            (d, e, h, l) = [self.regs.get(r) for r in ("D", "E", "H", "L")]
+            self.set("D", h)
+            self.set("E", l)
+            self.set("H", d)
+            self.set("L", e)
+        elif op in ("INX", "DCX"):
+            if arg1 != "SP":
+                self.step_pair(arg1, 1 if op == "INX" else -1)
+        elif op in ("INR", "DCR"):
+            if arg1 == "M":
+                self.clobber(self.address("H"))
+            else:
+                v = self.regs.get(arg1)
+                if isinstance(v, tuple) and (v[0] == "#"):
+                    v = ("#", (v[1] + (1 if op == "INR" else -1)) & 0xff)
+                else:
+                    v = None
+                self.set(arg1, v)
+        elif op in ("DAD", "XTHL"):
+            self.set("H", None)
+            self.set("L", None)
+        elif op == "POP":
+            if arg1 == "PSW":
+                self.set("A", None)
+            else:
+                for reg in g_reg_pairs[arg1]:
+                    self.set(reg, None)
+        elif op in g_alu_ops:
+            if (op in ("ANA", "ORA")) and (arg1 == "A"):
+                pass
+            elif (op in ("XRA", "SUB")) and (arg1 == "A"):
+                self.set("A", ("#", 0))
+            else:
+                self.set("A", None)
+        elif (op in g_nop_ops) or (op in g_cond_ops):
+            pass
+        else:
+            # jumps, calls and anything else end the block
+            self.flush()
+        return False
+
+
+def plain_names():
+    """Get the names of the allocated data which cannot be reached
+       through any other name"""
+    global g_sym_list, g_uni_list, g_pseudo_count
+    plain = set()
+    aliased = set()
+    for sym in g_sym_list[g_pseudo_count:] + g_uni_list:
+        if isinstance(sym, (AtVariable, AtArray)):
+            if isinstance(sym.addr, str):
+                addr = parse_address(sym.addr)
+                aliased.add(sym.addr if addr is None else addr[0])
+        elif isinstance(sym, (BasedVariable, BasedArray, BasedStruct)):
+            continue
+        elif isinstance(sym, Variable):
+            plain.add(sym.name)
+    return plain - aliased
+
+
+g_jump_ops = set(("JMP", "RET", "PCHL"))
+g_name_re = re.compile(r"[A-Z_?@][A-Z0-9_?@$]*")
+
+
+def external_names(externName):
+    """Get the names used by the external assembly file"""
+    if externName is None:
+        return set()
+    extFile = open(externName, "rt")
+    names = set(g_name_re.findall(extFile.read().upper()))
+    extFile.close()
+    return names
+
+
+def code_roots(externName):
+    """Get the names of the labels where the program can be entered: the
+       start procedure, the first top level statement, and any label used
+       by the external code or by data"""
+    global g_sym_list, g_pseudo_count, g_entry, g_top_start, g_symtab
+    roots = external_names(externName)
+    for sym in g_sym_list[g_pseudo_count:]:
+        if isinstance(sym, Variable) and isinstance(sym.value, Reference):
+            roots.add(sym.value.name)
+    starts = []
+    if g_top_start is not None:
+        # labels of the first statement come before its code
+        n = g_top_start
+        while (n > g_pseudo_count) and isinstance(g_sym_list[n - 1], Label):
+            n -= 1
+        starts.append(n - g_pseudo_count)
+    if g_entry is not None:
+        roots.add(g_entry)
+    elif g_top_start is None:
+        # a module of procedures only
+        for proc in g_symtab.procs.values():
+            if not isinstance(proc, ExternalProcedure):
+                roots.add(proc.name)
+    return (roots, starts)
+
+
+def remove_dead_code(externName):
+    """Remove the code which cannot be reached from the program entry,
+       and the compiler labels which no code refers to.  Code is followed
+       from each entry through fall through, jumps, calls and addresses
+       taken, so procedures which are never referenced are removed."""
+    global g_sym_list, g_pseudo_count, g_case_list, g_top_start
+    stream = g_sym_list[g_pseudo_count:]
+    labels = {}
+    for n in range(len(stream)):
+        if isinstance(stream[n], Label):
+            labels[stream[n].name] = n
+    tables = {}
+    for case in g_case_list:
+        if case.kind is not None:
+            tables[case.table] = case.table_data()
+    (roots, starts) = code_roots(externName)
+    top = starts[0] if len(starts) > 0 else None
+    refs = set()
+    
+    def refer(names):
+        for name in names:
+            if name in tables:
+                refs.add(name)
+                refer(g_name_re.findall(" ".join(tables[name])))
+            elif (name in labels) and (name not in refs):
+                refs.add(name)
+                starts.append(labels[name])
+                
+    refer(roots)
+    reached = set()
+    while len(starts) > 0:
+        n = starts.pop()
+        while (n < len(stream)) and (n not in reached):
+            sym = stream[n]
+            if isinstance(sym, (Label, CodeBlock)):
+                reached.add(n)
+            if isinstance(sym, CodeBlock):
+                end = False
+                for instr in sym.cdata:
+                    for arg in (instr.arg1, instr.arg2):
+                        if arg is not None:
+                            refer(g_name_re.findall(arg))
+                    if instr.op in g_jump_ops:
+                        end = True
+                        break
+                if end:
+                    break
+            n += 1
+            
+    symList = g_sym_list[:g_pseudo_count]
+    for n in range(len(stream)):
+        sym = stream[n]
+        if n == top:
+            g_top_start = len(symList)
+        if isinstance(sym, CodeBlock):
+            if n not in reached:
+                dead = sym.cdata
+                sym.cdata = []
+            else:
+                ops = [instr.op for instr in sym.cdata]
+                end = len(ops)
+                for op in g_jump_ops:
+                    if op in ops:
+                        end = min(end, ops.index(op) + 1)
+                dead = sym.cdata[end:]
+                sym.cdata = sym.cdata[:end]
+            for instr in dead:
+                log(DEBUG, "opt", "opt: DEAD %s", instr)
+                count_rule("DEAD", sym, [instr], executed = False)
+            if len(sym.cdata) == 0:
+                continue
+        elif isinstance(sym, Label):
+            if (n not in reached) or (sym.name.startswith("__L") and (sym.name not in refs)):
+                continue
+        symList.append(sym)
+    g_sym_list = symList
+    for case in g_case_list:
+        if case.table not in refs:
+            case.kind = None
+
+
+g_invert_ops = {"JZ" : "JNZ", "JNZ" : "JZ", "JC" : "JNC", "JNC" : "JC",
+                "JPO" : "JPE", "JPE" : "JPO", "JP" : "JM", "JM" : "JP"}
+
+
+def flat_code():
+    """List the labels and instructions of the program in order with the
+       code block of each instruction.  Data is listed as None."""
+    global g_sym_list, g_pseudo_count
+    code = []
+    blocks = []
+    for sym in g_sym_list[g_pseudo_count:]:
+        if isinstance(sym, CodeBlock):
+            code.extend(sym.cdata)
+            blocks.extend([sym] * len(sym.cdata))
+        elif isinstance(sym, Label):
+            code.append(sym)
+            blocks.append(None)
+        elif not isinstance(sym, (AtVariable, AtArray, BasedVariable, BasedArray, BasedStruct)):
+            code.append(None)
+            blocks.append(None)
+    return (code, blocks)
+    
+    
+def jump_target(code, labels, after, name):
+    """Follow a chain of jumps from a label to the last one, returns the
+       final label name and the instruction there"""
+    seen = set()
+    while (name in labels) and (name not in seen):
+        seen.add(name)
+        instr = code[after[labels[name]]]
+        if (instr is None) or (instr.op != "JMP") or (instr.arg1 == name):
+            return (name, instr)
+        name = instr.arg1
+    return (name, None)
+    
+    
+def thread_jumps():
+    """Jump threading over the whole program: a jump or call to a JMP
+       goes to its target, a JMP to a RET is a RET, jumps to the next
+       instruction are removed and a conditional jump over a JMP or RET
+       is inverted.  Repeated until nothing changes."""
+    changed = True
+    while changed:
+        changed = False
+        (code, blocks) = flat_code()
+        labels = {}
+        after = [len(code)] * (len(code) + 1)
+        code.append(None)
+        for n in range(len(code) - 2, -1, -1):
+            if isinstance(code[n], Label):
+                labels[code[n].name] = n
+                after[n] = after[n + 1]
+            else:
+                after[n] = n
+        dead = set()
+        for n in range(len(code) - 1):
+            instr = code[n]
+            if (n in dead) or not isinstance(instr, Instr):
+                continue
+            if (instr.op not in g_invert_ops) and (instr.op not in ("JMP", "CALL")):
+                continue
+            (name, final) = jump_target(code, labels, after, instr.arg1)
+            if name != instr.arg1:
+                log(DEBUG, "opt", "opt: THREAD %s -> %s", instr, name)
+                count_rule("THREAD", blocks[n], [], extra = INSTR_CYCLES["JMP"])
+                instr.arg1 = name
+                changed = True
+            if instr.op == "CALL":
+                continue
+            if (final is not None) and (final.op == "RET"):
+                log(DEBUG, "opt", "opt: JRET %s", instr)
+                ret = Instr("RET" if instr.op == "JMP" else "R" + instr.op[1:])
+                count_rule("JRET", blocks[n], [instr], [ret], INSTR_CYCLES["RET"])
+                instr.op = ret.op
+                instr.arg1 = None
+                instr.size = OPCODE_SIZES[instr.op]
+                changed = True
+                continue
+            # only labels up to the target
+            if (name in labels) and (n < labels[name] < after[n + 1]):
+                log(DEBUG, "opt", "opt: JNEXT %s", instr)
+                count_rule("JNEXT", blocks[n], [instr])
+                dead.add(n)
+                changed = True
+                continue
+            # conditional jump over one JMP or RET
+            skip = code[n + 1]
+            if (instr.op in g_invert_ops) and isinstance(skip, Instr) and \
+               (skip.op in ("JMP", "RET")) and (name in labels) and \
+               (n + 1 < labels[name] < after[n + 2]):
+                log(DEBUG, "opt", "opt: JINV %s", instr)
+                if skip.op == "JMP":
+                    count_rule("JINV", blocks[n], [skip])
+                    instr.op = g_invert_ops[instr.op]
+                    instr.arg1 = skip.arg1
+                else:
+                    ret = Instr("R" + g_invert_ops[instr.op][1:])
+                    count_rule("JINV", blocks[n], [instr, skip], [ret])
+                    instr.op = ret.op
+                    instr.arg1 = None
+                    instr.size = OPCODE_SIZES[instr.op]
+                dead.add(n + 1)
+                changed = True
+        for n in dead:
+            blocks[n].cdata.remove(code[n])
+            
+            
+def track_registers():
+    """Remove loads and stores of values which the registers or memory
+       already hold.  Register and memory contents are followed through
+       each basic block of the program and forgotten at every label,
+       jump and call."""
+    global g_sym_list, g_pseudo_count
+    tracker = RegisterTracker(plain_names())
+    for sym in g_sym_list[g_pseudo_count:]:
+        if not isinstance(sym, CodeBlock):
+            tracker.flush()
+            continue
+        cdata = []
+        for instr in sym.cdata:
+            if tracker.step(instr):
+                log(DEBUG, "opt", "opt: REGS %s", instr)
+                count_rule("REGS", sym, [instr])
+            else:
+                cdata.append(instr)
+        sym.cdata = cdata
+
+
+g_store_ops = set(("STA", "SHLD"))
+g_relative_ops = {"JZ" : "JRZ", "JNZ" : "JRNZ", "JC" : "JRC", "JNC" : "JRNC"}
+g_szp_set_ops = set(("ADD", "ADC", "SUB", "SBB", "ANA", "XRA", "ORA", "CMP",
+                     "ADI", "ACI", "SUI", "SBI", "ANI", "XRI", "ORI", "CPI",
+                     "INR", "DCR"))
+g_szp_use_ops = set(("JZ", "JNZ", "JPO", "JPE", "JP", "JM",
+                     "RZ", "RNZ", "RPO", "RPE", "RP", "RM",
+                     "CZ", "CNZ", "CPO", "CPE", "CP", "CM", "DAA"))
+
+
+def index_registers():
+    """Keep the pointers of BASED structures in IX and IY on the Z80.
+       A pointer already held by an index register is not loaded again
+       until a label, a call or a store which may change it.  The least
+       recently used register is loaded with a new pointer."""
+    global g_sym_list, g_pseudo_count
+    held = []
+    regs = {}
+    reg = "X"
+    for sym in g_sym_list[g_pseudo_count:]:
+        if not isinstance(sym, CodeBlock):
+            held.clear()
+            regs.clear()
+            continue
+        cdata = []
+        for instr in sym.cdata:
+            op = instr.op
+            if op == "LIXD":
+                name = instr.arg1
+                if name in held:
+                    held.remove(name)
+                    held.insert(0, name)
+                    reg = regs[name]
+                    log(DEBUG, "opt", "opt: INDEX %s", instr)
+                    count_rule("INDEX", sym, [instr])
+                    continue
+                if len(held) < 2:
+                    reg = "Y" if "X" in regs.values() else "X"
+                else:
+                    reg = regs.pop(held.pop())
+                held.insert(0, name)
+                regs[name] = reg
+                instr.op = "LI%sD" % reg
+            elif op == "LDX":
+                instr.op = "LD" + reg
+            elif op in g_store_ops:
+                addr = parse_address(instr.arg1)
+                if (addr is None) or (addr[0] is None):
+                    held.clear()
+                    regs.clear()
+                elif addr[0] in held:
+                    held.remove(addr[0])
+                    del regs[addr[0]]
+            elif ((op in ("MOV", "MVI", "INR", "DCR")) and (instr.arg1 == "M")) or \
+                 (op in ("STAX", "LDIR", "CALL", "RST")) or \
+                 ((op[0] == "C") and (op[1:] in ZILOG_CONDS)):
+                # stores through a register pair and calls
+                held.clear()
+                regs.clear()
+            cdata.append(instr)
+        sym.cdata = cdata
         
         
-def optimize():
-    """Perform optimization on a code block"""
-    opt = True
-    while opt:
-        opt = opt0()
-    opt = True
-    while opt:
-        opt = opt1()
-    opt = True
-    while opt:
-        opt = opt2()
+def flags_used(code, labels, n, seen):
+    """Check if the sign, zero or parity flag may be read by the code
+       starting at code[n] before it is set"""
+    while n < len(code):
+        instr = code[n]
+        if instr is None:
+            return True
+        if isinstance(instr, Label):
+            n += 1
+            continue
+        op = instr.op
+        if op in g_szp_set_ops:
+            return False
+        if (op in g_szp_use_ops) or (op in ("CALL", "PCHL", "RST")) or \
+           ((op == "PUSH") and (instr.arg1 == "PSW")):
+            return True
+        if op == "RET":
+            return False
+        if op in ("JMP", "JC", "JNC", "DJNZ"):
+            if (instr.arg1 not in labels) or (instr.arg1 in seen):
+                return True
+            seen.add(instr.arg1)
+            if flags_used(code, labels, labels[instr.arg1], seen):
+                return True
+            if op == "JMP":
+                return False
+        n += 1
+    return True
+    
+    
+def relative_jumps():
+    """Use the two byte jumps of the Z80.  DCR B and JNZ is DJNZ when the
+       flags it sets are not used, and forward JZ, JNZ, JC and JNC are
+       relative jumps.  All of them start short, those whose target is
+       out of range are made long again until the layout is stable."""
+    global g_sym_list, g_pseudo_count
+    (code, blocks) = flat_code()
+    labels = {}
+    for n in range(len(code)):
+        if isinstance(code[n], Label):
+            labels[code[n].name] = n
+    short = {}
+    for n in range(len(code) - 1):
+        (instr, next) = (code[n], code[n + 1])
+        if isinstance(instr, Instr) and (instr.op == "DCR") and (instr.arg1 == "B") and \
+           isinstance(next, Instr) and (next.op == "JNZ") and (next.arg1 in labels) and \
+           (blocks[n] is blocks[n + 1]) and \
+           not flags_used(code, labels, n + 2, set()) and \
+           not flags_used(code, labels, labels[next.arg1], set()):
+            djnz = Instr("DJNZ", next.arg1, comment=next.comment)
+            block = blocks[n]
+            pos = block.cdata.index(instr)
+            block.cdata[pos:pos + 2] = [djnz]
+            short[djnz] = (block, [instr, next])
+            code[n] = code[n + 1] = djnz
+    for n in range(len(code)):
+        instr = code[n]
+        if not (isinstance(instr, Instr) and (instr.op in g_relative_ops) and (instr.arg1 in labels)):
+            continue
+        # a taken JR is slower than JP but one not taken is faster, so
+        # only forward branches are short, JMP and loops stay fast
+        if labels[instr.arg1] > n:
+            short[instr] = (blocks[n], instr.op)
+            instr.op = g_relative_ops[instr.op]
+            instr.size = 2
+    changed = True
+    while changed:
+        changed = False
+        layout()
+        addrs = {}
+        for sym in g_sym_list[g_pseudo_count:]:
+            if isinstance(sym, Label):
+                addrs[sym.name] = sym.addr
+        for sym in g_sym_list[g_pseudo_count:]:
+            if not isinstance(sym, CodeBlock):
+                continue
+            pc = sym.addr
+            for instr in list(sym.cdata):
+                pc += instr.size
+                if (instr not in short) or (-0x80 <= addrs[instr.arg1] - pc < 0x80):
+                    continue
+                (block, long) = short.pop(instr)
+                if isinstance(long, str):
+                    instr.op = long
+                    instr.size = 3
+                else:
+                    pos = block.cdata.index(instr)
+                    block.cdata[pos:pos + 1] = long
+                changed = True
+    for (instr, (block, long)) in short.items():
+        if isinstance(long, str):
+            log(DEBUG, "opt", "opt: JR %s", instr)
+            count_rule("JR", block, [Instr(long)], [instr])
+        else:
+            log(DEBUG, "opt", "opt: DJNZ %s", long[1])
+            count_rule("DJNZ", block, long, [instr])
         
-           
+
+def layout():
+    """Assign addresses to the labels, code and data of the program
+       after code has been removed"""
+    global g_sym_list, g_pseudo_count, g_pc
+    pc = 0x0100
+    for sym in g_sym_list[g_pseudo_count:]:
+        if isinstance(sym, CodeBlock):
+            sym.addr = pc
+            sym.size = sum(instr.size for instr in sym.cdata)
+            pc += sym.size
+        elif isinstance(sym, Label):
+            sym.addr = pc
+        elif isinstance(sym, (AtVariable, AtArray, BasedVariable, BasedArray, BasedStruct)):
+            continue
+        elif isinstance(sym, Variable):
+            sym.addr = pc
+            pc += sym.size
+    g_pc = pc
+
+
+def instr_text(instr):
+    """Get the assembly text of an instruction for the target processor"""
+    if g_target == "z80":
+        return zilog_text(instr)
+    return str(instr)
+    
+    
 def output_code(cdata):
     """Write a code block to the output file"""
     global g_fout
-    for line in cdata:
-        g_fout.write("\t%s\n" % line)
+    for instr in cdata:
+        g_fout.write("\t%s\n" % instr_text(instr))
         
 
 def output_array(sym):
@@ -3466,13 +5019,13 @@ def output_header():
     
 def output_trailer_hlt():
     global g_fout
-    g_fout.write("\tHLT  ; halt\n")
+    g_fout.write("\t%s\n" % instr_text(Instr("HLT", comment="halt")))
     return 1
     
     
 def output_trailer_mon():
     global g_fout
-    g_fout.write("\tRST 001H  ; go to MON80 debug trap\n")
+    g_fout.write("\t%s\n" % instr_text(Instr("RST", "001H", comment="go to MON80 debug trap")))
     return 1
     
     
@@ -3484,7 +5037,7 @@ def output_trailer_ret():
 def output_trailer(trailer):
     """Create the output file trailer.  This is the code which
        runs at program exit."""
-    global g_fout, g_pc
+    global g_fout
     g_fout.write("__ENDCOM:\n")
     if trailer == "mon":
         size = output_trailer_mon()
@@ -3506,12 +5059,12 @@ def output_external(externName):
     extFile.close()
 
 
-def output(outName, externName, trailer):
-    """Create the assembly output file"""
+def output(fout, externName, trailer):
+    """Write the assembly output to a file object"""
     global g_sym_list, g_fout, g_pseudo_count, g_anon_list, g_pc, g_case_list
     
-    # create file and write header
-    g_fout = open(outName, "wt")
+    # write header
+    g_fout = fout
     output_header()
     
     # write initialized data variables and code blocks 
@@ -3527,14 +5080,11 @@ def output(outName, externName, trailer):
             
     # write case tables
     for case in g_case_list:
-        g_fout.write("%s:\tDW  " % case[0])
-        case = case[2][1:]
-        for n in range(len(case)):
-            l = case[n]
-            g_fout.write("%s" % l)
-            if n != (len(case) - 1):
-                g_fout.write(", ")
-        g_fout.write("\n")
+        if case.kind is None:
+            continue
+        entries = case.table_data()
+        g_fout.write("%s:\t%s  %s\n" % (case.table, case.kind, ", ".join(entries)))
+        g_pc += len(entries) * (1 if case.kind == "DB" else 2)
          
     # write anonymous data variables
     for sym in g_anon_list:
@@ -3557,62 +5107,387 @@ def output(outName, externName, trailer):
         elif isinstance(sym, Variable):
             output_variable(sym)
         
-    # mark the remainder of user memory and close file
+    # mark the remainder of user memory
     g_fout.write("MEMORY:\n")
-    g_fout.close()
              
              
-def fixup():
-    global g_code, g_pc
+def use_runtime(name):
+    """Mark a runtime library routine as used by the program.
+       Returns the routine name to call."""
+    global g_runtime
+    g_runtime.add(name)
+    return name
+    
+    
+def runtime_mul16():
+    """HL = DE * BC, B is destroyed.  The multiplier is scanned MSB
+       first one byte at a time, a zero MSB is skipped."""
+    emit_instr("LXI", "H", "00000H")
+    emit_instr("MOV", "A", "B")
+    emit_instr("ORA", "A")
+    emit_instr("CNZ", "__MUL16B", comment="multiplier MSB")
+    emit_instr("MOV", "A", "C", comment="multiplier LSB")
+    emit_label("__MUL16B")
+    emit_instr("MVI", "B", "008H")
+    emit_label("__MUL16C")
+    emit_instr("DAD", "H")
+    emit_instr("RAL")
+    emit_instr("JNC", "__MUL16D")
+    emit_instr("DAD", "D")
+    emit_label("__MUL16D")
+    emit_instr("DCR", "B")
+    emit_instr("JNZ", "__MUL16C")
+    emit_instr("RET")
+    
+    
+def runtime_div16():
+    """DE = DE / BC, HL = DE MOD BC.  Restoring division of the dividend
+       one byte at a time, 16 iterations at most.  The MSB pass is
+       skipped when the divisor is larger than the dividend MSB."""
+    emit_instr("LXI", "H", "00000H", comment="remainder")
+    emit_instr("MOV", "A", "B")
+    emit_instr("ORA", "A")
+    emit_instr("JNZ", "__DIV16A", comment="divisor > dividend MSB")
+    emit_instr("MOV", "A", "D")
+    emit_instr("CMP", "C")
+    emit_instr("JC", "__DIV16A", comment="divisor > dividend MSB")
+    emit_instr("PUSH", "D", comment="save dividend LSB")
+    emit_instr("CALL", "__DIV16B", comment="quotient MSB to D")
+    emit_instr("MOV", "A", "D")
+    emit_instr("POP", "D")
+    emit_instr("JMP", "__DIV16L")
+    emit_label("__DIV16A")
+    emit_instr("MOV", "L", "D", comment="remainder is dividend MSB")
+    emit_instr("XRA", "A", comment="quotient MSB is 0")
+    emit_label("__DIV16L")
+    emit_instr("MOV", "D", "E", comment="dividend LSB")
+    emit_instr("PUSH", "PSW")
+    emit_instr("CALL", "__DIV16B", comment="quotient LSB to D")
+    emit_instr("POP", "PSW")
+    emit_instr("MOV", "E", "D")
+    emit_instr("MOV", "D", "A", comment="quotient to D,E")
+    emit_instr("RET")
+    emit_label("__DIV16B")
+    emit_instr("MVI", "E", "008H")
+    emit_label("__DIV16C")
+    emit_instr("MOV", "A", "D")
+    emit_instr("ADD", "A", comment="next dividend bit")
+    emit_instr("MOV", "D", "A")
+    emit_instr("MOV", "A", "L")
+    emit_instr("RAL")
+    emit_instr("MOV", "L", "A")
+    emit_instr("MOV", "A", "H")
+    emit_instr("RAL")
+    emit_instr("MOV", "H", "A", comment="remainder << 1")
+    emit_instr("JC", "__DIV16D", comment="remainder overflow")
+    emit_instr("MOV", "A", "L")
+    emit_instr("SUB", "C")
+    emit_instr("MOV", "A", "H")
+    emit_instr("SBB", "B")
+    emit_instr("JC", "__DIV16E", comment="remainder < divisor")
+    emit_label("__DIV16D")
+    emit_instr("MOV", "A", "L")
+    emit_instr("SUB", "C")
+    emit_instr("MOV", "L", "A")
+    emit_instr("MOV", "A", "H")
+    emit_instr("SBB", "B")
+    emit_instr("MOV", "H", "A")
+    emit_instr("INR", "D", comment="quotient bit")
+    emit_label("__DIV16E")
+    emit_instr("DCR", "E")
+    emit_instr("JNZ", "__DIV16C")
+    emit_instr("RET")
+    
+    
+def runtime_shift8(name, ops):
+    """E = E shifted or rotated C times by the ops applied to A.
+       A zero count leaves E unchanged."""
+    emit_instr("MOV", "A", "C")
+    emit_instr("ORA", "A")
+    emit_instr("RZ", comment="count 0")
+    emit_instr("MOV", "A", "E")
+    emit_label(name + "A")
+    for (op, arg) in ops:
+        emit_instr(op, arg)
+    emit_instr("DCR", "C")
+    emit_instr("JNZ", name + "A")
+    emit_instr("MOV", "E", "A")
+    emit_instr("RET")
+    
+    
+def runtime_shr16():
+    """DE = DE >> C"""
+    emit_instr("MOV", "A", "C")
+    emit_instr("ORA", "A")
+    emit_instr("RZ", comment="count 0")
+    emit_label("__SHR16A")
+    emit_instr("MOV", "A", "D")
+    emit_instr("ORA", "A", comment="clear carry")
+    emit_instr("RAR")
+    emit_instr("MOV", "D", "A")
+    emit_instr("MOV", "A", "E")
+    emit_instr("RAR")
+    emit_instr("MOV", "E", "A")
+    emit_instr("DCR", "C")
+    emit_instr("JNZ", "__SHR16A")
+    emit_instr("RET")
+    
+    
+def runtime_shl16():
+    """DE = DE << C, HL is destroyed"""
+    emit_instr("MOV", "A", "C")
+    emit_instr("ORA", "A")
+    emit_instr("RZ", comment="count 0")
+    emit_instr("XCHG")
+    emit_label("__SHL16A")
+    emit_instr("DAD", "H")
+    emit_instr("DCR", "C")
+    emit_instr("JNZ", "__SHL16A")
+    emit_instr("XCHG")
+    emit_instr("RET")
+    
+    
+g_runtime_lib = {"__MUL16" : runtime_mul16,
+                 "__DIV16" : runtime_div16,
+                 "__SHR8" : lambda: runtime_shift8("__SHR8", (("ORA", "A"), ("RAR", None))),
+                 "__SHL8" : lambda: runtime_shift8("__SHL8", (("ADD", "A"),)),
+                 "__ROR8" : lambda: runtime_shift8("__ROR8", (("RRC", None),)),
+                 "__ROL8" : lambda: runtime_shift8("__ROL8", (("RLC", None),)),
+                 "__SHR16" : runtime_shr16,
+                 "__SHL16" : runtime_shl16}
+    
+    
+def emit_runtime():
+    """Add the runtime library routines used by the program"""
+    global g_runtime, g_runtime_lib
+    for name in sorted(g_runtime):
+        emit_label(name)
+        g_runtime_lib[name]()
+        emit_code()
+    
+    
+def run_phase(name, func, *args):
+    """Run one phase of the compilation, measured if statistics are
+       being collected.  Returns the result of func(*args)."""
+    if g_stats is None:
+        return func(*args)
+    return g_stats.measure(name, func, *args)
+    
+    
+def fixup(externName):
     
     if g_entry is None:
-        g_code.append("JMP __ENDCOM  ; program end")
-        g_pc += 3
+        emit_instr("JMP", "__ENDCOM", comment="program end")
     else:
-        g_code.append("RET  ; program end")
-        g_pc += 1
+        emit_instr("RET", comment="program end")
     emit_code()
+    run_phase("runtime", emit_runtime)
+    if g_opt:
+        run_phase("dead code", remove_dead_code, externName)
+        run_phase("thread jumps", thread_jumps)
+        run_phase("dead code", remove_dead_code, externName)
+        run_phase("registers", track_registers)
+        if g_target == "z80":
+            run_phase("index registers", index_registers)
+            run_phase("relative jumps", relative_jumps)
+    run_phase("layout", layout)
     #fixup_vars()
     #fixup_refs()
            
            
+# optimizations of the whole program, reported as rules with the
+# peephole rules
+g_program_rules = ("DEAD", "THREAD", "JRET", "JNEXT", "JINV", "REGS")
+g_z80_rules = ("INDEX", "DJNZ", "JR")
+
+
+def rule_names(target):
+    """Get the names of all optimizer rules used for a target"""
+    names = []
+    for rules in g_peep_rules.values():
+        names.extend(rule.name for rule in rules)
+    names.extend(g_program_rules)
+    if target == "z80":
+        names.extend(g_z80_rules)
+    return names
+    
+    
+def count_program(stats, lines):
+    """Record the size of the compiled program of lines source lines
+       in stats"""
+    symbols = 0
+    for table in (g_symtab.alloc, g_symtab.uninit, g_symtab.anon):
+        symbols += len(table)
+    blocks = 0
+    labels = 0
+    instrs = 0
+    for sym in g_sym_list[g_pseudo_count:]:
+        if isinstance(sym, CodeBlock):
+            blocks += 1
+            instrs += len(sym.cdata)
+            for (rule, size, cycles) in sym.hits or ():
+                stats.rules.add(rule, sym.proc, size, cycles)
+        elif isinstance(sym, Label):
+            labels += 1
+    procs = 0
+    for sym in g_symtab.procs.values():
+        if isinstance(sym, UserProcedure):
+            procs += 1
+    stats.counts["source lines"] = lines
+    stats.counts["symbols"] = symbols - g_pseudo_count
+    stats.counts["procedures"] = procs
+    stats.counts["code blocks"] = blocks
+    stats.counts["labels"] = labels
+    stats.counts["instructions"] = instrs
+    stats.counts["bytes"] = g_pc - 0x0100
+    
+    
 def init_builtins():
     global g_proc_list
-    g_proc_list.append(BuiltinProcedure("LENGTH", 1, builtin_length))
-    g_proc_list.append(BuiltinProcedure("LAST", 1, builtin_last))
-    g_proc_list.append(BuiltinProcedure("LOW", 1, builtin_low))  
-    g_proc_list.append(BuiltinProcedure("HIGH", 1, builtin_high))
-    g_proc_list.append(BuiltinProcedure("DOUBLE", 1, builtin_double))
-    g_proc_list.append(BuiltinProcedure("SHR", 2, builtin_shr))
-    g_proc_list.append(BuiltinProcedure("SHL", 2, builtin_shl))
-    g_proc_list.append(BuiltinProcedure("ROR", 2, builtin_ror))
-    g_proc_list.append(BuiltinProcedure("ROL", 2, builtin_rol))
+    add_proc(BuiltinProcedure("LENGTH", 1, builtin_length))
+    add_proc(BuiltinProcedure("LAST", 1, builtin_last))
+    add_proc(BuiltinProcedure("LOW", 1, builtin_low))  
+    add_proc(BuiltinProcedure("HIGH", 1, builtin_high))
+    add_proc(BuiltinProcedure("DOUBLE", 1, builtin_double))
+    add_proc(BuiltinProcedure("SHR", 2, builtin_shr))
+    add_proc(BuiltinProcedure("SHL", 2, builtin_shl))
+    add_proc(BuiltinProcedure("ROR", 2, builtin_ror))
+    add_proc(BuiltinProcedure("ROL", 2, builtin_rol))
     
     
 def init_pseudos():
     global g_sym_list, g_pseudo_count
-    g_sym_list.append(Variable("STACKPTR", 0, 2, None))
-    g_sym_list.append(Variable("ZERO", 0, 1, None))
-    g_sym_list.append(Variable("CARRY", 0, 1, None))
-    g_sym_list.append(Variable("SIGN", 0, 1, None))
-    g_sym_list.append(Variable("PARITY", 0, 1, None))
-    g_sym_list.append(Array("MEMORY", 0, 0, None, 1))
+    add_sym(Variable("STACKPTR", 0, 2, None))
+    add_sym(Variable("ZERO", 0, 1, None))
+    add_sym(Variable("CARRY", 0, 1, None))
+    add_sym(Variable("SIGN", 0, 1, None))
+    add_sym(Variable("PARITY", 0, 1, None))
+    add_sym(Array("MEMORY", 0, 0, None, 1))
     g_pseudo_count = len(g_sym_list)
 
 
-if __name__ == '__main__':
+# held while a compilation uses the module globals
+g_compile_lock = RLock()
 
-    from argparse import ArgumentParser
 
-    argparser = ArgumentParser()
-    argparser.add_argument("infile", type=str, 
-                            help="input PL/M file")
-    argparser.add_argument("outfile", type=str, 
-                            help="output 8080 ASM file")
+class Compiler(object):
+    """PL/M to 8080 or Z80 assembly compiler.  One Compiler can be used
+       for any number of compilations in the same process, the lexer and
+       parser tables are only loaded once.  The code generator works on
+       module globals, so each Compiler keeps its own state in state and
+       only puts it in the globals while it compiles.  Compilations from
+       several threads take turns, and a compilation started from within
+       another one (from a log, say) gives the outer one its state back.
+       Diagnostics go to log, only warnings are shown if it is None.  If
+       stats is set each result has a CompileStats."""
+
+    def __init__(self, start = None, optimize = False, external = None,
+                 initialize = False, trailer = "ret", case_check = False,
+                 target = "8080", cache = None, log = None, stats = False):
+        self.start = start
+        self.optimize = optimize
+        self.external = external
+        self.initialize = initialize
+        self.trailer = trailer
+        self.case_check = case_check
+        self.target = target
+        self.cache = cache
+        self.log = log
+        self.stats = stats
+        self.state = None
+        
+    def options(self):
+        """Get the options which affect the generated code"""
+        return dict(start = self.start, optimize = self.optimize,
+                    external = self.external, initialize = self.initialize,
+                    trailer = self.trailer, case_check = self.case_check,
+                    target = self.target)
+        
+    def compile(self, text):
+        """Compile PL/M source text and return a CompileResult.  If a
+           cache is set, an unchanged module is taken from the cache
+           without being parsed and its warnings are logged again,
+           unless the log asks for more than warnings or stats are
+           collected.  Raises CompileError if the source cannot be
+           compiled.  Afterwards state holds the compiler state of the
+           compilation."""
+        with g_compile_lock:
+            outer = save_state()
+            try:
+                return self._cached(text)
+            finally:
+                self.state = save_state()
+                load_state(outer)
+                
+    def _cached(self, text):
+        cache = self.cache
+        if self.stats or ((self.log is not None) and (self.log.level > WARNING)):
+            cache = None
+        if cache is not None:
+            key = cache.key(text, self.options())
+            result = cache.get(key)
+            if result is not None:
+                set_log(self.log or Log())
+                for msg in result.warnings:
+                    warning(msg)
+                return result
+        result = self._compile(text)
+        if cache is not None:
+            cache.put(key, result)
+        return result
+        
+    def _compile(self, text):
+        global g_stats
+        set_log(self.log or Log())
+        g_stats = None
+        if self.stats:
+            g_stats = CompileStats(rule_names(self.target))
+            g_stats.record("startup/lexer", LEXER_LOAD_TIME)
+            g_stats.record("startup/parser", PARSER_LOAD_TIME)
+            g_stats.start()
+        start = perf_counter()
+        try:
+            return self._run(text)
+        finally:
+            if g_stats is not None:
+                g_stats.record("total", perf_counter() - start, g_stats.peak())
+                g_stats.stop()
+                
+    def _run(self, text):
+        init_state(self.optimize, self.initialize, self.start, self.case_check,
+                   self.target)
+        init_builtins()
+        init_pseudos()
+        lexer = plmlexer.clone()
+        lexer.begin('INITIAL')
+        lexer.lineno = 1
+        try:
+            run_phase("parse", parser.parse, text, lexer)
+        except lex.LexError:
+            fatal("illegal character, line %d" % lexer.lineno)
+        
+        if len(g_do_stack) > 0:
+            fatal("missing closing END statement")
+        if len(g_proc_stack) > 0:
+            fatal("missing END for procedure %s" % g_proc_stack[-1])
+            
+        run_phase("fixup", fixup, self.external)
+        
+        fout = StringIO()
+        run_phase("output", output, fout, self.external, self.trailer)
+        if g_stats is not None:
+            count_program(g_stats, lexer.lineno)
+        return CompileResult(fout.getvalue(), g_pc, g_stats, g_warnings)
+        
+        
+def add_options(argparser):
+    """Add the compile options shared by the command line and build
+       manifests to an ArgumentParser"""
     argparser.add_argument("-s", "--start", action="store", type=str,
                            help="program start procedure")
     argparser.add_argument("-o", "--optimize", action="store_true",
-                            help="optimize")
+                            help="optimize the whole program: remove dead code, thread "
+                                 "jumps and keep values in registers")
     argparser.add_argument("-e", "--external", action="store", type=str,
                             help="8080 ASM file containing EXTERNAL procedures")
     argparser.add_argument("-i", "--initialize", action="store_true",
@@ -3620,35 +5495,93 @@ if __name__ == '__main__':
     argparser.add_argument("-t", "--trailer", action="store", type=str,
                            choices = ("hlt", "ret", "mon"), default="ret",
                            help="program termination option")
+    argparser.add_argument("-c", "--case-check", action="store_true",
+                           help="skip DO CASE when the selector is out of range")
+    argparser.add_argument("-z", "--target", action="store", type=str,
+                           choices = ("8080", "z80"), default="8080",
+                           help="processor to generate code for")
+                           
+                           
+def add_log_options(argparser):
+    """Add the diagnostic options to an ArgumentParser"""
+    argparser.add_argument("-v", "--verbose", action="count", default=0,
+                           help="show declarations, -vv also optimizations")
+    argparser.add_argument("--log-json", action="store_true",
+                           help="write diagnostics as JSON lines")
+                           
+                           
+def log_from_args(args):
+    """Create the Log selected by parsed options"""
+    return Log(min(WARNING + args.verbose, DEBUG), args.log_json)
+    
+    
+def compiler_options(args):
+    """Get the Compiler keyword arguments from parsed options"""
+    return dict(start = args.start, optimize = args.optimize,
+                external = args.external, initialize = args.initialize,
+                trailer = args.trailer, case_check = args.case_check,
+                target = args.target)
+
+
+if __name__ == '__main__':
+
+    import sys
+    from argparse import ArgumentParser
+    from cache import add_cache_options, cache_from_args
+    
+    if (len(sys.argv) > 1) and (sys.argv[1] == "build"):
+        # build imports pyplm, which must be this module and not a
+        # second copy with its own globals and parser
+        sys.modules["pyplm"] = sys.modules[__name__]
+        from build import main
+        exit(main(sys.argv[2:]))
+
+    argparser = ArgumentParser()
+    argparser.add_argument("infile", type=str, 
+                            help="input PL/M file")
+    argparser.add_argument("outfile", type=str, 
+                            help="output 8080 or Z80 ASM file")
+    add_options(argparser)
+    add_log_options(argparser)
+    add_cache_options(argparser)
+    argparser.add_argument("--stats", action="store_true",
+                           help="show time and peak memory of each compile phase, "
+                                "as JSON with --log-json")
+    argparser.add_argument("--profile", action="store", type=str,
+                           help="write cProfile statistics of the compile to a file")
     args = argparser.parse_args()
-    
-    print(args.external)
-    
-    g_opt = args.optimize
-    g_data_init = args.initialize
-    g_entry = args.start
+    runLog = log_from_args(args)
+    set_log(runLog)
     
     inFile = open(args.infile, "rt")
     text = inFile.read()
     inFile.close()
     
-    init_builtins()
-    init_pseudos()
-    
-    plmlexer.input(text)
-    parser.parse(text, lexer = plmlexer)
-    
-    if len(g_do_stack) > 0:
-        fatal("missing closing END statement")
+    compiler = Compiler(cache = cache_from_args(args), log = runLog,
+                        stats = args.stats, **compiler_options(args))
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler is None:
+            result = compiler.compile(text)
+        else:
+            result = profiler.runcall(compiler.compile, text)
+    except CompileError as e:
+        log(ERROR, "error", str(e))
+        exit(-1)
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(args.profile)
         
-    fixup()
-   
-    #for sym in g_sym_list:
-    #    print(sym)
-
-    output(args.outfile, args.external, args.trailer)
+    outFile = open(args.outfile, "wt")
+    outFile.write(result.asm)
+    outFile.close()
+    
+    if args.stats and args.log_json:
+        print(json.dumps(result.stats.as_dict()))
+    elif args.stats:
+        print(result.stats.table(), end="")
 
     exit(0)
-    
-
-
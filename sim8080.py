@@ -0,0 +1,1151 @@
+"""8080 and Z80 assembler and instruction level simulator.
+
+Assembles the output of pyplm (ORG, DB/DW/DS, DUP(?), labels and merged
+EXTERNAL files) and executes it with exact 8080 T-state counts.  With
+z80 set the source is in Zilog mnemonics and runs with Z80 T-states;
+only the Z80 instructions generated by pyplm --target z80 are supported
+beyond the 8080 set.  The
+program is entered with a return address of 0000H on the stack, so the
+"ret" trailer exits through the CP/M warm boot vector.  The "hlt" trailer
+stops on HLT and the "mon" trailer stops on RST 1.  CALL 0005H is handled
+as a CP/M BDOS call supporting console input, output, status and string
+output; a BDOS call costs only the T-states of its RET.
+
+Programs starting with data or procedures should be run from the
+procedure given to pyplm with -s, since code starts at 0100H."""
+
+from compiler import OPCODE_SIZES, INSTR_SIZES, Z80_OPCODE_SIZES
+
+
+class AsmError(Exception):
+    """Error assembling a source line"""
+
+
+class SimError(Exception):
+    """Error while simulating a program"""
+
+
+REGS = {'B' : 0, 'C' : 1, 'D' : 2, 'E' : 3, 'H' : 4, 'L' : 5, 'M' : 6, 'A' : 7}
+PAIRS = {'B' : 0, 'D' : 1, 'H' : 2, 'SP' : 3}
+STACK_PAIRS = {'B' : 0, 'D' : 1, 'H' : 2, 'PSW' : 3}
+CONDS = {'NZ' : 0, 'Z' : 1, 'NC' : 2, 'C' : 3, 'PO' : 4, 'PE' : 5, 'P' : 6, 'M' : 7}
+
+# opcodes taking a register encoded in bits 0-2
+ALU_REG = {'ADD' : 0x80, 'ADC' : 0x88, 'SUB' : 0x90, 'SBB' : 0x98,
+           'ANA' : 0xa0, 'XRA' : 0xa8, 'ORA' : 0xb0, 'CMP' : 0xb8}
+ALU_IMM = {'ADI' : 0xc6, 'ACI' : 0xce, 'SUI' : 0xd6, 'SBI' : 0xde,
+           'ANI' : 0xe6, 'XRI' : 0xee, 'ORI' : 0xf6, 'CPI' : 0xfe}
+IMPLIED = {'XCHG' : 0xeb, 'XTHL' : 0xe3, 'SPHL' : 0xf9, 'PCHL' : 0xe9,
+           'RLC' : 0x07, 'RRC' : 0x0f, 'RAL' : 0x17, 'RAR' : 0x1f,
+           'CMA' : 0x2f, 'CMC' : 0x3f, 'STC' : 0x37, 'DAA' : 0x27,
+           'RET' : 0xc9, 'EI' : 0xfb, 'DI' : 0xf3, 'NOP' : 0x00, 'HLT' : 0x76}
+ADDR = {'LDA' : 0x3a, 'STA' : 0x32, 'LHLD' : 0x2a, 'SHLD' : 0x22,
+        'JMP' : 0xc3, 'CALL' : 0xcd}
+
+# Z80 relative jumps, the conditions are NZ, Z, NC and C
+RELATIVE = {'DJNZ' : 0x10, 'JR' : 0x18, 'JRNZ' : 0x20, 'JRZ' : 0x28,
+            'JRNC' : 0x30, 'JRC' : 0x38}
+
+# Zilog mnemonics translated to 8080 (or Z80.LIB) mnemonics
+Z80_PAIRS = {'BC' : 'B', 'DE' : 'D', 'HL' : 'H', 'SP' : 'SP'}
+Z80_STACK_PAIRS = {'BC' : 'B', 'DE' : 'D', 'HL' : 'H', 'AF' : 'PSW'}
+Z80_REGS = {'A' : 'A', 'B' : 'B', 'C' : 'C', 'D' : 'D', 'E' : 'E',
+            'H' : 'H', 'L' : 'L', '(HL)' : 'M'}
+Z80_ALU = {'ADD' : ('ADD', 'ADI'), 'ADC' : ('ADC', 'ACI'), 'SUB' : ('SUB', 'SUI'),
+           'SBC' : ('SBB', 'SBI'), 'AND' : ('ANA', 'ANI'), 'XOR' : ('XRA', 'XRI'),
+           'OR' : ('ORA', 'ORI'), 'CP' : ('CMP', 'CPI')}
+Z80_IMPLIED = {'RLCA' : 'RLC', 'RRCA' : 'RRC', 'RLA' : 'RAL', 'RRA' : 'RAR',
+               'CPL' : 'CMA', 'CCF' : 'CMC', 'SCF' : 'STC', 'DAA' : 'DAA',
+               'EI' : 'EI', 'DI' : 'DI', 'NOP' : 'NOP', 'HALT' : 'HLT',
+               'LDIR' : 'LDIR'}
+
+# flag bits
+FLAG_S = 0x80
+FLAG_Z = 0x40
+FLAG_AC = 0x10
+FLAG_P = 0x04
+FLAG_CY = 0x01
+
+# sign, zero and parity flags for each byte value
+SZP = []
+for n in range(256):
+    f = n & FLAG_S
+    if n == 0:
+        f |= FLAG_Z
+    if bin(n).count('1') % 2 == 0:
+        f |= FLAG_P
+    SZP.append(f)
+
+
+def split_operands(text):
+    """Split an operand field on commas outside of quotes"""
+    ops = []
+    cur = ""
+    quote = False
+    for c in text:
+        if c == "'":
+            quote = not quote
+        if (c == ',') and not quote:
+            ops.append(cur.strip())
+            cur = ""
+        else:
+            cur += c
+    if len(cur.strip()) > 0:
+        ops.append(cur.strip())
+    return ops
+
+
+def strip_asm_comment(line):
+    """Remove a comment from an assembly line, ignoring ; in quotes"""
+    quote = False
+    for n in range(len(line)):
+        if line[n] == "'":
+            quote = not quote
+        elif (line[n] == ';') and not quote:
+            return line[:n]
+    return line
+
+
+class Assembler(object):
+    """Two pass 8080 assembler producing a 64K memory image"""
+
+    def __init__(self, text):
+        self.symbols = {}
+        self.memory = bytearray(0x10000)
+        self.lines = []
+        for line in text.splitlines():
+            stmt = self.parse_line(line)
+            if stmt is not None:
+                self.lines.append(stmt)
+        self.end = self.assemble(False)
+        self.end = self.assemble(True)
+
+    def parse_line(self, line):
+        """Split a line into (label, op, operands).
+           Returns None for empty lines."""
+        text = strip_asm_comment(line).rstrip()
+        if len(text.strip()) == 0:
+            return None
+        label = None
+        if not text[0].isspace():
+            sl = text.split(None, 1)
+            first = sl[0]
+            rest = ""
+            if len(sl) > 1:
+                rest = sl[1]
+            if first.endswith(':'):
+                label = first[:-1]
+                text = rest
+            elif (len(rest) > 0) and (rest.split()[0].upper() in ('DB', 'DW', 'DS', 'EQU')):
+                label = first
+                text = rest
+        sl = text.strip().split(None, 1)
+        if len(sl) == 0:
+            return (label, None, [])
+        op = sl[0].upper()
+        operands = []
+        if len(sl) > 1:
+            operands = split_operands(sl[1])
+        return (label, op, operands)
+
+    def value(self, expr, final, pc):
+        """Evaluate an operand expression of numbers, symbols, $, + and -"""
+        expr = expr.replace(' ', '').replace('\t', '')
+        total = 0
+        sign = 1
+        term = ""
+        for c in expr + '+':
+            if (c in '+-') and (len(term) > 0) and not (term.startswith("'") and not term.endswith("'")):
+                total += sign * self.term(term, final, pc)
+                sign = 1 if c == '+' else -1
+                term = ""
+            elif (c in '+-') and (len(term) == 0):
+                if c == '-':
+                    sign = -sign
+            else:
+                term += c
+        return total & 0xffff
+
+    def term(self, term, final, pc):
+        """Evaluate a single number, character or symbol"""
+        if term == '$':
+            return pc
+        if term.startswith("'") and term.endswith("'") and (len(term) == 3):
+            return ord(term[1])
+        if term[0].isdigit():
+            t = term.upper()
+            try:
+                if t.endswith('H'):
+                    return int(t[:-1], 16)
+                if t.endswith('B'):
+                    return int(t[:-1], 2)
+                if t.endswith('D'):
+                    return int(t[:-1])
+                return int(t)
+            except ValueError:
+                raise AsmError("bad number %s" % term)
+        name = term.upper()
+        if name in self.symbols:
+            return self.symbols[name]
+        if final:
+            raise AsmError("undefined symbol %s" % term)
+        return 0
+
+    def data_size(self, op, operands):
+        """Size of a DB, DW or DS directive"""
+        if op == 'DS':
+            return self.value(operands[0], True, 0)
+        elemSize = 1 if op == 'DB' else 2
+        size = 0
+        for o in operands:
+            if 'DUP' in o.upper():
+                count = o.upper().split('DUP')[0]
+                size += self.value(count, True, 0) * elemSize
+            elif o.startswith("'") and (op == 'DB'):
+                size += len(o) - 2
+            else:
+                size += elemSize
+        return size
+
+    def assemble(self, final):
+        """Run one assembler pass, returns the end address"""
+        pc = 0
+        for (label, op, operands) in self.lines:
+            if label is not None:
+                if op == 'EQU':
+                    self.symbols[label.upper()] = self.value(operands[0], final, pc)
+                    continue
+                self.symbols[label.upper()] = pc
+            if op is None:
+                continue
+            if op == 'ORG':
+                pc = self.value(operands[0], final, pc)
+            elif op == 'END':
+                break
+            elif op in ('DB', 'DW', 'DS'):
+                if final:
+                    self.emit_data(pc, op, operands)
+                pc += self.data_size(op, operands)
+            else:
+                size = self.instr_size(op, operands)
+                if final:
+                    self.emit_instr(pc, op, operands)
+                pc += size
+            if pc > 0x10000:
+                raise AsmError("program too large")
+        return pc
+
+    def emit_data(self, pc, op, operands):
+        """Store DB/DW data in memory, DS and DUP(?) are left zero"""
+        if op == 'DS':
+            return
+        for o in operands:
+            if 'DUP' in o.upper():
+                count = self.value(o.upper().split('DUP')[0], True, pc)
+                pc += count * (1 if op == 'DB' else 2)
+            elif o.startswith("'") and (op == 'DB'):
+                for c in o[1:-1]:
+                    self.memory[pc] = ord(c)
+                    pc += 1
+            elif op == 'DB':
+                self.memory[pc] = self.value(o, True, pc) & 0xff
+                pc += 1
+            else:
+                v = self.value(o, True, pc)
+                self.memory[pc] = v & 0xff
+                self.memory[pc + 1] = v >> 8
+                pc += 2
+
+    def instr_size(self, op, operands):
+        """Size of an instruction in bytes"""
+        try:
+            return OPCODE_SIZES[op]
+        except KeyError:
+            raise AsmError("unknown instruction %s" % op)
+
+    def reg(self, name, table):
+        try:
+            return table[name.upper()]
+        except KeyError:
+            raise AsmError("bad register %s" % name)
+
+    def emit_instr(self, pc, op, operands):
+        """Encode an instruction into memory"""
+        mem = self.memory
+        data = None
+        if op == 'MOV':
+            code = 0x40 | (self.reg(operands[0], REGS) << 3) | self.reg(operands[1], REGS)
+        elif op == 'MVI':
+            code = 0x06 | (self.reg(operands[0], REGS) << 3)
+            data = operands[1]
+        elif op == 'LXI':
+            code = 0x01 | (self.reg(operands[0], PAIRS) << 4)
+            data = operands[1]
+        elif op in ALU_REG:
+            code = ALU_REG[op] | self.reg(operands[0], REGS)
+        elif op in ALU_IMM:
+            code = ALU_IMM[op]
+            data = operands[0]
+        elif op in ('INR', 'DCR'):
+            code = (0x04 if op == 'INR' else 0x05) | (self.reg(operands[0], REGS) << 3)
+        elif op in ('INX', 'DCX', 'DAD'):
+            base = {'INX' : 0x03, 'DCX' : 0x0b, 'DAD' : 0x09}[op]
+            code = base | (self.reg(operands[0], PAIRS) << 4)
+        elif op in ('LDAX', 'STAX'):
+            pair = self.reg(operands[0], PAIRS)
+            if pair > 1:
+                raise AsmError("bad register %s" % operands[0])
+            code = (0x0a if op == 'LDAX' else 0x02) | (pair << 4)
+        elif op in ('PUSH', 'POP'):
+            code = (0xc5 if op == 'PUSH' else 0xc1) | (self.reg(operands[0], STACK_PAIRS) << 4)
+        elif op in IMPLIED:
+            code = IMPLIED[op]
+        elif op in ADDR:
+            code = ADDR[op]
+            data = operands[0]
+        elif op == 'RST':
+            code = 0xc7 | ((self.value(operands[0], True, pc) & 7) << 3)
+        elif op in ('IN', 'OUT'):
+            code = 0xdb if op == 'IN' else 0xd3
+            data = operands[0]
+        elif (op[0] in 'JCR') and (op[1:] in CONDS):
+            base = {'J' : 0xc2, 'C' : 0xc4, 'R' : 0xc0}[op[0]]
+            code = base | (CONDS[op[1:]] << 3)
+            if op[0] != 'R':
+                data = operands[0]
+        else:
+            raise AsmError("unknown instruction %s" % op)
+        mem[pc] = code
+        if data is not None:
+            v = self.value(data, True, pc)
+            mem[pc + 1] = v & 0xff
+            if OPCODE_SIZES[op] == 3:
+                mem[pc + 2] = v >> 8
+
+
+class Z80Assembler(Assembler):
+    """Two pass Z80 assembler for Zilog mnemonics.  Each instruction is
+       translated to its 8080 mnemonic, or the Z80.LIB mnemonic of the Z80
+       instructions pyplm generates, and encoded from that."""
+
+    def instr_size(self, op, operands):
+        op = self.intel(op, operands)[0]
+        try:
+            return INSTR_SIZES[op]
+        except KeyError:
+            raise AsmError("unknown instruction %s" % op)
+
+    def intel(self, op, operands):
+        """Translate a Zilog instruction to (op, operands)"""
+        ops = [o.upper() for o in operands]
+        n = len(ops)
+        if (op == 'LD') and (n == 2):
+            (d, s) = ops
+            if d in ('IX', 'IY') and self.is_mem(s):
+                return ('LI%sD' % d[1], [operands[1][1:-1]])
+            if (d in Z80_REGS) and (d != '(HL)') and s.startswith('(I') and (s[2:3] in 'XY'):
+                return ('LD' + s[2], [d, operands[1][4:-1]])
+            if (d in Z80_REGS) and (s in Z80_REGS):
+                return ('MOV', [Z80_REGS[d], Z80_REGS[s]])
+            if (d == 'SP') and (s == 'HL'):
+                return ('SPHL', [])
+            if d in Z80_PAIRS:
+                if (d == 'HL') and self.is_mem(s):
+                    return ('LHLD', [operands[1][1:-1]])
+                return ('LXI', [Z80_PAIRS[d], operands[1]])
+            if (d == 'A') and self.is_mem(s):
+                if s in ('(BC)', '(DE)'):
+                    return ('LDAX', [s[1]])
+                return ('LDA', [operands[1][1:-1]])
+            if d in Z80_REGS:
+                return ('MVI', [Z80_REGS[d], operands[1]])
+            if self.is_mem(d) and (s == 'A'):
+                if d in ('(BC)', '(DE)'):
+                    return ('STAX', [d[1]])
+                return ('STA', [operands[0][1:-1]])
+            if self.is_mem(d) and (s == 'HL'):
+                return ('SHLD', [operands[0][1:-1]])
+        elif op in Z80_ALU:
+            if (n == 2) and (ops[0] == 'HL') and (op in ('ADD', 'SBC')):
+                return ('DAD' if op == 'ADD' else 'DSBC', [self.reg(ops[1], Z80_PAIRS)])
+            if (n == 2) and (ops[0] == 'A'):
+                (ops, operands) = (ops[1:], operands[1:])
+            if len(ops) == 1:
+                if ops[0] in Z80_REGS:
+                    return (Z80_ALU[op][0], [Z80_REGS[ops[0]]])
+                return (Z80_ALU[op][1], operands)
+        elif (op in ('INC', 'DEC')) and (n == 1):
+            if ops[0] in Z80_REGS:
+                return ('INR' if op == 'INC' else 'DCR', [Z80_REGS[ops[0]]])
+            return ('INX' if op == 'INC' else 'DCX', [self.reg(ops[0], Z80_PAIRS)])
+        elif (op in ('PUSH', 'POP')) and (n == 1):
+            return (op, [self.reg(ops[0], Z80_STACK_PAIRS)])
+        elif (op == 'EX') and (ops == ['DE', 'HL']):
+            return ('XCHG', [])
+        elif (op == 'EX') and (ops == ['(SP)', 'HL']):
+            return ('XTHL', [])
+        elif op == 'JP':
+            if ops == ['(HL)']:
+                return ('PCHL', [])
+            if n == 1:
+                return ('JMP', operands)
+            return ('J' + ops[0], operands[1:])
+        elif op == 'CALL':
+            if n == 1:
+                return ('CALL', operands)
+            return ('C' + ops[0], operands[1:])
+        elif op == 'RET':
+            if n == 0:
+                return ('RET', [])
+            return ('R' + ops[0], [])
+        elif op == 'JR':
+            if n == 1:
+                return ('JR', operands)
+            return ('JR' + ops[0], operands[1:])
+        elif op == 'DJNZ':
+            return ('DJNZ', operands)
+        elif (op == 'RST') and (n == 1):
+            return ('RST', ["%d" % (self.value(operands[0], True, 0) >> 3)])
+        elif (op == 'IN') and (n == 2) and (ops[0] == 'A') and self.is_mem(ops[1]):
+            return ('IN', [operands[1][1:-1]])
+        elif (op == 'OUT') and (n == 2) and (ops[1] == 'A') and self.is_mem(ops[0]):
+            return ('OUT', [operands[0][1:-1]])
+        elif (op in Z80_IMPLIED) and (n == 0):
+            return (Z80_IMPLIED[op], [])
+        raise AsmError("unknown instruction %s %s" % (op, ",".join(operands)))
+
+    def is_mem(self, operand):
+        return operand.startswith('(') and operand.endswith(')')
+
+    def emit_instr(self, pc, op, operands):
+        (op, operands) = self.intel(op, operands)
+        if op not in Z80_OPCODE_SIZES:
+            Assembler.emit_instr(self, pc, op, operands)
+            return
+        mem = self.memory
+        if op in RELATIVE:
+            mem[pc] = RELATIVE[op]
+            disp = self.value(operands[0], True, pc) - (pc + 2)
+            if not (-0x80 <= disp < 0x80):
+                raise AsmError("relative jump out of range at %04XH" % pc)
+            mem[pc + 1] = disp & 0xff
+        elif op == 'LDIR':
+            mem[pc:pc + 2] = b'\xed\xb0'
+        elif op == 'DSBC':
+            mem[pc] = 0xed
+            mem[pc + 1] = 0x42 | (self.reg(operands[0], PAIRS) << 4)
+        elif op in ('LIXD', 'LIYD'):
+            v = self.value(operands[0], True, pc)
+            mem[pc:pc + 4] = bytes((0xdd if op == 'LIXD' else 0xfd, 0x2a, v & 0xff, v >> 8))
+        else:
+            r = self.reg(operands[0], REGS)
+            if r == 6:
+                raise AsmError("bad register %s" % operands[0])
+            mem[pc] = 0xdd if op == 'LDX' else 0xfd
+            mem[pc + 1] = 0x46 | (r << 3)
+            mem[pc + 2] = self.value(operands[1], True, pc) & 0xff
+
+
+class Cpu8080(object):
+    """8080 processor state and instruction execution"""
+
+    def __init__(self, memory):
+        self.mem = memory
+        self.r = [0] * 8
+        self.f = 0x02
+        self.sp = 0
+        self.pc = 0
+        self.cycles = 0
+        self.instructions = 0
+        self.halted = False
+        self.out_ports = []
+        self.in_port = None
+        self.table = [self.op_invalid] * 256
+        self.build_table()
+
+    def build_table(self):
+        t = self.table
+        for n in range(0x40, 0x80):
+            t[n] = self.op_mov
+        t[0x76] = self.op_hlt
+        for n in range(0x80, 0xc0):
+            t[n] = self.op_alu
+        for n in range(8):
+            t[0x06 | (n << 3)] = self.op_mvi
+            t[0x04 | (n << 3)] = self.op_inr
+            t[0x05 | (n << 3)] = self.op_dcr
+            t[0xc6 | (n << 3)] = self.op_alu_imm
+            t[0xc2 | (n << 3)] = self.op_jcc
+            t[0xc4 | (n << 3)] = self.op_ccc
+            t[0xc0 | (n << 3)] = self.op_rcc
+            t[0xc7 | (n << 3)] = self.op_rst
+        for n in range(4):
+            t[0x01 | (n << 4)] = self.op_lxi
+            t[0x03 | (n << 4)] = self.op_inx
+            t[0x0b | (n << 4)] = self.op_dcx
+            t[0x09 | (n << 4)] = self.op_dad
+            t[0xc5 | (n << 4)] = self.op_push
+            t[0xc1 | (n << 4)] = self.op_pop
+        t[0x02] = t[0x12] = self.op_stax
+        t[0x0a] = t[0x1a] = self.op_ldax
+        t[0x3a] = self.op_lda
+        t[0x32] = self.op_sta
+        t[0x2a] = self.op_lhld
+        t[0x22] = self.op_shld
+        t[0xeb] = self.op_xchg
+        t[0xe3] = self.op_xthl
+        t[0xf9] = self.op_sphl
+        t[0xe9] = self.op_pchl
+        t[0x07] = self.op_rlc
+        t[0x0f] = self.op_rrc
+        t[0x17] = self.op_ral
+        t[0x1f] = self.op_rar
+        t[0x2f] = self.op_cma
+        t[0x3f] = self.op_cmc
+        t[0x37] = self.op_stc
+        t[0x27] = self.op_daa
+        t[0xc3] = self.op_jmp
+        t[0xcd] = self.op_call
+        t[0xc9] = self.op_ret
+        t[0xdb] = self.op_in
+        t[0xd3] = self.op_out
+        t[0xfb] = t[0xf3] = t[0x00] = self.op_nop
+
+    # register and memory access
+
+    def get_reg(self, n):
+        if n == 6:
+            return self.mem[(self.r[4] << 8) | self.r[5]]
+        return self.r[n]
+
+    def set_reg(self, n, v):
+        if n == 6:
+            self.mem[(self.r[4] << 8) | self.r[5]] = v
+        else:
+            self.r[n] = v
+
+    def get_pair(self, n):
+        if n == 3:
+            return self.sp
+        return (self.r[n * 2] << 8) | self.r[n * 2 + 1]
+
+    def set_pair(self, n, v):
+        if n == 3:
+            self.sp = v & 0xffff
+        else:
+            self.r[n * 2] = (v >> 8) & 0xff
+            self.r[n * 2 + 1] = v & 0xff
+
+    def hl(self):
+        return (self.r[4] << 8) | self.r[5]
+
+    def fetch8(self):
+        v = self.mem[self.pc]
+        self.pc = (self.pc + 1) & 0xffff
+        return v
+
+    def fetch16(self):
+        v = self.mem[self.pc] | (self.mem[(self.pc + 1) & 0xffff] << 8)
+        self.pc = (self.pc + 2) & 0xffff
+        return v
+
+    def read16(self, addr):
+        return self.mem[addr] | (self.mem[(addr + 1) & 0xffff] << 8)
+
+    def write16(self, addr, v):
+        self.mem[addr] = v & 0xff
+        self.mem[(addr + 1) & 0xffff] = (v >> 8) & 0xff
+
+    def push(self, v):
+        self.sp = (self.sp - 2) & 0xffff
+        self.write16(self.sp, v)
+
+    def pop(self):
+        v = self.read16(self.sp)
+        self.sp = (self.sp + 2) & 0xffff
+        return v
+
+    def cond(self, n):
+        f = self.f
+        if n == 0:
+            return not (f & FLAG_Z)
+        if n == 1:
+            return bool(f & FLAG_Z)
+        if n == 2:
+            return not (f & FLAG_CY)
+        if n == 3:
+            return bool(f & FLAG_CY)
+        if n == 4:
+            return not (f & FLAG_P)
+        if n == 5:
+            return bool(f & FLAG_P)
+        if n == 6:
+            return not (f & FLAG_S)
+        return bool(f & FLAG_S)
+
+    # arithmetic
+
+    def alu(self, n, v):
+        a = self.r[7]
+        cy = self.f & FLAG_CY
+        if n == 0 or n == 1:
+            c = cy if n == 1 else 0
+            res = a + v + c
+            f = SZP[res & 0xff] | (FLAG_CY if res > 0xff else 0)
+            if ((a & 0xf) + (v & 0xf) + c) > 0xf:
+                f |= FLAG_AC
+            self.r[7] = res & 0xff
+        elif n == 2 or n == 3 or n == 7:
+            c = cy if n == 3 else 0
+            res = a - v - c
+            f = SZP[res & 0xff] | (FLAG_CY if res < 0 else 0)
+            if ((a & 0xf) - (v & 0xf) - c) >= 0:
+                f |= FLAG_AC
+            if n != 7:
+                self.r[7] = res & 0xff
+        elif n == 4:
+            res = a & v
+            f = SZP[res]
+            if (a | v) & 0x08:
+                f |= FLAG_AC
+            self.r[7] = res
+        elif n == 5:
+            res = a ^ v
+            f = SZP[res]
+            self.r[7] = res
+        else:
+            res = a | v
+            f = SZP[res]
+            self.r[7] = res
+        self.f = f | 0x02
+
+    # instructions, each returns the T-states used
+
+    def op_invalid(self, op):
+        raise SimError("invalid opcode %02XH at %04XH" % (op, (self.pc - 1) & 0xffff))
+
+    def op_nop(self, op):
+        return 4
+
+    def op_hlt(self, op):
+        self.halted = True
+        return 7
+
+    def op_mov(self, op):
+        d = (op >> 3) & 7
+        s = op & 7
+        self.set_reg(d, self.get_reg(s))
+        return 7 if (d == 6) or (s == 6) else 5
+
+    def op_mvi(self, op):
+        d = (op >> 3) & 7
+        self.set_reg(d, self.fetch8())
+        return 10 if d == 6 else 7
+
+    def op_lxi(self, op):
+        self.set_pair((op >> 4) & 3, self.fetch16())
+        return 10
+
+    def op_lda(self, op):
+        self.r[7] = self.mem[self.fetch16()]
+        return 13
+
+    def op_sta(self, op):
+        self.mem[self.fetch16()] = self.r[7]
+        return 13
+
+    def op_lhld(self, op):
+        v = self.read16(self.fetch16())
+        self.r[4] = v >> 8
+        self.r[5] = v & 0xff
+        return 16
+
+    def op_shld(self, op):
+        self.write16(self.fetch16(), self.hl())
+        return 16
+
+    def op_ldax(self, op):
+        self.r[7] = self.mem[self.get_pair((op >> 4) & 1)]
+        return 7
+
+    def op_stax(self, op):
+        self.mem[self.get_pair((op >> 4) & 1)] = self.r[7]
+        return 7
+
+    def op_xchg(self, op):
+        r = self.r
+        (r[2], r[3], r[4], r[5]) = (r[4], r[5], r[2], r[3])
+        return 4
+
+    def op_xthl(self, op):
+        v = self.read16(self.sp)
+        self.write16(self.sp, self.hl())
+        self.r[4] = v >> 8
+        self.r[5] = v & 0xff
+        return 18
+
+    def op_sphl(self, op):
+        self.sp = self.hl()
+        return 5
+
+    def op_pchl(self, op):
+        self.pc = self.hl()
+        return 5
+
+    def op_alu(self, op):
+        s = op & 7
+        self.alu((op >> 3) & 7, self.get_reg(s))
+        return 7 if s == 6 else 4
+
+    def op_alu_imm(self, op):
+        self.alu((op >> 3) & 7, self.fetch8())
+        return 7
+
+    def op_inr(self, op):
+        d = (op >> 3) & 7
+        v = (self.get_reg(d) + 1) & 0xff
+        self.set_reg(d, v)
+        f = SZP[v] | (self.f & FLAG_CY) | 0x02
+        if (v & 0xf) == 0:
+            f |= FLAG_AC
+        self.f = f
+        return 10 if d == 6 else 5
+
+    def op_dcr(self, op):
+        d = (op >> 3) & 7
+        v = (self.get_reg(d) - 1) & 0xff
+        self.set_reg(d, v)
+        f = SZP[v] | (self.f & FLAG_CY) | 0x02
+        if (v & 0xf) != 0xf:
+            f |= FLAG_AC
+        self.f = f
+        return 10 if d == 6 else 5
+
+    def op_inx(self, op):
+        n = (op >> 4) & 3
+        self.set_pair(n, self.get_pair(n) + 1)
+        return 5
+
+    def op_dcx(self, op):
+        n = (op >> 4) & 3
+        self.set_pair(n, self.get_pair(n) - 1)
+        return 5
+
+    def op_dad(self, op):
+        res = self.hl() + self.get_pair((op >> 4) & 3)
+        self.set_pair(2, res)
+        self.f = (self.f & ~FLAG_CY) | (FLAG_CY if res > 0xffff else 0)
+        return 10
+
+    def op_rlc(self, op):
+        a = self.r[7]
+        cy = a >> 7
+        self.r[7] = ((a << 1) | cy) & 0xff
+        self.f = (self.f & ~FLAG_CY) | cy
+        return 4
+
+    def op_rrc(self, op):
+        a = self.r[7]
+        cy = a & 1
+        self.r[7] = (a >> 1) | (cy << 7)
+        self.f = (self.f & ~FLAG_CY) | cy
+        return 4
+
+    def op_ral(self, op):
+        a = self.r[7]
+        self.r[7] = ((a << 1) | (self.f & FLAG_CY)) & 0xff
+        self.f = (self.f & ~FLAG_CY) | (a >> 7)
+        return 4
+
+    def op_rar(self, op):
+        a = self.r[7]
+        self.r[7] = (a >> 1) | ((self.f & FLAG_CY) << 7)
+        self.f = (self.f & ~FLAG_CY) | (a & 1)
+        return 4
+
+    def op_cma(self, op):
+        self.r[7] ^= 0xff
+        return 4
+
+    def op_cmc(self, op):
+        self.f ^= FLAG_CY
+        return 4
+
+    def op_stc(self, op):
+        self.f |= FLAG_CY
+        return 4
+
+    def op_daa(self, op):
+        a = self.r[7]
+        cy = self.f & FLAG_CY
+        corr = 0
+        if ((a & 0xf) > 9) or (self.f & FLAG_AC):
+            corr |= 0x06
+        if ((a >> 4) > 9) or cy or (((a >> 4) >= 9) and ((a & 0xf) > 9)):
+            corr |= 0x60
+            cy = FLAG_CY
+        f = SZP[(a + corr) & 0xff] | cy | 0x02
+        if ((a & 0xf) + (corr & 0xf)) > 0xf:
+            f |= FLAG_AC
+        self.r[7] = (a + corr) & 0xff
+        self.f = f
+        return 4
+
+    def op_jmp(self, op):
+        self.pc = self.fetch16()
+        return 10
+
+    def op_jcc(self, op):
+        addr = self.fetch16()
+        if self.cond((op >> 3) & 7):
+            self.pc = addr
+        return 10
+
+    def op_call(self, op):
+        addr = self.fetch16()
+        self.push(self.pc)
+        self.pc = addr
+        return 17
+
+    def op_ccc(self, op):
+        addr = self.fetch16()
+        if self.cond((op >> 3) & 7):
+            self.push(self.pc)
+            self.pc = addr
+            return 17
+        return 11
+
+    def op_ret(self, op):
+        self.pc = self.pop()
+        return 10
+
+    def op_rcc(self, op):
+        if self.cond((op >> 3) & 7):
+            self.pc = self.pop()
+            return 11
+        return 5
+
+    def op_rst(self, op):
+        self.push(self.pc)
+        self.pc = op & 0x38
+        return 11
+
+    def op_push(self, op):
+        n = (op >> 4) & 3
+        if n == 3:
+            self.push((self.r[7] << 8) | self.f)
+        else:
+            self.push(self.get_pair(n))
+        return 11
+
+    def op_pop(self, op):
+        n = (op >> 4) & 3
+        v = self.pop()
+        if n == 3:
+            self.r[7] = v >> 8
+            self.f = (v & 0xd7) | 0x02
+        else:
+            self.set_pair(n, v)
+        return 10
+
+    def op_in(self, op):
+        port = self.fetch8()
+        self.r[7] = 0 if self.in_port is None else self.in_port(port) & 0xff
+        return 10
+
+    def op_out(self, op):
+        self.out_ports.append((self.fetch8(), self.r[7]))
+        return 10
+
+    def step(self):
+        """Execute one instruction"""
+        op = self.mem[self.pc]
+        self.pc = (self.pc + 1) & 0xffff
+        self.cycles += self.table[op](op)
+        self.instructions += 1
+
+
+class CpuZ80(Cpu8080):
+    """Z80 processor running the 8080 instructions with Z80 T-states and
+       overflow in the P/V flag, and the Z80 instructions pyplm generates:
+       JR, DJNZ, LDIR, SBC HL and loads through IX and IY"""
+
+    def __init__(self, memory):
+        self.ix = 0
+        self.iy = 0
+        Cpu8080.__init__(self, memory)
+
+    def build_table(self):
+        Cpu8080.build_table(self)
+        t = self.table
+        t[0x10] = self.op_djnz
+        t[0x18] = self.op_jr
+        for n in range(4):
+            t[0x20 | (n << 3)] = self.op_jr_cc
+        t[0xed] = self.op_ed
+        t[0xdd] = t[0xfd] = self.op_index
+
+    def alu(self, n, v):
+        a = self.r[7]
+        c = self.f & FLAG_CY
+        Cpu8080.alu(self, n, v)
+        if n > 3 and n != 7:
+            return
+        if n not in (1, 3):
+            c = 0
+        if n < 2:
+            res = a + v + c
+            over = (a ^ res) & (v ^ res) & 0x80
+        else:
+            res = a - v - c
+            over = (a ^ v) & (a ^ res) & 0x80
+        self.f = (self.f & ~FLAG_P) | (FLAG_P if over else 0)
+
+    # T-states which differ from the 8080
+
+    def op_hlt(self, op):
+        Cpu8080.op_hlt(self, op)
+        return 4
+
+    def op_mov(self, op):
+        return 4 if Cpu8080.op_mov(self, op) == 5 else 7
+
+    def op_inr(self, op):
+        t = Cpu8080.op_inr(self, op)
+        v = self.get_reg((op >> 3) & 7)
+        self.f = (self.f & ~FLAG_P) | (FLAG_P if v == 0x80 else 0)
+        return 4 if t == 5 else 11
+
+    def op_dcr(self, op):
+        t = Cpu8080.op_dcr(self, op)
+        v = self.get_reg((op >> 3) & 7)
+        self.f = (self.f & ~FLAG_P) | (FLAG_P if v == 0x7f else 0)
+        return 4 if t == 5 else 11
+
+    def op_inx(self, op):
+        Cpu8080.op_inx(self, op)
+        return 6
+
+    def op_dcx(self, op):
+        Cpu8080.op_dcx(self, op)
+        return 6
+
+    def op_dad(self, op):
+        Cpu8080.op_dad(self, op)
+        return 11
+
+    def op_xthl(self, op):
+        Cpu8080.op_xthl(self, op)
+        return 19
+
+    def op_sphl(self, op):
+        Cpu8080.op_sphl(self, op)
+        return 6
+
+    def op_pchl(self, op):
+        Cpu8080.op_pchl(self, op)
+        return 4
+
+    def op_ccc(self, op):
+        return 17 if Cpu8080.op_ccc(self, op) == 17 else 10
+
+    def op_in(self, op):
+        Cpu8080.op_in(self, op)
+        return 11
+
+    def op_out(self, op):
+        Cpu8080.op_out(self, op)
+        return 11
+
+    # Z80 only instructions
+
+    def op_djnz(self, op):
+        d = self.fetch8()
+        self.r[0] = (self.r[0] - 1) & 0xff
+        if self.r[0] != 0:
+            self.pc = (self.pc + d - ((d & 0x80) << 1)) & 0xffff
+            return 13
+        return 8
+
+    def op_jr(self, op):
+        d = self.fetch8()
+        self.pc = (self.pc + d - ((d & 0x80) << 1)) & 0xffff
+        return 12
+
+    def op_jr_cc(self, op):
+        d = self.fetch8()
+        if self.cond((op >> 3) & 3):
+            self.pc = (self.pc + d - ((d & 0x80) << 1)) & 0xffff
+            return 12
+        return 7
+
+    def op_ed(self, op):
+        op2 = self.fetch8()
+        if op2 == 0xb0:
+            # LDIR, all of the repeats in one step
+            count = self.get_pair(0) or 0x10000
+            (src, dst) = (self.hl(), self.get_pair(1))
+            for n in range(count):
+                self.mem[(dst + n) & 0xffff] = self.mem[(src + n) & 0xffff]
+            self.set_pair(2, src + count)
+            self.set_pair(1, dst + count)
+            self.set_pair(0, 0)
+            self.f &= ~FLAG_P
+            return (21 * count) - 5
+        if (op2 & 0xcf) == 0x42:
+            # SBC HL,rp
+            (a, v) = (self.hl(), self.get_pair((op2 >> 4) & 3))
+            res = a - v - (self.f & FLAG_CY)
+            f = ((res >> 8) & FLAG_S) | (FLAG_CY if res < 0 else 0) | 0x02
+            if (res & 0xffff) == 0:
+                f |= FLAG_Z
+            if (a ^ v) & (a ^ res) & 0x8000:
+                f |= FLAG_P
+            self.set_pair(2, res)
+            self.f = f
+            return 15
+        raise SimError("invalid opcode EDH %02XH at %04XH" % (op2, (self.pc - 2) & 0xffff))
+
+    def op_index(self, op):
+        op2 = self.fetch8()
+        if op2 == 0x2a:
+            v = self.read16(self.fetch16())
+        elif ((op2 & 0xc7) == 0x46) and (op2 != 0x76):
+            d = self.fetch8()
+            base = self.ix if op == 0xdd else self.iy
+            self.r[(op2 >> 3) & 7] = self.mem[(base + d - ((d & 0x80) << 1)) & 0xffff]
+            return 19
+        else:
+            raise SimError("invalid opcode %02XH %02XH at %04XH" % (op, op2, (self.pc - 2) & 0xffff))
+        if op == 0xdd:
+            self.ix = v
+        else:
+            self.iy = v
+        return 20
+
+
+class Simulator(object):
+    """Assemble and run a pyplm output program"""
+
+    def __init__(self, asmText, conin = "", z80 = False):
+        if z80:
+            self.asm = Z80Assembler(asmText)
+            self.cpu = CpuZ80(bytearray(self.asm.memory))
+        else:
+            self.asm = Assembler(asmText)
+            self.cpu = Cpu8080(bytearray(self.asm.memory))
+        self.conin = list(conin)
+        self.console = ""
+        self.exit = None
+
+    @property
+    def cycles(self):
+        return self.cpu.cycles
+
+    @property
+    def instructions(self):
+        return self.cpu.instructions
+
+    def address(self, name):
+        """Get the address of a symbol"""
+        try:
+            return self.asm.symbols[name.upper()]
+        except KeyError:
+            raise SimError("unknown symbol %s" % name)
+
+    def read_byte(self, name, offset = 0):
+        """Read a byte variable by symbol name"""
+        return self.cpu.mem[(self.address(name) + offset) & 0xffff]
+
+    def read_word(self, name, offset = 0):
+        """Read an address variable by symbol name"""
+        return self.cpu.read16((self.address(name) + offset) & 0xffff)
+
+    def bdos(self):
+        """Handle a CP/M BDOS call, function number in C"""
+        cpu = self.cpu
+        func = cpu.r[1]
+        if func == 0:
+            return False
+        elif func == 1:
+            c = self.conin.pop(0) if len(self.conin) > 0 else '\x1a'
+            cpu.r[7] = cpu.r[5] = ord(c)
+        elif func == 2:
+            self.console += chr(cpu.r[3])
+        elif func == 9:
+            addr = cpu.get_pair(1)
+            while cpu.mem[addr] != ord('$'):
+                self.console += chr(cpu.mem[addr])
+                addr = (addr + 1) & 0xffff
+        elif func == 11:
+            cpu.r[7] = cpu.r[5] = 0xff if len(self.conin) > 0 else 0
+        else:
+            raise SimError("unsupported BDOS function %d" % func)
+        cpu.pc = cpu.pop()
+        cpu.cycles += 10
+        return True
+
+    def run(self, entry = None, maxCycles = 100000000):
+        """Run the program from entry (a symbol or address, default 0100H)
+           until it exits.  Returns the exit reason: "ret", "hlt" or "mon"."""
+        cpu = self.cpu
+        if entry is None:
+            cpu.pc = 0x0100
+        elif isinstance(entry, int):
+            cpu.pc = entry
+        else:
+            cpu.pc = self.address(entry)
+        cpu.sp = 0x0000
+        cpu.push(0x0000)
+        while True:
+            if cpu.pc < 0x0100:
+                if cpu.pc == 0x0000:
+                    self.exit = "ret"
+                elif cpu.pc == 0x0008:
+                    self.exit = "mon"
+                elif cpu.pc == 0x0005:
+                    if self.bdos():
+                        continue
+                    self.exit = "ret"
+                else:
+                    raise SimError("jump to %04XH" % cpu.pc)
+                break
+            cpu.step()
+            if cpu.halted:
+                self.exit = "hlt"
+                break
+            if cpu.cycles > maxCycles:
+                raise SimError("cycle limit %d exceeded at %04XH" % (maxCycles, cpu.pc))
+        return self.exit
+
+
+if __name__ == '__main__':
+
+    from argparse import ArgumentParser
+
+    argparser = ArgumentParser()
+    argparser.add_argument("infile", type=str,
+                           help="8080 ASM file generated by pyplm")
+    argparser.add_argument("-z", "--z80", action="store_true",
+                           help="Z80 ASM file generated by pyplm --target z80")
+    argparser.add_argument("-s", "--start", action="store", type=str,
+                           help="entry symbol (default 0100H)")
+    argparser.add_argument("-m", "--max-cycles", action="store", type=int,
+                           default=100000000,
+                           help="stop after this many T-states")
+    args = argparser.parse_args()
+
+    inFile = open(args.infile, "rt")
+    text = inFile.read()
+    inFile.close()
+
+    try:
+        sim = Simulator(text, z80 = args.z80)
+        reason = sim.run(args.start, args.max_cycles)
+    except (AsmError, SimError) as e:
+        print("ERROR:", e)
+        exit(-1)
+    if len(sim.console) > 0:
+        print(sim.console)
+    print("exit: %s  cycles: %d  instructions: %d" % (reason, sim.cycles, sim.instructions))
+    exit(0)